@@ -1,19 +1,151 @@
 """Functions used to generate random numbers for Monte Carlo"""
-from numpy.random import random_sample, normal
+import numpy as np
 from numpy import sqrt, log, pi, sin, cos, arccos, dot
 
 
-def randomInRange(start,stop=None):
+class RandomSource:
+    """Source of random numbers which draws large blocks of values from a
+    numpy.random.Generator and serves scalars or arrays from the buffers"""
+    def __init__(self,seed=None,blockSize=4096,generator=None):
+        if generator is None:
+            generator = np.random.default_rng(seed)
+        self.generator = generator
+        self.blockSize = blockSize
+        self.setBuffers(np.zeros(0),np.zeros(0))
+
+    def random(self,size=None):
+        """Returns uniform random values in [0,1) (an array if size is given)"""
+        if size is None:
+            if self.uniformIndex>=len(self.uniformList):
+                self.uniformBuffer = self.generator.random(self.blockSize)
+                self.uniformList = self.uniformBuffer.tolist()
+                self.uniformIndex = 0
+            self.uniformIndex += 1
+            return self.uniformList[self.uniformIndex-1]
+        buffer = self.uniformBuffer
+        values, self.uniformBuffer, self.uniformIndex = \
+            self.serveBlock(size,buffer,self.uniformIndex,self.generator.random)
+        if self.uniformBuffer is not buffer:
+            self.uniformList = self.uniformBuffer.tolist()
+        return values
+
+    def normal(self,loc=0.,scale=1.,size=None):
+        """Returns normally distributed random values (an array if size is
+        given or if loc or scale are arrays)"""
+        if size is None and not(isinstance(loc,(np.ndarray,list,tuple))) \
+           and not(isinstance(scale,(np.ndarray,list,tuple))):
+            if self.normalIndex>=len(self.normalList):
+                self.normalBuffer = self.generator.standard_normal(self.blockSize)
+                self.normalList = self.normalBuffer.tolist()
+                self.normalIndex = 0
+            self.normalIndex += 1
+            return loc+scale*self.normalList[self.normalIndex-1]
+        if size is None:
+            size = np.broadcast(np.asarray(loc),np.asarray(scale)).shape
+        buffer = self.normalBuffer
+        values, self.normalBuffer, self.normalIndex = \
+            self.serveBlock(size,buffer,self.normalIndex,self.generator.standard_normal)
+        if self.normalBuffer is not buffer:
+            self.normalList = self.normalBuffer.tolist()
+        return np.asarray(loc)+np.asarray(scale)*values
+
+    def serveBlock(self,size,buffer,index,draw):
+        """Returns array of the given size served from the buffer (refilled with
+        the draw function as necessary), the new buffer, and the new index"""
+        if isinstance(size,(int,np.integer)):
+            count = size
+            shape = None
+        else:
+            count = int(np.prod(size))
+            shape = size
+        if index+count<=len(buffer):
+            values = buffer[index:index+count]
+            index += count
+        elif count>=self.blockSize:
+            # Serve large requests directly, leaving the buffer empty
+            values = np.concatenate((buffer[index:],draw(count-len(buffer)+index)))
+            buffer = np.zeros(0)
+            index = 0
+        else:
+            buffer = np.concatenate((buffer[index:],draw(self.blockSize)))
+            values = buffer[:count]
+            index = count
+        if shape is not None:
+            values = values.reshape(shape)
+        return values, buffer, index
+
+    def getState(self):
+        """Returns the state of the source, including any buffered values"""
+        return {"generator": self.generator.bit_generator.state,
+                "uniform": self.uniformBuffer[self.uniformIndex:].tolist(),
+                "normal": self.normalBuffer[self.normalIndex:].tolist()}
+
+    def setState(self,state):
+        """Sets the state of the source from the result of getState"""
+        self.generator.bit_generator.state = state["generator"]
+        self.setBuffers(np.array(state["uniform"],dtype=float),
+                        np.array(state["normal"],dtype=float))
+
+    def setBuffers(self,uniform,normal):
+        """Sets the buffers of values to be served next"""
+        self.uniformBuffer = uniform
+        self.uniformList = uniform.tolist()
+        self.uniformIndex = 0
+        self.normalBuffer = normal
+        self.normalList = normal.tolist()
+        self.normalIndex = 0
+
+
+class CounterSource:
+    """Counter-based source of random numbers keyed by a run seed and shower
+    index. Each particle gets its own Philox stream for each generation,
+    indexed by the particle id and generation number, so any particle's
+    interactions can be regenerated in isolation and in any order"""
+    def __init__(self,seed=0,shower=0,blockSize=64):
+        self.seed = seed
+        self.shower = shower
+        self.blockSize = blockSize
+        self.key = np.random.SeedSequence([seed,shower]).generate_state(2,dtype=np.uint64)
+
+    def forParticle(self,particleId,generation=0):
+        """Returns a RandomSource for the draws of the particle in the
+        generation. Successive draws advance the lowest counter word (the
+        draw slot)"""
+        counter = [0,generation,particleId%2**64,0]
+        bitGenerator = np.random.Philox(key=self.key,counter=counter)
+        return RandomSource(generator=np.random.Generator(bitGenerator),
+                            blockSize=self.blockSize)
+
+
+defaultSource = RandomSource()
+
+
+def getSource(rng=None):
+    """Returns the given random source, or the default source if none is given"""
+    if rng is None:
+        return defaultSource
+    return rng
+
+
+def setSeed(seed=None):
+    """Reseeds the default random source"""
+    global defaultSource
+    defaultSource = RandomSource(seed)
+
+
+def randomInRange(start,stop=None,rng=None):
     """Returns a random value in the range [start,stop)"""
+    rng = getSource(rng)
     if stop is None:
         stop = start
         start = 0
-    return start+random_sample()*(stop-start)
+    return start+rng.random()*(stop-start)
 
 
-def randomWithSum(n,total):
+def randomWithSum(n,total,rng=None):
     """Generates n uniformly distributed random numbers whose sum is total"""
-    seeds = random_sample(n-1)
+    rng = getSource(rng)
+    seeds = rng.random(n-1)
     seeds = [0,1]+list(seeds)
     seeds.sort()
     vals = []
@@ -22,61 +154,106 @@ def randomWithSum(n,total):
     return vals
 
 
-def isotropicAngles(downgoing=False):
-    """Generates theta and phi with isotropic distribution"""
+def randomWithSums(counts,totals,rng=None):
+    """Generates sets of uniformly distributed random numbers where set i has
+    counts[i] values summing to totals[i]. Returns flat array of all sets"""
+    rng = getSource(rng)
+    counts = np.asarray(counts,dtype=int)
+    totals = np.asarray(totals,dtype=float)
+    # Normalized exponential spacings are distributed like sorted uniform spacings
+    spacings = -log(1-rng.random(np.sum(counts)))
+    starts = np.concatenate(([0],np.cumsum(counts)[:-1]))
+    sums = np.add.reduceat(spacings,starts)
+    return spacings * np.repeat(totals/sums,counts)
+
+
+def isotropicAngles(downgoing=False,size=None,rng=None):
+    """Generates theta and phi with isotropic distribution (arrays of
+    the given size, if any)"""
+    rng = getSource(rng)
     if downgoing:
-        costheta = -1*random_sample()
+        costheta = -1*rng.random(size)
     else:
-        costheta = random_sample()*2-1
+        costheta = rng.random(size)*2-1
     theta = arccos(costheta)
-    phi = random_sample()*2*pi
+    phi = rng.random(size)*2*pi
     return theta,phi
 
 
-def pointInCircle(radius=1):
+def pointInCircle(radius=1,rng=None):
     """Returns random points x,y within a circle of set radius"""
-    r2 = random_sample()*radius**2
-    theta = random_sample()*2*pi
+    rng = getSource(rng)
+    r2 = rng.random()*radius**2
+    theta = rng.random()*2*pi
     return sqrt(r2)*cos(theta),sqrt(r2)*sin(theta)
 
 
-def randomMomentumTriangle(totalKE,masses):
+def randomMomentumTriangle(totalKE,masses,rng=None):
     """Generates three momentum vectors in a random fashion such that
     their vector sum is zero"""
     assert(totalKE>0)
     assert(isinstance(masses,list))
     assert(len(masses)==3)
-    # Loop through generation of momenta until they could possibly sum to zero
-    realistic = False
-    while not(realistic):
-        kes = randomWithSum(3,totalKE)
-        pmags = [0,0,0]
-        for i,mass in enumerate(masses):
-            pmags[i] = sqrt(kes[i]**2 + 2*kes[i]*mass)
+    return list(randomMomentumTriangles([totalKE],masses,rng=rng)[0])
+
+
+def randomMomentumTriangles(totalKEs,masses,returnAcceptance=False,maxCandidates=64,
+                            rng=None):
+    """Generates sets of three momentum vectors in a random fashion such that
+    the vector sum of each set is zero. totalKEs has shape (N,) and masses has
+    shape (3,) or (N,3). Returns momenta with shape (N,3,3), and optionally the
+    fraction of candidate kinetic energy divisions that were accepted"""
+    rng = getSource(rng)
+    totalKEs = np.asarray(totalKEs,dtype=float)
+    size = len(totalKEs)
+    assert(np.all(totalKEs>0))
+    masses = np.broadcast_to(np.asarray(masses,dtype=float),(size,3))
+
+    # Generate momenta until they could possibly sum to zero, drawing several
+    # candidates for each remaining set when acceptance is low
+    pmags = np.zeros((size,3))
+    pending = np.arange(size)
+    drawn = 0
+    accepted = 0
+    candidates = 1
+    while len(pending)>0:
+        seeds = np.sort(rng.random((len(pending),candidates,2)),axis=2)
+        fractions = np.diff(seeds,axis=2,prepend=0,append=1)
+        kes = totalKEs[pending,None,None]*fractions
+        mags = sqrt(kes**2 + 2*kes*masses[pending,None,:])
         # Momenta could sum to zero if no one is greater than the sum of the others
-        realistic = (pmags[0]<pmags[1]+pmags[2]) and \
-                    (pmags[1]<pmags[0]+pmags[2]) and \
-                    (pmags[2]<pmags[0]+pmags[1])
+        realistic = 2*np.max(mags,axis=2) < np.sum(mags,axis=2)
+        drawn += realistic.size
+        accepted += np.count_nonzero(realistic)
+        done = np.any(realistic,axis=1)
+        first = np.argmax(realistic,axis=1)
+        pmags[pending[done]] = mags[done,first[done]]
+        pending = pending[~done]
+        if accepted>0:
+            candidates = min(maxCandidates,int(np.ceil(1.5*drawn/accepted)))
+        else:
+            candidates = maxCandidates
 
     # Set angles from x-axis (unrotated)
-    xis = [0,
-           pi-arccos((pmags[0]**2+pmags[1]**2-pmags[2]**2)/2/pmags[0]/pmags[1]),
-           pi+arccos((pmags[0]**2+pmags[2]**2-pmags[1]**2)/2/pmags[0]/pmags[2])]
+    p0, p1, p2 = pmags[:,0], pmags[:,1], pmags[:,2]
+    xis = np.stack([np.zeros(size),
+                    pi-arccos(np.clip((p0**2+p1**2-p2**2)/2/p0/p1,-1,1)),
+                    pi+arccos(np.clip((p0**2+p2**2-p1**2)/2/p0/p2,-1,1))],axis=1)
+    unrotated = np.stack([pmags*sin(xis),np.zeros((size,3)),pmags*cos(xis)],axis=2)
 
-    # Rotate triangle of momenta by some theta and phi
-    theta,phi = isotropicAngles()
-    sign = int(randomInRange(2)<1)*2-1
-
-    momenta = []
-    for i,mag in enumerate(pmags):
-        unrotated = [mag*sin(xis[i]),0,mag*cos(xis[i])]
-        momenta.append(sign*rotate3D(unrotated,theta,phi))
+    # Rotate each triangle of momenta by some theta and phi
+    theta,phi = isotropicAngles(size=size,rng=rng)
+    sign = (rng.random(size)<.5)*2-1
+    momenta = sign[:,None,None]*rotate3DArray(unrotated,theta,phi)
 
+    if returnAcceptance:
+        return momenta, accepted/max(drawn,1)
     return momenta
 
 
-def chooseMultiplicity(labE,totalKE):
+def chooseMultiplicity(labE,totalKE,rng=None):
     """Choose a pion multiplicity value based on energies"""
+    rng = getSource(rng)
     # Expected value of the multiplicity
     expected = 6*log(labE)-24
     # Maximum value of the multiplicity = KE/(3*pion mass)
@@ -85,11 +262,36 @@ def chooseMultiplicity(labE,totalKE):
     # Choose from a gaussian distribution until multiplicity is a reasonable value
     mult = -1
     while mult<0 or mult>maximum:
-        mult = int(normal(loc=expected,scale=sqrt(expected)))
+        mult = int(rng.normal(loc=expected,scale=sqrt(expected)))
 
     return mult
 
 
+def chooseMultiplicities(labEs,totalKEs,maxCandidates=4096,rng=None):
+    """Choose pion multiplicity values based on arrays of energies"""
+    rng = getSource(rng)
+    expected = 6*log(labEs)-24
+    maximum = totalKEs / (139.57018+139.57018+134.9766)
+
+    # Choose from gaussian distributions until multiplicities are reasonable,
+    # drawing more candidates at a time for any values which are hard to reach
+    mults = np.full(len(expected),-1)
+    pending = np.arange(len(expected))
+    candidates = 1
+    while len(pending)>0:
+        loc = expected[pending,None]
+        draws = np.trunc(rng.normal(loc=loc,scale=sqrt(loc),
+                                size=(len(pending),candidates))).astype(int)
+        valid = (draws>=0) & (draws<=maximum[pending,None])
+        done = np.any(valid,axis=1)
+        first = np.argmax(valid,axis=1)
+        mults[pending[done]] = draws[done,first[done]]
+        pending = pending[~done]
+        candidates = min(4*candidates,maxCandidates)
+
+    return mults
+
+
 def rotate3D(vector,theta=0,phi=0):
     """Rotate 3-vector by spherical angles theta and phi"""
     rx = [[1,0,0],
@@ -101,16 +303,36 @@ def rotate3D(vector,theta=0,phi=0):
     return dot(rz, dot(rx,vector))
 
 
-def randomDistance(inverseCDF):
+def rotate3DArray(vectors,theta,phi):
+    """Rotate 3-vectors by spherical angles theta and phi, where vectors has
+    shape (N,...,3) and theta and phi have shape (N,)"""
+    vectors = np.asarray(vectors,dtype=float)
+    cosT, sinT = cos(theta), sin(theta)
+    cosP, sinP = cos(phi), sin(phi)
+    zeros = np.zeros(len(vectors))
+    ones = np.ones(len(vectors))
+    rx = np.stack([np.stack([ones,zeros,zeros],axis=1),
+                   np.stack([zeros,cosT,-sinT],axis=1),
+                   np.stack([zeros,sinT,cosT],axis=1)],axis=1)
+    rz = np.stack([np.stack([cosP,-sinP,zeros],axis=1),
+                   np.stack([sinP,cosP,zeros],axis=1),
+                   np.stack([zeros,zeros,ones],axis=1)],axis=1)
+    rotation = np.matmul(rz,rx)
+    return np.einsum('nij,n...j->n...i',rotation,vectors)
+
+
+def randomDistance(inverseCDF,rng=None):
     """Returns a random distance for a particle to travel given some inverted
     cumulative density function of the distance (based on the atmospheric model)"""
-    seed = random_sample()
+    rng = getSource(rng)
+    seed = rng.random()
     return inverseCDF(seed)
 
 
-def chooseEnergy(minimum=100):
+def chooseEnergy(minimum=100,rng=None):
     """Returns a random energy value based on an E^-2.7 power law spectrum
     with a minimum energy of 1 GeV"""
-    seed = random_sample()
+    rng = getSource(rng)
+    seed = rng.random()
     normalization = minimum**1.7
     return ((1-seed)/normalization)**(-1/1.7)
@@ -1,10 +1,22 @@
 """Functions for doing analysis of simulated hadron showers"""
-import pickle
+import time
+import json
 import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-from shower import generatePrimary, generateShower
-from MCmethods import randomDistance
+from shower import generatePrimary, generateShower, maxPrimaryEnergy
+from vectorShower import generateEnsemble
+from parallel import runShowers
+from particleStack import ParticleStack
+from dataset import MuonDataset, DatasetWriter, datasetMetadata, loadDataset, loadMetadata, \
+    eventValues, datasetExtension, defaultThresholds
+from MCmethods import randomDistance, getSource
+from catalog import Catalog, catalogPath, codeVersion
+from histograms import Histogram, mergeHistograms
+from cache import ResultCache
+from selection import Column, Columns, evaluate, deg
+from thinning import Thinning
+from cuts import CutPolicy
 from atmosphere import getAirCrossSection, getCollisionInverseCDF
 
 
@@ -31,34 +43,20 @@ def scaleValue(value,base=1):
         return value, letters[index]
 
 
-def interpretFilename(filename):
-    """Returns values of primary based on filename"""
-    directoryIndex = filename.rfind("/")
-    extensionIndex = filename.rfind(".p")
-    filenameBase = filename[directoryIndex+1:extensionIndex]
-    bits = filenameBase.split("_")
-
-    info = {"count": bits[0],
-            "energyType": bits[1][:4],
-            "energyValue": bits[1][4:],
-            "theta": None, "phi": None,
-            "isotropic": False}
-    if len(bits)==3:
-        info["isotropic"] = True
-    elif len(bits)==4:
-        info["theta"] = bits[2][5:]
-        info["phi"] = bits[3][3:]
-    elif len(bits)==5:
-        info["theta"] = bits[2][5:]
-        info["phi"] = bits[3][3:]
-        info["isotropic"] = True
-
-    return info
-
-
-
 def plotHistogramLogLog(data,bars=False,nbins=50,power=1):
-    """Plots the data on a log-log histogram"""
+    """Plots the data (an array or a filled Histogram) on a log-log histogram"""
+    if isinstance(data,Histogram):
+        histogram = data.trimmed()
+        xVals = histogram.centers
+        yVals = histogram.counts
+        if power!=1:
+            yVals = histogram.weighted(power)
+        if bars:
+            plt.hist(xVals,log=True,bins=histogram.edges,weights=histogram.counts)
+            plt.gca().set_xscale("log")
+        else:
+            plt.loglog(xVals,yVals)
+        return xVals, yVals
     if bars:
         logmin = np.log10(np.min(data))
         logmax = np.log10(np.max(data))
@@ -88,9 +86,85 @@ def plotSingleShower(plotName=None,**kwargs):
     print(len(muons),"muons reached the ground")
 
 
-
-def generateDataset(num,minE=100,setE=None,isotropic=False,theta=None,phi=None):
-    """Generate num showers and return muons from each shower"""
+# Metadata of the settings which change a dataset's showers, which must
+# match for a run to resume (or replace) a dataset of the same name
+datasetSettings = ["primaryArgs","ensembleSize","seed","thresholds","thinning","cuts",
+                   "muonTransport"]
+
+
+def fillDataset(writer,num,rng=None,workers=None,checkpointEvery=100,progress=None):
+    """Adds showers to the dataset being written until it holds num events,
+    then marks it complete. The showers are generated with the settings in
+    the dataset's metadata, continuing its random numbers from the last
+    checkpoint, and a checkpoint is made every checkpointEvery events"""
+    metadata = writer.metadata
+    primaryArgs = metadata["primaryArgs"]
+    ensembleSize = metadata["ensembleSize"]
+    seed = metadata["seed"]
+    thinning = Thinning.fromState(metadata.get("thinning"))
+    cuts = CutPolicy.fromState(metadata.get("cuts"))
+    muonTransport = metadata.get("muonTransport")
+    lastCheckpoint = [writer.events]
+    # Count the runtime of earlier sessions of the run
+    startTime = time.time()-metadata.get("runtime",0)
+
+    def addChunk(results,values,state=None):
+        if isinstance(results,list):
+            stack = ParticleStack.fromParticles(
+                [muon for muons in results for muon in muons],
+                showers=writer.events+np.repeat(np.arange(len(results)),
+                                                [len(muons) for muons in results]))
+        else:
+            stack = ParticleStack.concatenate(results.stacks())
+        writer.append(stack,len(values),values)
+        if writer.events-lastCheckpoint[0]>=checkpointEvery:
+            writer.metadata["runtime"] = time.time()-startTime
+            writer.checkpoint(state)
+            lastCheckpoint[0] = writer.events
+
+    if seed is not None:
+        first = writer.events
+        runShowers(num-first,seed,primaryArgs,ensembleSize,workers,
+                   progress=None if progress is None else lambda count: progress(first+count),
+                   shared=True,first=first,callback=addChunk,thinning=thinning,cuts=cuts,
+                   muonTransport=muonTransport)
+        writer.metadata["runtime"] = time.time()-startTime
+        writer.finish()
+        return
+
+    rng = getSource(rng)
+    if metadata.get("resume") is not None:
+        rng.setState(metadata["resume"])
+    batchSize = 1 if ensembleSize is None else ensembleSize
+    while writer.events<num:
+        protons = [generatePrimary(rng=rng,**primaryArgs)
+                   for _ in range(min(batchSize,num-writer.events))]
+        infos = [{} for _ in protons]
+        if ensembleSize is None:
+            showerResults = [generateShower(protons[0].copy(),rng=rng,info=infos[0],
+                                            thinning=thinning,cuts=cuts,
+                                            muonTransport=muonTransport)]
+        else:
+            showerResults = generateEnsemble(protons,rng=rng,infos=infos,thinning=thinning,
+                                             cuts=cuts,muonTransport=muonTransport)
+        values = [eventValues(proton,info) for proton,info in zip(protons,infos)]
+        addChunk(showerResults,values,rng.getState())
+        if progress is not None:
+            progress(writer.events)
+    writer.metadata["runtime"] = time.time()-startTime
+    writer.finish(rng.getState())
+
+
+def generateDataset(num,minE=100,setE=None,isotropic=False,theta=None,phi=None,
+                    ensembleSize=None,rng=None,workers=None,seed=None,checkpointEvery=100,
+                    catalog=catalogPath,catalogShowers=False,thresholds=None,thinning=None,
+                    cuts=None,muonTransport=None):
+    """Generate num showers and save the muons from each shower, resuming an
+    unfinished dataset of the same name (a ValueError is raised if it was
+    made with other settings, see datasetSettings) and recording it in the
+    catalog. Showers are run in ensembles of ensembleSize if given, seeded
+    per event from seed (the same for any number of workers) if workers or
+    seed is given, and with the options of shower.generateShower"""
     if setE is None:
         scaledE, letter = scaleValue(minE,1e6)
         energyString = "minE"+str(int(scaledE))+letter+"eV"
@@ -104,21 +178,18 @@ def generateDataset(num,minE=100,setE=None,isotropic=False,theta=None,phi=None):
         print("set",end=" ")
     print("dataset with",energyString[:4]+"="+energyString[4:])
 
-    showerResults = []
-    tracker = 10
-    for i in range(num):
-        if setE is None:
-            proton = generatePrimary(minE=minE,isotropic=isotropic,
-                                     theta=theta,phi=phi)
-        else:
-            proton = generatePrimary(energy=setE,isotropic=isotropic,
-                                     theta=theta,phi=phi)
-        muons = generateShower(proton)
-        if 100*i/num>=tracker:
-            print("      -",str(tracker)+"%","@",
+    tracker = [10]
+    def printProgress(completed):
+        while tracker[0]<100 and 100*completed/num>=tracker[0]:
+            print("      -",str(tracker[0])+"%","@",
                   datetime.datetime.now().strftime("%H:%M"))
-            tracker += 10
-        showerResults.append(muons)
+            tracker[0] += 10
+
+    primaryArgs = {"isotropic": isotropic, "theta": theta, "phi": phi}
+    if setE is None:
+        primaryArgs["minE"] = minE
+    else:
+        primaryArgs["energy"] = setE
 
     filename = str(num)+"_"
     filename += energyString
@@ -126,33 +197,196 @@ def generateDataset(num,minE=100,setE=None,isotropic=False,theta=None,phi=None):
         filename += "_theta"+str(round(theta,2))+"_phi"+str(round(phi,2))
     if isotropic:
         filename += "_isotropic"
-    filename += ".pickle"
+    filename += datasetExtension
+
+    if workers is not None and seed is None:
+        seed = np.random.SeedSequence().entropy
+    metadata = datasetMetadata(filename,seed)
+    metadata.update({"minE": minE if setE is None else None, "setE": setE, "theta": theta, "phi": phi,
+                     "ensembleSize": ensembleSize, "primaryArgs": primaryArgs,
+                     "num": num, "codeVersion": codeVersion(),
+                     "thresholds": defaultThresholds if thresholds is None else list(thresholds),
+                     "thinning": None if thinning is None else thinning.state(),
+                     "cuts": None if cuts is None else cuts.state(),
+                     "muonTransport": muonTransport,
+                     "created": datetime.datetime.now().isoformat()})
+    writer = DatasetWriter("data/"+filename,metadata)
+    # Compare the settings as they are stored
+    stored = json.loads(json.dumps({name: metadata[name] for name in datasetSettings}))
+    changed = [name for name in datasetSettings
+               if writer.metadata.get(name)!=stored[name]]
+    if len(changed)>0:
+        message = "data/"+filename+" was made with different "+", ".join(changed)+\
+                  ", so remove it to make the dataset again"
+        if "seed" in changed and writer.metadata["seed"] is not None:
+            message += " (or resume it with seed="+str(writer.metadata["seed"])+")"
+        raise ValueError(message)
+    if writer.metadata["complete"]:
+        writer = DatasetWriter("data/"+filename,metadata,overwrite=True)
+    elif writer.events>0:
+        print("      - Resuming from event",writer.events)
 
     print("      - Saving to",filename)
-
-    pFile = open("data/"+filename,'wb')
-    pickle.dump(showerResults,pFile,-1)
-    pFile.close()
+    fillDataset(writer,num,rng,workers,checkpointEvery,printProgress)
+    if catalog is not None:
+        recordDataset("data/"+filename,catalog,catalogShowers)
 
     return filename
 
 
-def plotNumberCounts(dataFileName,plotName=None):
-    """Generates histogram of number of muons reaching the ground"""
-    pFile = open(dataFileName,'rb')
-    showerResults = pickle.load(pFile)
-    pFile.close()
-    info = interpretFilename(dataFileName)
-
-    muonCounts = np.zeros(int(info["count"]))
-    for i,muons in enumerate(showerResults):
-        for muon in muons:
-            if muon.ke>50:
-                muonCounts[i] += 1
-
-    print(np.count_nonzero(muonCounts),"events with muons")
-
-    titleString = "Muon Number Distribution\nfor "+info["count"]
+def extendDataset(dataFileName,extra,rng=None,workers=None,checkpointEvery=100,
+                  catalog=catalogPath,catalogShowers=False):
+    """Adds extra showers to a dataset made by generateDataset (after first
+    finishing it if its run was interrupted), with the same settings and
+    continuing its random numbers, so the existing events are kept as they
+    are. The count in the dataset's name is not changed. Seeded ensemble
+    datasets can only be extended from the end of a whole ensemble, which
+    holds unless the requested count wasn't a multiple of ensembleSize"""
+    writer = DatasetWriter(dataFileName)
+    ensembleSize = writer.metadata["ensembleSize"]
+    if writer.metadata["seed"] is not None and ensembleSize is not None and \
+       writer.events%ensembleSize!=0:
+        raise ValueError("Can't extend "+dataFileName+" as its last ensemble is "
+                         "incomplete, so the extension would repeat its events")
+    num = writer.metadata["num"]+extra
+    writer.metadata["num"] = num
+    print(datetime.datetime.now().strftime("%H:%M"),"- Extending",dataFileName,
+          "from",writer.events,"to",num,"events")
+    fillDataset(writer,num,rng,workers,checkpointEvery)
+    if catalog is not None:
+        recordDataset(dataFileName,catalog,catalogShowers)
+
+
+def recordDataset(dataFileName,catalog=catalogPath,showers=False):
+    """Records the dataset in the catalog database, with a row for each
+    shower if showers is True"""
+    dataset = MuonDataset.open(dataFileName)
+    with Catalog(catalog) as datasetCatalog:
+        datasetCatalog.record(dataFileName,dataset.metadata,dataset if showers else None)
+
+
+# Binning of the histograms filled by analyzeDataset: name of the histogram
+# -> (observable, selection or None, log bins, low, high, number of bins),
+# with the observable and selection being expressions of the muon columns (see
+# selection). The energy and momentum ranges are extended for each dataset by
+# datasetBinning
+analysisBinning = {"radius": ("radius",None,True,1e-1,1e6,70),
+                   "radiusVertical": ("radius",Column("zenith")<6*deg,True,1e-1,1e6,70),
+                   "energy": ("energy",None,True,1e1,1e9,80),
+                   "momentum": ("momentum",None,True,1e1,1e9,80),
+                   "momentumVertical": ("momentum",Column("theta")>11/12*np.pi,
+                                        True,1e1,1e9,80)}
+
+
+def datasetBinning(dataFileName):
+    """Returns analysisBinning with the energy and momentum histograms
+    extended (keeping their bins per decade) up to the highest primary energy
+    of the dataset, so that no muon energy can overflow them"""
+    metadata = loadMetadata(dataFileName)
+    primaryEnergy = metadata.get("setE") or maxPrimaryEnergy
+    # The primary's kinetic energy plus at most a proton mass
+    top = float(10**np.ceil(np.log10(primaryEnergy+1e3)))
+    binning = {}
+    for name,(observable,selection,log,low,high,nbins) in analysisBinning.items():
+        if observable in ["energy","momentum"] and top>high:
+            nbins = int(round(nbins*np.log10(top/low)/np.log10(high/low)))
+            high = top
+        binning[name] = (observable,selection,log,low,high,nbins)
+    return binning
+
+
+def reportOutOfRange(histogram,quantity):
+    """Prints a warning if any muons fell outside the histogram's bins (and
+    so are missing from its plot)"""
+    if histogram.underflow>0 or histogram.overflow>0:
+        print("Warning:",histogram.underflow,"muons below and",histogram.overflow,
+              "above the",quantity,"histogram range of",histogram.edges[0],"to",
+              histogram.edges[-1])
+
+
+def analysisHistograms(binning=None):
+    """Returns dictionary of empty histograms with the binning (by default
+    analysisBinning)"""
+    if binning is None:
+        binning = analysisBinning
+    histograms = {}
+    for name,(observable,selection,log,low,high,nbins) in binning.items():
+        if log:
+            histograms[name] = Histogram.logarithmic(low,high,nbins)
+        else:
+            histograms[name] = Histogram.linear(low,high,nbins)
+    return histograms
+
+
+class AnalysisResults:
+    """Results of a single pass over a dataset which the plot functions are
+    drawn from: the dataset info, the number of muons passing the kinetic
+    energy cut in each event, and histograms of the observables of the muons
+    passing the cut (the "Vertical" ones only of muons with zenith angle
+    below 6° for radius and 15° for momentum). Muons count with their
+    thinning weights. Results of separate shards of a dataset can be merged
+    and saved without the muons themselves"""
+    def __init__(self,info,muonCounts,histograms,keCut=50,observables=None):
+        self.info = info
+        self.muonCounts = muonCounts
+        self.histograms = histograms
+        self.keCut = keCut
+        self.observables = observables
+
+    def __getitem__(self,name):
+        return self.histograms[name]
+
+    def merge(self,other):
+        """Adds the results of another shard with the same cut and binning to
+        these results and returns them"""
+        if other.keCut!=self.keCut:
+            raise ValueError("Can't merge results with different kinetic energy cuts")
+        self.histograms = mergeHistograms([self.histograms,other.histograms])
+        self.muonCounts = np.concatenate([self.muonCounts,other.muonCounts])
+        self.info = dict(self.info,count=str(len(self.muonCounts)))
+        if self.observables is not None and other.observables is not None:
+            self.observables = {name: np.concatenate([values,other.observables[name]])
+                                for name,values in self.observables.items()}
+        else:
+            self.observables = None
+        return self
+
+    def state(self):
+        """Returns the results (without any observable arrays) as a JSON
+        serializable dictionary"""
+        return {"info": self.info, "keCut": self.keCut,
+                "muonCounts": self.muonCounts.tolist(),
+                "histograms": {name: histogram.state() for name,histogram
+                               in self.histograms.items()}}
+
+    @classmethod
+    def fromState(cls,state):
+        """Returns the results with the given state (see state)"""
+        histograms = {name: Histogram.fromState(histogramState) for name,histogramState
+                      in state["histograms"].items()}
+        return cls(state["info"],np.array(state["muonCounts"],dtype=float),histograms,
+                   state["keCut"])
+
+    def save(self,filename):
+        """Writes the results (without any observable arrays) to a JSON file"""
+        with open(filename,'w') as rFile:
+            json.dump(self.state(),rFile)
+
+    @classmethod
+    def load(cls,filename):
+        """Returns the results written by save"""
+        with open(filename) as rFile:
+            return cls.fromState(json.load(rFile))
+
+    def title(self,quantity):
+        """Returns plot title for the quantity's distribution in the dataset"""
+        return distributionTitle(self.info,quantity)
+
+
+def distributionTitle(info,quantity):
+    """Returns plot title for the quantity's distribution in the dataset with
+    the info (see dataset.interpretFilename)"""
+    titleString = quantity+" Distribution\nfor "+info["count"]
     if info["isotropic"]:
         titleString += " Isotropic"
     titleString += " Events with "
@@ -161,6 +395,93 @@ def plotNumberCounts(dataFileName,plotName=None):
     else:
         titleString += "E="
     titleString += info["energyValue"]
+    return titleString
+
+
+def analyzeDataset(dataFileName,keCut=50,chunkSize=1000000,binning=None,keepObservables=False):
+    """Makes one pass over the muons of a dataset, reading chunkSize muons at
+    a time, and returns the AnalysisResults for muons with kinetic energy
+    above keCut (MeV). The muon counts are taken from the event summary if it
+    holds them. With keepObservables the arrays of the observables (radius,
+    zenith, theta, energy, momentum, weight) of every muon passing the cut
+    are kept in the results as well. The default binning is datasetBinning"""
+    dataset = loadDataset(dataFileName)
+    muons = dataset.stack()
+    summarized = dataset.summarizes(keCut)
+    if summarized:
+        muonCounts = dataset.muonCounts(keCut).astype(float)
+    else:
+        muonCounts = np.zeros(len(dataset))
+    if binning is None:
+        binning = datasetBinning(dataFileName)
+    histograms = analysisHistograms(binning)
+    muonCut = Column("ke")>keCut
+    parts = {"radius": [], "zenith": [], "theta": [], "energy": [], "momentum": [],
+             "weight": []}
+    for start in range(0,len(muons),chunkSize):
+        chunk = muonCut.select(muons.select(slice(start,start+chunkSize)))
+        if not(summarized):
+            muonCounts += np.bincount(chunk.showers,weights=chunk.weights,
+                                      minlength=len(dataset))
+        columns = Columns(chunk)
+        for name,(observable,selection,log,low,high,nbins) in binning.items():
+            values = evaluate(observable,columns)
+            weights = columns["weight"]
+            if selection is not None:
+                selected = evaluate(selection,columns)
+                values, weights = values[selected], weights[selected]
+            histograms[name].fill(values,weights)
+        if keepObservables:
+            for name in parts:
+                parts[name].append(columns[name])
+    observables = None
+    if keepObservables:
+        observables = {name: np.concatenate(values) if len(values)>0 else np.zeros(0)
+                       for name,values in parts.items()}
+    return AnalysisResults(dataset.info,muonCounts,histograms,keCut,observables)
+
+
+def cachedAnalysis(dataFileName,keCut=50,binning=None,cache=True):
+    """Returns the AnalysisResults of a dataset from the result cache (a
+    ResultCache, or the default one if True), analyzing the dataset and
+    caching its results only if they aren't already cached"""
+    if not(cache):
+        return analyzeDataset(dataFileName,keCut,binning=binning)
+    if cache is True:
+        cache = ResultCache()
+    if binning is None:
+        binning = datasetBinning(dataFileName)
+    key = cache.key(dataFileName,analysis="analyzeDataset",keCut=keCut,binning=binning)
+    state = cache.get(key)
+    if state is not None:
+        return AnalysisResults.fromState(state)
+    results = analyzeDataset(dataFileName,keCut,binning=binning)
+    cache.put(key,results.state())
+    return results
+
+
+def getResults(dataFileName,cache=True):
+    """Returns the AnalysisResults of a dataset, analyzing it (or taking its
+    results from the cache) if given its filename rather than the results"""
+    if isinstance(dataFileName,AnalysisResults):
+        return dataFileName
+    return cachedAnalysis(dataFileName,cache=cache)
+
+
+def plotNumberCounts(dataFileName,plotName=None):
+    """Generates histogram of number of muons reaching the ground (from the
+    dataset file, reading only its event summary where it holds the counts,
+    or from its AnalysisResults)"""
+    if isinstance(dataFileName,AnalysisResults):
+        info, muonCounts = dataFileName.info, dataFileName.muonCounts
+    else:
+        dataset = loadDataset(dataFileName)
+        info, muonCounts = dataset.info, dataset.muonCounts()
+    muonCounts = np.asarray(muonCounts,dtype=float)
+
+    print(np.count_nonzero(muonCounts),"events with muons")
+
+    titleString = distributionTitle(info,"Muon Number")
 
     plt.hist(muonCounts,np.linspace(0,muonCounts.max()))
     plt.title(titleString)
@@ -174,42 +495,35 @@ def plotNumberCounts(dataFileName,plotName=None):
 
 
 def plotLateralDistribution(dataFileName,rmax=None,plotName=None,setLimits=False):
-    """Generates histogram of radii of muons reaching the ground"""
-    pFile = open(dataFileName,'rb')
-    showerResults = pickle.load(pFile)
-    pFile.close()
-    info = interpretFilename(dataFileName)
-
-    muonDistances = []
-    for i,muons in enumerate(showerResults):
-        for muon in muons:
-            if muon.ke>50:
-                r = np.sqrt(muon.position[0]**2+muon.position[1]**2)
-                if rmax is None or r<rmax:
-                    if not(setLimits) or muon.zenith<6*np.pi/180:
-                        muonDistances.append(r)
-
-    titleString = "Muon Lateral Distribution\nfor "+info["count"]
-    if info["isotropic"]:
-        titleString += " Isotropic"
-    titleString += " Events with "
-    if info["energyType"]=="minE":
-        titleString += "E>"
+    """Generates histogram of radii of muons reaching the ground (from the
+    dataset file or from its AnalysisResults). Muons closer than the first
+    bin edge are shown in a bin starting at 0. With rmax only muons closer
+    than rmax are shown, which needs the dataset file, as the radii are
+    binned again with an edge at rmax"""
+    name = "radiusVertical" if setLimits else "radius"
+    if rmax is None:
+        results = getResults(dataFileName)
+    elif isinstance(dataFileName,AnalysisResults):
+        raise ValueError("rmax needs the dataset file rather than its AnalysisResults")
     else:
-        titleString += "E="
-    titleString += info["energyValue"]
+        # Keep the analysis binning's number of bins per decade up to rmax
+        observable, selection, log, low, high, nbins = analysisBinning[name]
+        if rmax<=low:
+            raise ValueError("rmax must be above the first bin edge, "+str(low)+" m")
+        nbins = max(1,int(np.ceil(nbins*np.log10(rmax/low)/np.log10(high/low))))
+        results = cachedAnalysis(dataFileName,
+                                 binning={name: (observable,selection,log,low,rmax,nbins)})
+
+    histogram = results[name].withUnderflowBin(0).trimmed()
+    if rmax is None:
+        reportOutOfRange(histogram,"radius")
+
+    titleString = results.title("Muon Lateral")
     if setLimits:
         titleString += ", zen<6°"
 
-    nbins = 50
-    logmin = np.log10(np.min(muonDistances))
-    logmax = np.log10(np.max(muonDistances))
-    binsize = (logmax-logmin)/nbins
-    hist = np.histogram(muonDistances,bins=np.logspace(logmin,logmax,nbins+1))
-    xVals = hist[1][:-1] * 10**(binsize/2)
-    yVals = list(hist[0])
-    for i in range(len(yVals)):
-        yVals[i] /= np.pi * (hist[1][i+1]**2 - hist[1][i]**2)
+    xVals = histogram.centers
+    yVals = histogram.areal()
     plt.loglog(xVals,yVals)
 
     plt.title(titleString)
@@ -235,29 +549,14 @@ def plotLateralDistribution(dataFileName,rmax=None,plotName=None,setLimits=False
 
 
 def plotEnergyDistribution(dataFileName,plotName=None):
-    """Generates histogram of energies of muons reaching the ground"""
-    pFile = open(dataFileName,'rb')
-    showerResults = pickle.load(pFile)
-    pFile.close()
-    info = interpretFilename(dataFileName)
-
-    muonEnergies = []
-    for i,muons in enumerate(showerResults):
-        for muon in muons:
-            if muon.ke>50:
-                muonEnergies.append(muon.energy)
-
-    titleString = "Muon Energy Distribution\nfor "+info["count"]
-    if info["isotropic"]:
-        titleString += " Isotropic"
-    titleString += " Events with "
-    if info["energyType"]=="minE":
-        titleString += "E>"
-    else:
-        titleString += "E="
-    titleString += info["energyValue"]
+    """Generates histogram of energies of muons reaching the ground (from the
+    dataset file or from its AnalysisResults)"""
+    results = getResults(dataFileName)
+
+    titleString = results.title("Muon Energy")
 
-    plotHistogramLogLog(muonEnergies)
+    reportOutOfRange(results["energy"],"energy")
+    plotHistogramLogLog(results["energy"])
     plt.title(titleString)
     plt.xlabel("Muon energy (MeV)")
     plt.ylabel("Number of muons")
@@ -269,32 +568,21 @@ def plotEnergyDistribution(dataFileName,plotName=None):
 
 
 def plotMomentumDistribution(dataFileName,plotName=None,setLimits=False):
-    """Generates histogram of momenta of muons reaching the ground"""
-    pFile = open(dataFileName,'rb')
-    showerResults = pickle.load(pFile)
-    pFile.close()
-    info = interpretFilename(dataFileName)
-
-    muonMomenta = []
-    for i,muons in enumerate(showerResults):
-        for muon in muons:
-            if muon.ke>50:
-                if not(setLimits) or muon.theta>11/12*np.pi:
-                    muonMomenta.append(muon.Pmag)
-
-    titleString = "Muon Momentum Distribution\nfor "+info["count"]
-    if info["isotropic"]:
-        titleString += " Isotropic"
-    titleString += " Events with "
-    if info["energyType"]=="minE":
-        titleString += "E>"
+    """Generates histogram of momenta of muons reaching the ground (from the
+    dataset file or from its AnalysisResults)"""
+    results = getResults(dataFileName)
+
+    if setLimits:
+        histogram = results["momentumVertical"]
     else:
-        titleString += "E="
-    titleString += info["energyValue"]
+        histogram = results["momentum"]
+
+    titleString = results.title("Muon Momentum")
     if setLimits:
         titleString += ", "+r"$\theta>\frac{11}{12}\pi$"
 
-    xVals, yVals = plotHistogramLogLog(muonMomenta,power=2.7)
+    reportOutOfRange(histogram,"momentum")
+    xVals, yVals = plotHistogramLogLog(histogram,power=2.7)
     plt.title(titleString)
     plt.xlabel("Muon momentum (MeV)")
     plt.ylabel(r"$p_\mu^{2.7} \times dN/dp_\mu$"+" (arbitrary units)")
@@ -383,10 +671,13 @@ if __name__ == '__main__':
     # plotPrimaryEnergies(100000,minE=1000,plotName="data/100000_minE1GeV_primaries.png")
     # plotFirstInteractionHeight(10000,minE=1000,plotName="10000_minE1GeV_heights.png")
 
+    # from dataset import convertPickle
     # fileBase = "data/100_setE1PeV"
-    # plotNumberCounts(fileBase+".pickle",plotName=fileBase+"_numcts.png")
-    # plotLateralDistribution(fileBase+".pickle",plotName=fileBase+"_latdist.png")
-    # plotLateralDistribution(fileBase+".pickle",plotName=fileBase+"_latdist_zoomed.png",setLimits=True)
-    # plotEnergyDistribution(fileBase+".pickle",plotName=fileBase+"_energies.png")
-    # plotMomentumDistribution(fileBase+".pickle",plotName=fileBase+"_momenta.png")
-    # plotMomentumDistribution(fileBase+".pickle",plotName=fileBase+"_momenta_zoomed.png",setLimits=True)
+    # convertPickle(fileBase+".pickle")
+    # results = analyzeDataset(fileBase+".muons")
+    # plotNumberCounts(results,plotName=fileBase+"_numcts.png")
+    # plotLateralDistribution(results,plotName=fileBase+"_latdist.png")
+    # plotLateralDistribution(results,plotName=fileBase+"_latdist_zoomed.png",setLimits=True)
+    # plotEnergyDistribution(results,plotName=fileBase+"_energies.png")
+    # plotMomentumDistribution(results,plotName=fileBase+"_momenta.png")
+    # plotMomentumDistribution(results,plotName=fileBase+"_momenta_zoomed.png",setLimits=True)
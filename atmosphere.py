@@ -1,15 +1,15 @@
 """Atmospheric model code"""
 import numpy as np
-from MCmethods import random_sample
+from MCmethods import getSource
 from particle import Particle, ParticleError
 
 def density(height,scaleHeight=8000):
     """Returns the number density (in m^-3) of the atmosphere at a given height"""
     return 2.504e25*np.exp(-height/scaleHeight)
 
-def getAtmosphericNucleus(position):
+def getAtmosphericNucleus(position,rng=None):
     """Returns an atomic nucleus based on the atmospheric composition"""
-    atomSeed = random_sample()
+    atomSeed = getSource(rng).random()
     if atomSeed>=1-.78: #78% nitrogen
         return Particle("nitrogen",pos=position)
     elif atomSeed>=.01: #21% oxygen
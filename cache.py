@@ -0,0 +1,134 @@
+"""Code for the on-disk cache of analysis results"""
+import os
+import glob
+import json
+import time
+import hashlib
+
+cacheDirectory = "data/cache"
+cacheSize = 500*1024**2  # bytes
+
+
+def contentHash(path):
+    """Returns the SHA-256 hash of the contents of a file, or of all the files
+    in a directory (e.g. a columnar dataset) along with their names"""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(path,"*")))
+    else:
+        filenames = [path]
+    for filename in filenames:
+        digest.update(os.path.basename(filename).encode())
+        with open(filename,'rb') as dataFile:
+            for block in iter(lambda: dataFile.read(1024**2),b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def fileSignature(path):
+    """Returns the sizes and modification times of a file or the files in a
+    directory, which change whenever their contents are rewritten"""
+    if os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(path,"*")))
+    else:
+        filenames = [path]
+    return [[os.path.basename(filename),os.stat(filename).st_size,
+             os.stat(filename).st_mtime_ns] for filename in filenames]
+
+
+class ResultCache:
+    """Cache of JSON serializable results on local disk, keyed by the content
+    hash of a dataset and the parameters they were computed with. When the
+    cached results exceed maxSize bytes the least recently used are removed.
+    Content hashes are remembered until the dataset's files change, so a hit
+    doesn't read the dataset"""
+    def __init__(self,directory=cacheDirectory,maxSize=cacheSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        os.makedirs(directory,exist_ok=True)
+        self.indexPath = os.path.join(directory,"index.json")
+        try:
+            with open(self.indexPath) as iFile:
+                self.index = json.load(iFile)
+        except (OSError,ValueError):
+            self.index = {"entries": {}, "hashes": {}}
+
+    def writeIndex(self):
+        temporaryPath = self.indexPath+".tmp"
+        with open(temporaryPath,'w') as iFile:
+            json.dump(self.index,iFile)
+        os.replace(temporaryPath,self.indexPath)
+
+    def datasetHash(self,path):
+        """Returns the content hash of the dataset at path"""
+        path = os.path.abspath(path)
+        signature = fileSignature(path)
+        known = self.index["hashes"].get(path)
+        if known is not None and known[0]==signature:
+            return known[1]
+        digest = contentHash(path)
+        self.index["hashes"][path] = [signature,digest]
+        self.writeIndex()
+        return digest
+
+    def key(self,path,**parameters):
+        """Returns the cache key of results of the dataset at path computed
+        with the parameters (which are JSON serialized, using the repr of
+        anything else, e.g. selection expressions)"""
+        description = json.dumps({"dataset": self.datasetHash(path),
+                                  "parameters": parameters},sort_keys=True,default=repr)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def entryPath(self,key):
+        return os.path.join(self.directory,key+".json")
+
+    def get(self,key):
+        """Returns the cached results for the key, or None if not cached"""
+        if key not in self.index["entries"]:
+            return None
+        try:
+            with open(self.entryPath(key)) as eFile:
+                results = json.load(eFile)
+        except (OSError,ValueError):
+            del self.index["entries"][key]
+            self.writeIndex()
+            return None
+        self.index["entries"][key]["used"] = time.time()
+        self.writeIndex()
+        return results
+
+    def put(self,key,results):
+        """Stores results under the key, removing the least recently used
+        results if the cache is then too large"""
+        temporaryPath = self.entryPath(key)+".tmp"
+        with open(temporaryPath,'w') as eFile:
+            json.dump(results,eFile)
+        os.replace(temporaryPath,self.entryPath(key))
+        self.index["entries"][key] = {"size": os.path.getsize(self.entryPath(key)),
+                                      "used": time.time()}
+        self.evict()
+        self.writeIndex()
+
+    def size(self):
+        """Returns the total size in bytes of the cached results"""
+        return sum([entry["size"] for entry in self.index["entries"].values()])
+
+    def evict(self):
+        """Removes least recently used results until the cache fits in maxSize"""
+        entries = self.index["entries"]
+        total = self.size()
+        for key in sorted(entries,key=lambda key: entries[key]["used"]):
+            if total<=self.maxSize:
+                break
+            total -= entries[key]["size"]
+            del entries[key]
+            if os.path.exists(self.entryPath(key)):
+                os.remove(self.entryPath(key))
+
+    def clear(self):
+        """Removes all cached results"""
+        self.maxSize, maxSize = -1, self.maxSize
+        self.evict()
+        self.maxSize = maxSize
+        self.index["hashes"] = {}
+        self.writeIndex()
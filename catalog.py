@@ -0,0 +1,214 @@
+"""Code for the SQLite catalog of generated datasets"""
+import os
+import glob
+import json
+import sqlite3
+import datetime
+import subprocess
+import numpy as np
+from dataset import MuonDataset, loadDataset, datasetMetadata, datasetExtension
+
+catalogPath = "data/catalog.sqlite"
+
+# Columns of the dataset table and their SQL types
+datasetColumns = {"path": "TEXT UNIQUE",
+                  "name": "TEXT",
+                  "events": "INTEGER",
+                  "muons": "INTEGER",
+                  "energyType": "TEXT",
+                  "minE": "REAL",
+                  "setE": "REAL",
+                  "theta": "REAL",
+                  "phi": "REAL",
+                  "isotropic": "INTEGER",
+                  "ensembleSize": "INTEGER",
+                  "seed": "TEXT",
+                  "codeVersion": "TEXT",
+                  "created": "TEXT",
+                  "runtime": "REAL",
+                  "complete": "INTEGER"}
+# Columns of the per-shower table and their SQL types
+showerColumns = {"dataset": "INTEGER",
+                 "event": "INTEGER",
+                 "primaryEnergy": "REAL",
+                 "primaryTheta": "REAL",
+                 "primaryPhi": "REAL",
+                 "firstInteractionHeight": "REAL",
+                 "iterations": "INTEGER",
+                 "muons": "INTEGER",
+                 "muonEnergy": "REAL"}
+
+
+def codeVersion():
+    """Returns the git description of the code (or "unknown" outside git)"""
+    try:
+        result = subprocess.run(["git","describe","--always","--dirty"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True,text=True)
+    except OSError:
+        return "unknown"
+    if result.returncode!=0:
+        return "unknown"
+    return result.stdout.strip()
+
+
+def parseEnergy(energyValue):
+    """Returns the energy in MeV from its string in a filename (e.g. "1GeV")"""
+    letters = ["","k","M","G","T","P","E","Z","Y"]
+    number = energyValue[:-2]
+    index = 0
+    if number[-1] in letters[1:]:
+        index = letters.index(number[-1])
+        number = number[:-1]
+    return float(number)*1000**index/1e6
+
+
+class DatasetHandle:
+    """Catalog entry for one dataset, holding its catalog values as
+    attributes. The dataset's files are only opened by open"""
+    def __init__(self,values):
+        self.values = values
+        for key,val in values.items():
+            setattr(self,key,val)
+
+    def open(self):
+        """Returns the MuonDataset of the entry"""
+        return loadDataset(self.path)
+
+    def __repr__(self):
+        return "DatasetHandle("+repr(self.path)+")"
+
+
+class Catalog:
+    """SQLite catalog with one row per dataset (its parameters, seed, code
+    version, path, and runtime) and optional rows for each shower"""
+    def __init__(self,path=catalogPath):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory!="":
+            os.makedirs(directory,exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS datasets "
+                                    "(id INTEGER PRIMARY KEY, "+
+                                    ", ".join([name+" "+sqlType for name,sqlType
+                                               in datasetColumns.items()])+")")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS showers ("+
+                                    ", ".join([name+" "+sqlType for name,sqlType
+                                               in showerColumns.items()])+
+                                    ", PRIMARY KEY (dataset, event))")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record(self,path,metadata,showers=None):
+        """Adds or updates the row for the dataset at path from its metadata,
+        returning the row id. If a MuonDataset is given as showers, a row for
+        each of its showers is also recorded"""
+        values = {"path": path, "events": metadata.get("events"),
+                  "muons": metadata.get("muons"),
+                  "codeVersion": metadata.get("codeVersion") or codeVersion(),
+                  "created": metadata.get("created") or datetime.datetime.now().isoformat(),
+                  "complete": metadata.get("complete",True)}
+        for name in ["name","energyType","minE","setE","theta","phi","isotropic",
+                     "ensembleSize","runtime"]:
+            values[name] = metadata.get(name)
+        values["seed"] = None if metadata.get("seed") is None else str(metadata["seed"])
+        # Datasets whose angles were only known from their names
+        for name in ["theta","phi"]:
+            if isinstance(values[name],str):
+                values[name] = float(values[name])
+
+        with self.connection:
+            self.connection.execute("INSERT INTO datasets ("+", ".join(values)+") "
+                                    "VALUES ("+", ".join(["?"]*len(values))+") "
+                                    "ON CONFLICT(path) DO UPDATE SET "+
+                                    ", ".join([name+"=excluded."+name for name in values
+                                               if name!="path"]),
+                                    list(values.values()))
+            datasetId = self.connection.execute("SELECT id FROM datasets WHERE path=?",
+                                                (path,)).fetchone()[0]
+            if showers is not None:
+                self.connection.execute("DELETE FROM showers WHERE dataset=?",(datasetId,))
+                summary = showers.summary
+                columns = [[datasetId]*len(showers),range(len(showers))]
+                for name in list(showerColumns)[2:]:
+                    if name=="muons":
+                        columns.append(np.diff(showers.offsets).tolist())
+                    elif name in summary:
+                        columns.append(np.asarray(summary[name]).tolist())
+                    else:
+                        columns.append([None]*len(showers))
+                self.connection.executemany(
+                    "INSERT INTO showers VALUES ("+", ".join(["?"]*len(showerColumns))+")",
+                    zip(*columns))
+        return datasetId
+
+    def query(self,where="1",parameters=()):
+        """Returns handles of the datasets matching an SQL condition"""
+        rows = self.connection.execute("SELECT * FROM datasets WHERE "+where+
+                                       " ORDER BY id",parameters).fetchall()
+        return [DatasetHandle(dict(row)) for row in rows]
+
+    def find(self,**conditions):
+        """Returns handles of the datasets matching all the conditions, given
+        as column=value, or column=(low,high) for an inclusive range with
+        either bound None to leave it open, e.g. find(isotropic=True,
+        minE=(1e6,None)) for all isotropic runs with minE of at least 1 TeV"""
+        clauses = []
+        parameters = []
+        for name,val in conditions.items():
+            if name not in datasetColumns and name!="id":
+                raise ValueError("Unknown catalog column "+name)
+            if isinstance(val,tuple):
+                low, high = val
+                if low is not None:
+                    clauses.append(name+">=?")
+                    parameters.append(low)
+                if high is not None:
+                    clauses.append(name+"<=?")
+                    parameters.append(high)
+            elif val is None:
+                clauses.append(name+" IS NULL")
+            else:
+                clauses.append(name+"=?")
+                parameters.append(val)
+        if len(clauses)==0:
+            return self.query()
+        return self.query(" AND ".join(clauses),parameters)
+
+    def showers(self,handle,where="1",parameters=()):
+        """Returns the shower rows of a dataset (as dictionaries) matching an
+        SQL condition"""
+        rows = self.connection.execute("SELECT * FROM showers WHERE dataset=? AND ("+
+                                       where+") ORDER BY event",
+                                       (handle.id,)+tuple(parameters)).fetchall()
+        return [dict(row) for row in rows]
+
+
+def scanDatasets(directory="data",path=catalogPath,showers=False):
+    """Records all datasets in the directory (both columnar and pickled) in
+    the catalog, returning the number recorded"""
+    count = 0
+    with Catalog(path) as catalog:
+        for filename in sorted(glob.glob(os.path.join(directory,"*"+datasetExtension))):
+            with open(os.path.join(filename,"metadata.json")) as mFile:
+                metadata = json.load(mFile)
+            catalog.record(filename,metadata,MuonDataset.open(filename) if showers else None)
+            count += 1
+        for filename in sorted(glob.glob(os.path.join(directory,"*.pickle"))):
+            dataset = loadDataset(filename)
+            metadata = datasetMetadata(filename)
+            metadata.update({"events": len(dataset), "muons": int(dataset.offsets[-1]),
+                             "codeVersion": "unknown"})
+            metadata[metadata["energyType"]] = parseEnergy(metadata["energyValue"])
+            catalog.record(filename,metadata,dataset if showers else None)
+            count += 1
+    return count
@@ -0,0 +1,66 @@
+"""Code for dropping particles from showers which can't matter to the results"""
+import numpy as np
+from particle import speciesTypes, speciesCodes, speciesMasses, resolveType
+from interactions import decayChannels
+from vectorShower import fragmentCodes
+
+
+class CutPolicy:
+    """Kinetic energy thresholds (MeV) for each species, below which particles
+    are dropped from a shower before being propagated, and whether upward
+    going particles are dropped as well. Dropped particles are added to the
+    shower's EnergyLedger (if given) under their own species"""
+    def __init__(self,thresholds=None,dropUpgoing=False):
+        self.thresholds = np.zeros(len(speciesTypes))
+        if thresholds is not None:
+            for particleType,threshold in thresholds.items():
+                self.thresholds[resolveType(particleType)] = threshold
+        self.dropUpgoing = dropUpgoing
+
+    @classmethod
+    def fromMuonCut(cls,keCut=50,dropUpgoing=False):
+        """Returns the policy which drops only particles that can't lead to a
+        muon with kinetic energy above keCut at the ground: muons below keCut,
+        pions whose total energy is below that of such a muon, and nucleons
+        (and F-16, which decays to a proton) too slow to make such a pion,
+        allowing for the mass released by the collision or decay"""
+        muonMass = speciesMasses[speciesCodes["mu+"]]
+        # Most energy a collision can release by changing the target nucleus
+        collisionRelease = max([np.max(speciesMasses[target]-speciesMasses[fragments])
+                                for target,fragments in fragmentCodes.items()])
+        decayRelease = speciesMasses[speciesCodes["F-16"]] - \
+                       sum([speciesMasses[speciesCodes[t]] for t in decayChannels["F-16"]])
+        nucleonCut = keCut+muonMass-collisionRelease
+        thresholds = {"mu+": keCut, "mu-": keCut,
+                      "pi+": keCut+muonMass-speciesMasses[speciesCodes["pi+"]],
+                      "pi-": keCut+muonMass-speciesMasses[speciesCodes["pi-"]],
+                      "p+": nucleonCut, "n0": nucleonCut,
+                      "F-16": nucleonCut-decayRelease}
+        return cls({particleType: max(threshold,0) for particleType,threshold
+                    in thresholds.items()},dropUpgoing)
+
+    def drops(self,codes,ke,pz):
+        """Returns boolean array of which particles (given by arrays of their
+        type codes, kinetic energies and z momenta) are dropped"""
+        dropped = np.asarray(ke)<self.thresholds[codes]
+        if self.dropUpgoing:
+            dropped |= np.asarray(pz)>0
+        return dropped
+
+    def dropsParticle(self,particle):
+        """Returns whether the Particle is dropped"""
+        return particle.ke<self.thresholds[particle.code] or \
+               (self.dropUpgoing and particle.momentum[2]>0)
+
+    def state(self):
+        """Returns the policy as a JSON serializable dictionary"""
+        return {"thresholds": {speciesTypes[code]: float(self.thresholds[code])
+                               for code in np.flatnonzero(self.thresholds)},
+                "dropUpgoing": self.dropUpgoing}
+
+    @classmethod
+    def fromState(cls,state):
+        """Returns the policy from state (None for no policy)"""
+        if state is None:
+            return None
+        return cls(state["thresholds"],state["dropUpgoing"])
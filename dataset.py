@@ -0,0 +1,406 @@
+"""Code for the columnar on-disk format of muon datasets"""
+import os
+import json
+import pickle
+import numpy as np
+from particleStack import ParticleStack
+
+# Columns with one row per muon, and their types and row shapes
+muonFields = {"code": (np.int16,()),
+              "id": (np.int64,()),
+              "position": (np.float64,(3,)),
+              "momentum": (np.float64,(3,)),
+              "weight": (np.float64,())}
+# Columns with one row per event describing the shower, in the order of the
+# values returned by eventValues
+eventValueFields = {"primaryEnergy": (np.float64,()),
+                    "primaryTheta": (np.float64,()),
+                    "primaryPhi": (np.float64,()),
+                    "firstInteractionHeight": (np.float64,()),
+                    "iterations": (np.int64,())}
+# Kinetic energies (MeV) above which muons are counted in the event summary
+defaultThresholds = [0,50,1000]
+datasetExtension = ".muons"
+formatVersion = 2
+
+
+def eventFields(thresholds=defaultThresholds):
+    """Returns the columns with one row per event: the event offsets (which
+    have one extra leading row of 0), the shower values, and the summary of
+    the muons (number stored above each threshold, and total weighted
+    energy)"""
+    fields = {"offsets": (np.int64,())}
+    fields.update(eventValueFields)
+    fields.update({"muonCounts": (np.int64,(len(thresholds),)),
+                   "muonEnergy": (np.float64,())})
+    return fields
+
+
+def interpretFilename(filename):
+    """Returns values of primary based on filename"""
+    filename = filename.rstrip("/")
+    directoryIndex = filename.rfind("/")
+    for extension in [".pickle",datasetExtension]:
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+    filenameBase = filename[directoryIndex+1:]
+    bits = filenameBase.split("_")
+
+    info = {"count": bits[0],
+            "energyType": bits[1][:4],
+            "energyValue": bits[1][4:],
+            "theta": None, "phi": None,
+            "isotropic": False}
+    if len(bits)==3:
+        info["isotropic"] = True
+    elif len(bits)==4:
+        info["theta"] = bits[2][5:]
+        info["phi"] = bits[3][3:]
+    elif len(bits)==5:
+        info["theta"] = bits[2][5:]
+        info["phi"] = bits[3][3:]
+        info["isotropic"] = True
+
+    return info
+
+
+def eventValues(primary,info=None):
+    """Returns the values stored for an event from its primary (kinetic
+    energy, theta, phi) and the info dictionary filled in by generateShower
+    (first interaction height and number of iterations)"""
+    if info is None:
+        info = {}
+    return [primary.ke,primary.theta,primary.phi,
+            info.get("firstInteractionHeight",np.nan),info.get("iterations",-1)]
+
+
+def eventSummary(stack,count,values=None,thresholds=defaultThresholds,first=0):
+    """Returns dictionary of the event columns (other than offsets) for count
+    events from an array of their event values (missing values are filled
+    with nan, or -1 for integers) and a stack of their muons, whose shower
+    indices are counted from event first"""
+    values = np.zeros((count,0)) if values is None else np.asarray(values,dtype=float)
+    values = values.reshape(count,-1)
+    summary = {}
+    for i,(name,(dtype,shape)) in enumerate(eventValueFields.items()):
+        if i<values.shape[1] and dtype==np.float64:
+            summary[name] = values[:,i].astype(dtype)
+        elif i<values.shape[1]:
+            summary[name] = np.where(np.isnan(values[:,i]),-1,values[:,i]).astype(dtype)
+        else:
+            summary[name] = np.full(count,np.nan if dtype==np.float64 else -1,dtype=dtype)
+    showers = stack.showers-first
+    ke = stack.ke
+    summary["muonCounts"] = np.zeros((count,len(thresholds)),dtype=np.int64)
+    for i,threshold in enumerate(thresholds):
+        summary["muonCounts"][:,i] = np.bincount(showers[ke>threshold],minlength=count)
+    summary["muonEnergy"] = np.bincount(showers,weights=stack.energy*stack.weights,
+                                        minlength=count)
+    return summary
+
+
+def openColumn(path,name,dtype,shape,rows,mode="r"):
+    """Returns a memory map of the column file (or an empty array when there
+    are no rows, since empty files can't be mapped)"""
+    if rows==0:
+        return np.zeros((0,)+shape,dtype=dtype)
+    return np.memmap(os.path.join(path,name+".bin"),dtype=dtype,mode=mode,
+                     shape=(rows,)+shape)
+
+
+class MuonDataset:
+    """Muons from a set of showers held as contiguous columns (code, id,
+    position, momentum, thinning weight) with an index of event offsets, so the muons of event
+    i are rows offsets[i] to offsets[i+1]. Also holds a summary of each event
+    (its primary energy and angles, first interaction height, number of
+    iterations, and number of muons above each threshold and their total
+    energy) and a metadata dictionary describing the dataset"""
+    def __init__(self,columns,offsets,summary,metadata=None):
+        self.columns = columns
+        self.offsets = offsets
+        self.summary = summary
+        self.metadata = {} if metadata is None else metadata
+        self.thresholds = self.metadata.get("thresholds",defaultThresholds)
+
+    @classmethod
+    def open(cls,path):
+        """Returns the dataset stored in the directory, with the columns
+        memory-mapped read-only rather than loaded"""
+        with open(os.path.join(path,"metadata.json")) as mFile:
+            metadata = json.load(mFile)
+        events = metadata["events"]
+        muons = metadata["muons"]
+        # Only the fields listed in the metadata were written
+        fields = {name: (np.dtype(field["dtype"]),tuple(field["shape"]))
+                  for name,field in metadata["fields"].items()}
+        columns = {name: openColumn(path,name,dtype,shape,muons)
+                   for name,(dtype,shape) in fields.items() if name in muonFields}
+        summary = {name: openColumn(path,name,dtype,shape,events)
+                   for name,(dtype,shape) in fields.items()
+                   if name not in muonFields and name!="offsets"}
+        offsets = openColumn(path,"offsets",np.int64,(),events+1)
+        if events==0:
+            offsets = np.zeros(1,dtype=np.int64)
+        return cls(columns,offsets,summary,metadata)
+
+    @classmethod
+    def fromStack(cls,stack,count,values=None,metadata=None):
+        """Returns a dataset of count events from a stack whose shower indices
+        give the event each row belongs to, and an array of event values (see
+        eventValues) with a row for each event"""
+        order = np.argsort(stack.showers,kind="stable")
+        offsets = np.searchsorted(stack.showers[order],np.arange(count+1))
+        columns = {"code": stack.codes[order], "id": stack.ids[order],
+                   "position": stack.positions[order], "momentum": stack.momenta[order],
+                   "weight": stack.weights[order]}
+        thresholds = defaultThresholds if metadata is None \
+                     else metadata.get("thresholds",defaultThresholds)
+        summary = eventSummary(stack,count,values,thresholds)
+        return cls(columns,offsets,summary,metadata)
+
+    @classmethod
+    def fromShowerResults(cls,showerResults,values=None,metadata=None):
+        """Returns a dataset from a list of lists of muons, one per event"""
+        showers = np.repeat(np.arange(len(showerResults)),
+                            [len(muons) for muons in showerResults])
+        stack = ParticleStack.fromParticles([m for muons in showerResults for m in muons],
+                                            showers=showers)
+        return cls.fromStack(stack,len(showerResults),values,metadata)
+
+    def save(self,path):
+        """Writes the dataset to the directory (created if needed), replacing
+        any dataset already there"""
+        writer = DatasetWriter(path,self.metadata,overwrite=True)
+        writer.append(self.stack(),len(self),self.eventValues())
+        writer.finish(self.metadata.get("resume"))
+
+    def eventValues(self):
+        """Returns the array of event values (see eventValues) of the events"""
+        count = len(self)
+        return np.column_stack([self.summary[name] if name in self.summary
+                                else np.full(count,np.nan)
+                                for name in eventValueFields])
+
+    @property
+    def weighted(self):
+        """Returns whether the muons carry weights (from thinning or survival
+        weighted muon transport)"""
+        return self.metadata.get("thinning") is not None or \
+               self.metadata.get("muonTransport")=="survival"
+
+    def summarizes(self,threshold):
+        """Returns whether the event summary holds the muon counts above the
+        threshold (it counts muons rather than weights, so not if weighted)"""
+        return "muonCounts" in self.summary and threshold in self.thresholds and \
+               not(self.weighted)
+
+    def muonCounts(self,threshold=50):
+        """Returns the number of muons in each event with kinetic energy above
+        the threshold, from the event summary if it holds the threshold (for
+        weighted datasets, the sum of the muons' weights)"""
+        if self.summarizes(threshold):
+            return np.asarray(self.summary["muonCounts"][:,self.thresholds.index(threshold)])
+        muons = self.stack()
+        above = muons.ke>threshold
+        return np.bincount(muons.showers[above],
+                           weights=muons.weights[above] if self.weighted else None,
+                           minlength=len(self))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @property
+    def info(self):
+        """Returns values of primary in the form given by interpretFilename"""
+        metadata = self.metadata
+        return {"count": str(len(self)),
+                "energyType": metadata.get("energyType",""),
+                "energyValue": metadata.get("energyValue",""),
+                "theta": metadata.get("theta"), "phi": metadata.get("phi"),
+                "isotropic": metadata.get("isotropic",False)}
+
+    @property
+    def events(self):
+        """Returns the event index of each muon"""
+        return np.repeat(np.arange(len(self)),np.diff(self.offsets))
+
+    def stack(self,event=None):
+        """Returns a ParticleStack of the muons of one event (default all),
+        viewing the columns without copying"""
+        if event is None:
+            rows = slice(0,int(self.offsets[-1]))
+            showers = self.events
+        else:
+            rows = slice(int(self.offsets[event]),int(self.offsets[event+1]))
+            showers = np.full(rows.stop-rows.start,event)
+        return ParticleStack(codes=self.columns["code"][rows],
+                             positions=self.columns["position"][rows],
+                             momenta=self.columns["momentum"][rows],
+                             ids=self.columns["id"][rows],
+                             showers=showers,
+                             weights=self.columns["weight"][rows] if "weight" in self.columns
+                                     else None)
+
+    def muons(self,event):
+        """Returns list of Particle objects for the muons of an event"""
+        return self.stack(event).toParticles()
+
+    def showerResults(self):
+        """Returns the dataset as a list of lists of Particles, one per event"""
+        return [self.muons(i) for i in range(len(self))]
+
+
+class DatasetWriter:
+    """Writes a dataset directory incrementally. Each append adds the muons
+    and event summaries of a chunk of events to the ends of the column files,
+    and checkpoint commits everything appended so far by recording the event
+    and muon counts (and any state needed to continue the run) in the
+    metadata. Opening a directory that already holds a dataset discards
+    anything written after its last checkpoint, so an interrupted run can be
+    resumed (or a finished one extended) from there"""
+    def __init__(self,path,metadata=None,overwrite=False):
+        self.path = path
+        metadataPath = os.path.join(path,"metadata.json")
+        existing = os.path.exists(metadataPath) and not(overwrite)
+        if existing:
+            with open(metadataPath) as mFile:
+                self.metadata = json.load(mFile)
+        else:
+            os.makedirs(path,exist_ok=True)
+            self.metadata = {} if metadata is None else dict(metadata)
+            self.metadata.update({"events": 0, "muons": 0, "complete": False})
+        self.metadata.setdefault("thresholds",defaultThresholds)
+        self.events = self.metadata["events"]
+        self.muons = self.metadata["muons"]
+        self.thresholds = self.metadata["thresholds"]
+        self.fields = dict(muonFields)
+        self.fields.update(eventFields(self.thresholds))
+
+        # Cut the column files back to the last checkpoint
+        self.files = {}
+        for fields,rows in [(muonFields,self.muons),(eventFields(self.thresholds),self.events)]:
+            for name,(dtype,shape) in fields.items():
+                filename = os.path.join(path,name+".bin")
+                rowSize = np.dtype(dtype).itemsize*int(np.prod(shape))
+                # Offsets have a leading row of 0 once the dataset has been started
+                fieldRows = rows+1 if name=="offsets" and existing else rows
+                self.files[name] = open(filename,'ab')
+                self.files[name].truncate(fieldRows*rowSize)
+        # Datasets written before thinning weights existed get unit weights
+        if "weight" not in self.metadata.get("fields",muonFields) and self.muons>0:
+            self.files["weight"].truncate(0)
+            np.ones(self.muons).tofile(self.files["weight"])
+        # Datasets written before the event summary existed get it rebuilt
+        # from their muons, with the unknown shower values filled as missing
+        missing = [name for name in eventFields(self.thresholds)
+                   if name not in self.metadata.get("fields",{})]
+        if existing and self.events>0 and len(missing)>0:
+            for dataFile in self.files.values():
+                dataFile.flush()
+            columns = {name: openColumn(path,name,dtype,shape,self.muons)
+                       for name,(dtype,shape) in muonFields.items()}
+            offsets = openColumn(path,"offsets",np.int64,(),self.events+1)
+            summary = eventSummary(MuonDataset(columns,offsets,{}).stack(),self.events,
+                                   thresholds=self.thresholds)
+            for name in missing:
+                dtype, shape = self.fields[name]
+                self.files[name].truncate(0)
+                np.ascontiguousarray(summary[name],dtype=dtype).tofile(self.files[name])
+        if not(existing):
+            np.zeros(1,dtype=np.int64).tofile(self.files["offsets"])
+            self.checkpoint(self.metadata.get("resume"))
+
+    def append(self,stack,count,values,first=None):
+        """Appends count events whose muons are the rows of the stack, with
+        the shower indices of the rows counted from event first (default the
+        next event of the dataset), and an array of event values (see
+        eventValues) with a row for each event. The event summary is
+        computed from the muons"""
+        if first is None:
+            first = self.events
+        showers = stack.showers-first
+        order = np.argsort(showers,kind="stable")
+        ends = self.muons+np.searchsorted(showers[order],np.arange(1,count+1))
+        columns = eventSummary(stack,count,values,self.thresholds,first)
+        columns.update({"code": stack.codes[order], "id": stack.ids[order],
+                        "position": stack.positions[order],
+                        "momentum": stack.momenta[order], "weight": stack.weights[order],
+                        "offsets": ends})
+        for name,(dtype,shape) in self.fields.items():
+            np.ascontiguousarray(columns[name],dtype=dtype).tofile(self.files[name])
+        self.events += count
+        self.muons += len(stack)
+
+    def checkpoint(self,state=None,complete=False):
+        """Commits all appended events, along with the state needed to
+        continue the run (which must be JSON serializable)"""
+        for dataFile in self.files.values():
+            dataFile.flush()
+            os.fsync(dataFile.fileno())
+        self.metadata.update({"format": formatVersion, "events": self.events,
+                              "muons": self.muons, "complete": complete, "resume": state,
+                              "fields": {name: {"dtype": np.dtype(dtype).str,
+                                                "shape": list(shape)}
+                                         for name,(dtype,shape) in self.fields.items()}})
+        # Replace the metadata in one step so a crash never leaves it half written
+        temporaryPath = os.path.join(self.path,"metadata.json.tmp")
+        with open(temporaryPath,'w') as mFile:
+            json.dump(self.metadata,mFile,indent=1)
+            mFile.flush()
+            os.fsync(mFile.fileno())
+        os.replace(temporaryPath,os.path.join(self.path,"metadata.json"))
+
+    def finish(self,state=None):
+        """Commits all appended events, marks the dataset complete and closes
+        the column files"""
+        self.checkpoint(state,complete=True)
+        for dataFile in self.files.values():
+            dataFile.close()
+        self.files = {}
+
+
+def datasetMetadata(filename,seed=None):
+    """Returns the metadata describing a dataset from its filename"""
+    info = interpretFilename(filename)
+    name = filename.rstrip("/")
+    name = name[name.rfind("/")+1:]
+    for extension in [".pickle",datasetExtension]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return {"name": name,
+            "energyType": info["energyType"],
+            "energyValue": info["energyValue"],
+            "theta": info["theta"], "phi": info["phi"],
+            "isotropic": info["isotropic"],
+            "seed": seed}
+
+
+def loadMetadata(filename):
+    """Returns the metadata of the dataset in a dataset directory, or of a
+    pickled dataset, without reading its muons"""
+    if filename.rstrip("/").endswith(".pickle"):
+        return datasetMetadata(filename)
+    with open(os.path.join(filename,"metadata.json")) as mFile:
+        return json.load(mFile)
+
+
+def loadDataset(filename):
+    """Returns the MuonDataset stored in a dataset directory, or built from
+    a pickled list of lists of muons"""
+    if filename.rstrip("/").endswith(".pickle"):
+        pFile = open(filename,'rb')
+        showerResults = pickle.load(pFile)
+        pFile.close()
+        return MuonDataset.fromShowerResults(showerResults,
+                                             metadata=datasetMetadata(filename))
+    return MuonDataset.open(filename)
+
+
+def convertPickle(filename,path=None):
+    """Converts a pickled dataset to the columnar format and returns the
+    path of the new dataset directory (event values other than the muon
+    summary are not known for pickled datasets and are stored as nan or -1)"""
+    if path is None:
+        path = filename[:filename.rfind(".pickle")]+datasetExtension
+    loadDataset(filename).save(path)
+    return path
@@ -1,10 +1,27 @@
 """Tests for functions across project"""
+import os
+import json
+import pickle
+import shutil
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
 from particle import Particle
-from interactions import lorentzBoost,decay,collision
-from MCmethods import randomDistance
-from atmosphere import getInverseCDF
+from interactions import lorentzBoost,lorentzBoostArray,decay,collision
+from MCmethods import randomDistance, CounterSource
+from atmosphere import getCollisionInverseCDF
+from shower import generatePrimary, generateShower, replayBranch
+from vectorShower import generateEnsemble
+from parallel import runShowers, generateShowerParallel
+from particleStack import ParticleStack
+from dataset import MuonDataset, DatasetWriter, convertPickle
+from ledger import EnergyLedger
+from catalog import Catalog
+from histograms import Histogram, saveHistograms, loadHistograms
+from cache import ResultCache
+from selection import Column, Columns, isSpecies, deg
+from thinning import Thinning
+from cuts import CutPolicy
 
 def testDecay():
     """Test decay function with rest-frame charged pion decay"""
@@ -27,6 +44,22 @@ def testLorentzBoost():
         print("       Expected value:",expected[i])
 
 
+def testLorentzBoostArray():
+    """Test batched lorentzBoostArray against single lorentzBoost calls"""
+    print("Batched Lorentz boost test-")
+    vectors = np.array([[5,0,0,2],[3,1,-1,2],[10,-4,2,6]])
+    betas = np.array([.6,.2,.9])
+    directions = np.array([[0,0,-1],[1,0,0],[0,.6,.8]])
+    shared = lorentzBoostArray(vectors, .6,[0,0,-1])
+    perRow = lorentzBoostArray(vectors, betas,directions)
+    for i in range(len(vectors)):
+        print("  Row",i,"shared boost difference:",
+              np.max(np.abs(shared[i]-lorentzBoost(vectors[i], .6,[0,0,-1]))))
+        print("  Row",i,"per-row boost difference:",
+              np.max(np.abs(perRow[i]-lorentzBoost(vectors[i], betas[i],directions[i]))))
+    print("       Expected values: 0")
+
+
 def testCollision():
     """Test basic kinematics of proton-Nitrogen collision"""
     print("Basic collision test-")
@@ -64,7 +97,7 @@ def testRandomDistance():
     theta = 2/3*np.pi
 
     distances = np.zeros(trials)
-    function = getInverseCDF(sigma,z,theta)
+    function = getCollisionInverseCDF(sigma,z,theta)
     for i in range(trials):
         distances[i] = randomDistance(function)
     plt.hist(distances,bins=nbins,label="Data",normed=True)
@@ -80,8 +113,521 @@ def testRandomDistance():
     plt.show()
 
 
+def fixedPrimaries(count,energy=1e6):
+    """Returns count vertical primaries of the given energy"""
+    return [generatePrimary(energy=energy) for _ in range(count)]
+
+
+def meanAndError(values):
+    """Returns the mean of values and its standard error, rounded"""
+    values = np.asarray(values,dtype=float)
+    return round(np.mean(values),2), round(np.std(values)/np.sqrt(len(values)),2)
+
+
+def testEnsembleStatistics():
+    """Test that the ensemble engine gives the same muon statistics as
+    generateShower"""
+    print("Ensemble statistics test-")
+    scalar = [generateShower(primary) for primary in fixedPrimaries(30)]
+    vector = generateEnsemble(fixedPrimaries(30))
+    for name,results in [("Scalar",scalar),("Vector",vector)]:
+        print("  "+name+" muons per shower:",*meanAndError([len(m) for m in results]),
+              " mean muon energy:",*meanAndError([muon.energy for m in results for muon in m]))
+    print("       Expected values: the same within their errors")
+
+
+def muonKeys(muons):
+    """Returns the sorted ids, positions and momenta of a list of muons, for
+    comparing the muons of two showers"""
+    return sorted([(muon.id,tuple(muon.position),tuple(muon.momentum)) for muon in muons])
+
+
+def testCounterSourceReplay():
+    """Test that replayBranch reproduces the muons of a shower generated with
+    a CounterSource"""
+    print("CounterSource replay test-")
+    primary = fixedPrimaries(1)[0]
+    ceiling = 2*primary.position[2]
+    history = []
+    muons = muonKeys(generateShower(primary,rng=CounterSource(42,3),history=history))
+    inShower = True
+    for generation,particle in history[::max(1,len(history)//7)]:
+        branch = muonKeys(replayBranch(particle,generation,CounterSource(42,3),ceiling))
+        inShower = inShower and set(branch)<=set(muons)
+    print("  Replayed branches within shower:",inShower)
+    generation, particle = history[0]
+    print("  Replayed primary same shower:",
+          muonKeys(replayBranch(particle,generation,CounterSource(42,3),ceiling))==muons)
+    print("       Expected values: True")
+
+
+def testRunShowersWorkers():
+    """Test that runShowers gives the same showers for any number of workers,
+    with and without shared memory"""
+    print("runShowers workers test-")
+    for ensembleSize in [None,4]:
+        runs = []
+        for workers,shared in [(1,False),(1,True),(2,False),(2,True)]:
+            showerResults, primaries = runShowers(8,5,{"energy":1e5},ensembleSize,
+                                                  workers=workers,shared=shared)
+            if shared:
+                with showerResults as records:
+                    showerResults = records.showerResults(8)
+            runs.append(([[(m.type,tuple(m.position),tuple(m.momentum)) for m in muons]
+                          for muons in showerResults],primaries))
+        print("  Ensemble size",ensembleSize,"same results:",
+              all([run[0]==runs[0][0] and np.array_equal(run[1],runs[0][1],equal_nan=True)
+                   for run in runs]))
+    print("       Expected values: True")
+
+
+def testParallelShower():
+    """Test that generateShowerParallel gives the muons of the same shower
+    generated serially with a CounterSource"""
+    print("Parallel shower test-")
+    muons = muonKeys(generateShower(fixedPrimaries(1)[0],rng=CounterSource(42,3)))
+    for workers in [1,2]:
+        parallel = generateShowerParallel(fixedPrimaries(1)[0],splitEnergy=1e5,
+                                          workers=workers,seed=42,shower=3)
+        print("  Workers",workers,"same shower:",muonKeys(parallel)==muons)
+    print("       Expected values: True")
+
+
+def testDatasetFormat():
+    """Test that a pickled dataset converted to the columnar format reads
+    back with the same muons in each event"""
+    print("Dataset format test-")
+    showerResults = generateEnsemble(fixedPrimaries(6))
+    with tempfile.TemporaryDirectory() as temporary:
+        filename = os.path.join(temporary,"6_setE1TeV.pickle")
+        with open(filename,'wb') as pFile:
+            pickle.dump(showerResults,pFile)
+        dataset = MuonDataset.open(convertPickle(filename))
+        print("  Events:",len(dataset),"muons:",len(dataset.stack()),
+              "of",sum([len(muons) for muons in showerResults]))
+        print("  Same muons in each event:",
+              all([muonKeys(dataset.muons(i))==muonKeys(muons)
+                   for i,muons in enumerate(showerResults)]))
+        print("  Energy type:",dataset.info["energyType"],dataset.info["energyValue"])
+    print("       Expected values: 6, the same number, True, setE 1TeV")
+
+
+def testDatasetRoundTrip():
+    """Test that a dataset written in chunks, reopened part way (losing the
+    events after its checkpoint) and extended, reads back as built in memory"""
+    print("Dataset round trip test-")
+    showerResults = generateEnsemble(fixedPrimaries(6),asStack=True)
+    values = np.arange(30,dtype=float).reshape(6,5)
+    expected = MuonDataset.fromStack(ParticleStack.concatenate(showerResults),6,values)
+    def chunk(first,last):
+        stack = ParticleStack.concatenate(showerResults[first:last])
+        return stack, last-first, values[first:last]
+    with tempfile.TemporaryDirectory() as temporary:
+        path = os.path.join(temporary,"test.muons")
+        writer = DatasetWriter(path)
+        writer.append(*chunk(0,2))
+        writer.checkpoint()
+        writer.append(*chunk(2,5))
+        writer = DatasetWriter(path)
+        print("  Events after reopening:",writer.events)
+        writer.append(*chunk(2,4))
+        writer.finish()
+        writer = DatasetWriter(path)
+        writer.append(*chunk(4,6))
+        writer.finish()
+        dataset = MuonDataset.open(path)
+        print("  Offsets difference:",np.max(np.abs(dataset.offsets-expected.offsets)))
+        stack, expectedStack = dataset.stack(), expected.stack()
+        print("  Muon difference:",
+              max([np.max(np.abs(stack.positions-expectedStack.positions)),
+                   np.max(np.abs(stack.momenta-expectedStack.momenta)),
+                   np.max(np.abs(stack.codes-expectedStack.codes)),
+                   np.max(np.abs(stack.showers-expectedStack.showers))]))
+        print("  Summary difference:",
+              max([np.max(np.abs(np.asarray(dataset.summary[name],dtype=float)-
+                                 expected.summary[name]))
+                   for name in expected.summary]))
+        counts = [np.count_nonzero(shower.ke>threshold) for shower in showerResults
+                  for threshold in dataset.thresholds]
+        print("  Summary counts match muons:",
+              np.array_equal(dataset.summary["muonCounts"],np.reshape(counts,(6,-1))))
+    print("       Expected values: 2, 0, 0, 0, True")
+
+
+def testOldDatasetResume():
+    """Test that resuming a dataset written before the event summary existed
+    rebuilds its summary from the muons rather than filling it with zeros"""
+    print("Old dataset resume test-")
+    showerResults = generateEnsemble(fixedPrimaries(6),asStack=True)
+    values = np.arange(30,dtype=float).reshape(6,5)
+    expected = MuonDataset.fromStack(ParticleStack.concatenate(showerResults),6,values)
+    with tempfile.TemporaryDirectory() as temporary:
+        path = os.path.join(temporary,"test.muons")
+        writer = DatasetWriter(path)
+        writer.append(ParticleStack.concatenate(showerResults[:4]),4,values[:4])
+        writer.checkpoint()
+        # Rewrite it as the first format, with only the muons and offsets
+        with open(os.path.join(path,"metadata.json")) as mFile:
+            metadata = json.load(mFile)
+        for name in list(metadata["fields"]):
+            if name not in ["code","id","position","momentum","offsets"]:
+                del metadata["fields"][name]
+                os.remove(os.path.join(path,name+".bin"))
+        metadata["format"] = 1
+        del metadata["thresholds"]
+        with open(os.path.join(path,"metadata.json"),'w') as mFile:
+            json.dump(metadata,mFile)
+        writer = DatasetWriter(path)
+        writer.append(ParticleStack.concatenate(showerResults[4:]),2,values[4:])
+        writer.finish()
+        dataset = MuonDataset.open(path)
+        print("  Rebuilt summary difference:",
+              max([np.max(np.abs(np.asarray(dataset.summary[name],dtype=float)-
+                                 expected.summary[name]))
+                   for name in ["muonCounts","muonEnergy"]]))
+        print("  Unknown primary energies:",np.isnan(dataset.summary["primaryEnergy"][:4]).all(),
+              np.array_equal(dataset.summary["primaryEnergy"][4:],values[4:,0]))
+    print("       Expected values: ~0 (rounding), True True")
+
+
+class InterruptingSource(CounterSource):
+    """CounterSource that raises KeyboardInterrupt once it has given out
+    limit particle streams, to stop a shower part way through"""
+    def __init__(self,seed=0,shower=0,limit=100):
+        CounterSource.__init__(self,seed,shower)
+        self.limit = limit
+
+    def forParticle(self,particleId,generation=0):
+        self.limit -= 1
+        if self.limit<0:
+            raise KeyboardInterrupt
+        return CounterSource.forParticle(self,particleId,generation)
+
+
+def interruptShower(snapshotFile,limit=150,**kwargs):
+    """Starts the CounterSource(42,3) shower of a fixed primary with the
+    keyword arguments, stopping it part way to leave a snapshot, and returns
+    whether it was stopped"""
+    try:
+        generateShower(fixedPrimaries(1)[0],rng=InterruptingSource(42,3,limit=limit),
+                       snapshotFile=snapshotFile,snapshotInterval=0,**kwargs)
+        return False
+    except KeyboardInterrupt:
+        return True
+
+
+def testShowerSnapshot():
+    """Test that a shower stopped part way and restarted from its snapshot
+    gives the same muons, ledger tallies and info as one run straight through,
+    can be drawn, and that snapshots of other showers aren't restarted"""
+    print("Shower snapshot test-")
+    ledger = EnergyLedger()
+    info = {}
+    muons = muonKeys(generateShower(fixedPrimaries(1)[0],rng=CounterSource(42,3),
+                                    ledger=ledger,info=info))
+    with tempfile.TemporaryDirectory() as temporary:
+        snapshotFile = os.path.join(temporary,"shower.npz")
+        print("  Snapshot saved:",interruptShower(snapshotFile,ledger=EnergyLedger(),info={})
+              and os.path.exists(snapshotFile))
+        resumedLedger = EnergyLedger()
+        resumedInfo = {}
+        resumed = muonKeys(generateShower(fixedPrimaries(1)[0],rng=CounterSource(42,3),
+                                          ledger=resumedLedger,info=resumedInfo,
+                                          snapshotFile=snapshotFile))
+        print("  Snapshot removed:",not(os.path.exists(snapshotFile)))
+        print("  Same muons:",resumed==muons)
+        print("  Same ledger:",np.array_equal(resumedLedger.counts,ledger.counts) and
+              np.array_equal(resumedLedger.energy,ledger.energy))
+        print("  Same info:",resumedInfo==info,info)
+
+        interruptShower(snapshotFile)
+        plotName = os.path.join(temporary,"shower.png")
+        generateShower(fixedPrimaries(1)[0],rng=CounterSource(42,3),drawShower=True,
+                       plotName=plotName,snapshotFile=snapshotFile)
+        plt.close("all")
+        print("  Restarted shower drawn:",os.path.exists(plotName))
+        print("       Expected values: True")
+
+        interruptShower(snapshotFile)
+        for name,kwargs in [("Energy",{"primary": fixedPrimaries(1,energy=2e6)[0]}),
+                            ("Seed",{"rng": CounterSource(43,3)}),
+                            ("Thinning",{"thinning": Thinning(1e-3)}),
+                            ("Cuts",{"cuts": CutPolicy.fromMuonCut()}),
+                            ("Muon transport",{"muonTransport": "sample"})]:
+            kwargs = dict({"primary": fixedPrimaries(1)[0],"rng": CounterSource(42,3),
+                           "snapshotFile": snapshotFile},**kwargs)
+            try:
+                generateShower(**kwargs)
+                print("  "+name+" changed: restarted")
+            except ValueError:
+                print("  "+name+" changed: refused")
+        print("  Snapshot kept:",os.path.exists(snapshotFile))
+        print("       Expected values: refused, True")
+
+
+def testCatalog():
+    """Test recording datasets in the catalog and finding them again"""
+    print("Catalog test-")
+    showerResults = generateEnsemble(fixedPrimaries(3))
+    dataset = MuonDataset.fromShowerResults(showerResults)
+    with tempfile.TemporaryDirectory() as temporary:
+        with Catalog(os.path.join(temporary,"catalog.sqlite")) as catalog:
+            catalog.record("data/3_setE1TeV.muons",
+                           {"events": 3, "muons": len(dataset.stack()), "energyType": "setE",
+                            "setE": 1e6, "isotropic": False},dataset)
+            catalog.record("data/5_minE100GeV_iso.muons",
+                           {"events": 5, "muons": 0, "energyType": "minE",
+                            "minE": 1e5, "isotropic": True})
+            found = catalog.find(setE=(1e5,None),isotropic=False)
+            print("  Found datasets:",[handle.path for handle in found])
+            print("  Shower muons:",[row["muons"] for row in catalog.showers(found[0])],
+                  "of",[len(muons) for muons in showerResults])
+    print("       Expected values: ['data/3_setE1TeV.muons'], the same counts")
+
+
+def testAnalyzeDataset():
+    """Test that analyzeDataset gives the same muon counts and energies in
+    one pass, whatever its chunk size, as the muons of each shower"""
+    from analysis import analyzeDataset
+    print("Dataset analysis test-")
+    showerResults = generateEnsemble(fixedPrimaries(6))
+    with tempfile.TemporaryDirectory() as temporary:
+        path = os.path.join(temporary,"6_setE1TeV.muons")
+        MuonDataset.fromShowerResults(showerResults).save(path)
+        whole = analyzeDataset(path,keepObservables=True)
+        chunked = analyzeDataset(path,chunkSize=50,keepObservables=True)
+    counts = [len([muon for muon in muons if muon.ke>50]) for muons in showerResults]
+    energies = sorted([muon.energy for muons in showerResults for muon in muons if muon.ke>50])
+    for name,results in [("One chunk",whole),("Chunks of 50",chunked)]:
+        print("  "+name+" counts match:",np.array_equal(results.muonCounts,counts),
+              " energy difference:",
+              np.max(np.abs(np.sort(results.observables["energy"])-energies)))
+    print("  Same energy histograms:",
+          np.array_equal(whole["energy"].counts,chunked["energy"].counts))
+    print("  Muons outside the energy and momentum histograms:",
+          sum(whole[name].underflow+whole[name].overflow for name in ["energy","momentum"]),
+          " top edge:",whole["energy"].edges[-1])
+    print("       Expected values: True, ~0 (rounding), True, 0, 1e+15")
+
+
+def testHistogramMerge():
+    """Test that histograms filled in parts and merged in any order match
+    one filled at once and numpy's histogram, and survive saving"""
+    print("Histogram merge test-")
+    values = np.random.lognormal(3,2,10000)
+    weights = np.random.random(10000)
+    parts = [Histogram.logarithmic(1,1e4,40).fill(values[i::3],weights[i::3])
+             for i in range(3)]
+    whole = Histogram.logarithmic(1,1e4,40).fill(values,weights)
+    first = (parts[0]+parts[1])+parts[2]
+    second = parts[0]+(parts[1]+parts[2])
+    print("  Merge order difference:",np.max(np.abs(first.counts-second.counts)))
+    print("  Merged and whole difference:",np.max(np.abs(first.counts-whole.counts)),
+          abs(first.overflow-whole.overflow)+abs(first.underflow-whole.underflow))
+    counts = np.histogram(values,whole.edges,weights=weights)[0]
+    print("  Numpy difference:",np.max(np.abs(whole.counts-counts)))
+    with tempfile.TemporaryDirectory() as temporary:
+        filename = os.path.join(temporary,"histograms.json")
+        saveHistograms(filename,{"whole": whole})
+        loaded = loadHistograms(filename)["whole"]
+    print("  Saved difference:",np.max(np.abs(loaded.counts-whole.counts)),
+          loaded.compatible(whole))
+    print("       Expected values: ~0 (rounding), True")
+
+
+def testResultCache():
+    """Test that cached results are found again, missed when the dataset
+    changes, and evicted least recently used first when the cache is full"""
+    print("Result cache test-")
+    with tempfile.TemporaryDirectory() as temporary:
+        dataFile = os.path.join(temporary,"data.bin")
+        with open(dataFile,'wb') as dFile:
+            dFile.write(b"first")
+        cache = ResultCache(os.path.join(temporary,"cache"),maxSize=120)
+        key = cache.key(dataFile,keCut=50)
+        cache.put(key,{"counts": [1,2,3]})
+        print("  Cached results:",ResultCache(os.path.join(temporary,"cache")).get(key))
+        print("  Other parameters:",cache.get(cache.key(dataFile,keCut=60)))
+        cache.put("older",{"counts": [4,5,6]})
+        cache.get(key)
+        cache.put("large",{"counts": list(range(20))})
+        print("  Kept after eviction:",[name for name in [key,"older","large"]
+                                       if cache.get(name) is not None]==[key,"large"],
+              " size:",cache.size(),"<= 120")
+        with open(dataFile,'wb') as dFile:
+            dFile.write(b"second")
+        print("  Changed dataset:",cache.get(cache.key(dataFile,keCut=50)))
+    print("       Expected values: {'counts': [1, 2, 3]}, None, True, None")
+
+
+def testSelection():
+    """Test column expressions against the same cuts written with numpy"""
+    print("Selection test-")
+    stack = ParticleStack.concatenate(generateEnsemble(fixedPrimaries(4),asStack=True))
+    columns = Columns(stack)
+    cut = (Column("ke")>50) & (Column("zenith")<6*deg) & isSpecies("mu+")
+    expected = (stack.ke>50) & (np.pi-stack.theta<6*deg) & stack.isType("mu+")
+    print("  Mismatched rows:",np.count_nonzero(cut.evaluate(columns)!=expected),
+          "of",len(stack))
+    radius = np.sqrt(stack.positions[:,0]**2+stack.positions[:,1]**2)
+    print("  Radius difference:",np.max(np.abs(Column("radius").evaluate(columns)-radius)))
+    print("  Expression:",cut)
+    print("       Expected values: 0, 0")
+
+
+def testThinning():
+    """Test that thinned showers have the same weighted muon numbers as full
+    ones"""
+    print("Thinning test-")
+    for name,thinning in [("Full",None),("Thinned",Thinning(1e-3))]:
+        showerResults = generateEnsemble(fixedPrimaries(20,energy=1e7),asStack=True,
+                                         thinning=thinning)
+        print("  "+name+" weighted muons per shower:",
+              *meanAndError([np.sum(stack.weights[stack.ke>50]) for stack in showerResults]),
+              " muon rows:",sum([len(stack) for stack in showerResults]))
+    print("       Expected values: the same within their errors, fewer rows when thinned")
+
+
+def testCutPolicy():
+    """Test that CutPolicy.fromMuonCut(5000) keeps every muon above 5 GeV in a
+    shower generated with a CounterSource"""
+    print("Cut policy test-")
+    full = generateShower(fixedPrimaries(1)[0],rng=CounterSource(7,0))
+    cut = generateShower(fixedPrimaries(1)[0],rng=CounterSource(7,0),
+                         cuts=CutPolicy.fromMuonCut(5000))
+    print("  Muons above cut:",len([muon for muon in full if muon.ke>5000]),
+          "of",len(full),"without cuts,",len(cut),"with cuts")
+    print("  Same muons above cut:",
+          muonKeys([muon for muon in full if muon.ke>5000])==muonKeys(cut))
+    print("       Expected value: True")
+
+
+def testMuonTransport():
+    """Test that sampled muon transport gives the same muons as stepping, and
+    that survival weights give the same muon numbers"""
+    print("Muon transport test-")
+    stepped = generateShower(fixedPrimaries(1)[0],rng=CounterSource(7,0))
+    sampled = generateShower(fixedPrimaries(1)[0],rng=CounterSource(7,0),
+                             muonTransport="sample")
+    print("  Sampled transport same muons:",muonKeys(stepped)==muonKeys(sampled))
+    print("       Expected value: True")
+    for muonTransport in [None,"survival"]:
+        showerResults = generateEnsemble(fixedPrimaries(40),asStack=True,
+                                         muonTransport=muonTransport)
+        print("  Transport",muonTransport,"weighted muons per shower:",
+              *meanAndError([np.sum(stack.weights) for stack in showerResults]))
+    print("       Expected values: the same within their errors")
+
+
+def datasetDifference(first,second):
+    """Returns the largest difference between the offsets, muon columns and
+    event values of two datasets (inf if their sizes differ). Particle ids
+    are left out, as they count particles made by the process"""
+    first, second = MuonDataset.open(first), MuonDataset.open(second)
+    columns = [(first.offsets,second.offsets)]
+    columns += [(first.columns[name],second.columns[name]) for name in first.columns
+                if name!="id"]
+    columns += [(first.summary[name],second.summary[name]) for name in first.summary]
+    difference = 0
+    for a,b in columns:
+        if np.shape(a)!=np.shape(b):
+            return np.inf
+        if len(a)>0:
+            difference = max(difference,np.nanmax(np.abs(np.asarray(a,dtype=float)-b)))
+    return difference
+
+
+def testDatasetExtension():
+    """Test that extending a seeded dataset gives the same events as one run
+    of the total size, and that datasets ending part way through an
+    ensemble can't be extended"""
+    from analysis import generateDataset, extendDataset
+    print("Dataset extension test-")
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as temporary:
+        os.chdir(temporary)
+        try:
+            for ensembleSize,num,extra in [(None,10,6),(4,8,8)]:
+                try:
+                    os.makedirs("single/data")
+                    os.chdir("single")
+                    generateDataset(num+extra,setE=1e5,ensembleSize=ensembleSize,seed=3,
+                                    workers=1,catalog=None)
+                    os.chdir("..")
+                    os.makedirs("extended/data")
+                    os.chdir("extended")
+                    generateDataset(num,setE=1e5,ensembleSize=ensembleSize,seed=3,
+                                    workers=1,catalog=None)
+                    extendDataset("data/"+str(num)+"_setE100GeV.muons",extra,workers=1,
+                                  catalog=None)
+                    os.chdir("..")
+                    print("  Ensemble size",ensembleSize,"difference:",
+                          datasetDifference("single/data/"+str(num+extra)+"_setE100GeV.muons",
+                                            "extended/data/"+str(num)+"_setE100GeV.muons"))
+                finally:
+                    os.chdir(temporary)
+                    shutil.rmtree("single",ignore_errors=True)
+                    shutil.rmtree("extended",ignore_errors=True)
+            print("       Expected values: 0")
+            os.makedirs("partial/data")
+            os.chdir("partial")
+            generateDataset(10,setE=1e5,ensembleSize=4,seed=3,workers=1,catalog=None)
+            try:
+                extendDataset("data/10_setE100GeV.muons",6,workers=1,catalog=None)
+                print("  Partial ensemble extended")
+            except ValueError:
+                print("  Partial ensemble refused")
+            print("       Expected value: Partial ensemble refused")
+        finally:
+            os.chdir(directory)
+
+
+def testDatasetSeed():
+    """Test that a seeded dataset is only resumed or replaced by a run with
+    the same seed"""
+    from analysis import generateDataset
+    print("Dataset seed test-")
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as temporary:
+        os.chdir(temporary)
+        try:
+            os.makedirs("data")
+            generateDataset(4,setE=1e5,seed=3,workers=1,catalog=None)
+            for name,kwargs in [("Other seed",{"seed": 4,"workers": 1}),
+                                ("No seed",{}),
+                                ("Workers without seed",{"workers": 1}),
+                                ("Same seed",{"seed": 3})]:
+                try:
+                    generateDataset(4,setE=1e5,catalog=None,**kwargs)
+                    print("  "+name+": replaced")
+                except ValueError:
+                    print("  "+name+": refused")
+        finally:
+            os.chdir(directory)
+    print("       Expected values: refused, refused, refused, replaced")
+
+
 if __name__ == '__main__':
     # testDecay()
     # testLorentzBoost()
+    # testLorentzBoostArray()
     # testCollision()
+    # testEnsembleStatistics()
+    # testCounterSourceReplay()
+    # testRunShowersWorkers()
+    # testParallelShower()
+    # testDatasetFormat()
+    # testDatasetRoundTrip()
+    # testOldDatasetResume()
+    # testShowerSnapshot()
+    # testCatalog()
+    # testAnalyzeDataset()
+    # testHistogramMerge()
+    # testResultCache()
+    # testSelection()
+    # testThinning()
+    # testCutPolicy()
+    # testMuonTransport()
+    # testDatasetExtension()
+    # testDatasetSeed()
     testRandomDistance()
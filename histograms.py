@@ -0,0 +1,161 @@
+"""Code for histograms which are filled incrementally and can be merged"""
+import json
+import numpy as np
+
+
+class Histogram:
+    """Histogram with fixed bin edges (linearly or logarithmically spaced)
+    which is filled from arrays of values a batch at a time. Values outside
+    the edges are counted in underflow and overflow. Histograms with the same
+    binning can be merged in any order, and their state can be saved and
+    loaded so that histograms of separate jobs can be combined"""
+    def __init__(self,edges,log=False,counts=None,underflow=0,overflow=0,entries=0):
+        self.edges = np.asarray(edges,dtype=float)
+        self.log = log
+        if counts is None:
+            counts = np.zeros(len(self.edges)-1)
+        self.counts = np.asarray(counts,dtype=float)
+        self.underflow = underflow
+        self.overflow = overflow
+        self.entries = entries
+
+    @classmethod
+    def linear(cls,low,high,nbins=50):
+        """Returns empty histogram with nbins equal bins from low to high"""
+        return cls(np.linspace(low,high,nbins+1))
+
+    @classmethod
+    def logarithmic(cls,low,high,nbins=50):
+        """Returns empty histogram with nbins bins from low to high which are
+        equal in size on a log scale"""
+        return cls(np.logspace(np.log10(low),np.log10(high),nbins+1),log=True)
+
+    def fill(self,values,weights=None):
+        """Adds an array of values (with optional weights) to the histogram"""
+        values = np.asarray(values,dtype=float).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        weights = np.broadcast_to(np.asarray(weights,dtype=float),values.shape)
+        bins = np.searchsorted(self.edges,values,side="right")-1
+        # Values equal to the last edge belong in the last bin
+        bins[values==self.edges[-1]] = len(self.counts)-1
+        inside = (bins>=0) & (bins<len(self.counts))
+        self.counts += np.bincount(bins[inside],weights=weights[inside],
+                                   minlength=len(self.counts))
+        self.underflow += float(np.sum(weights[values<self.edges[0]]))
+        self.overflow += float(np.sum(weights[values>self.edges[-1]]))
+        self.entries += len(values)
+        return self
+
+    def compatible(self,other):
+        """Returns whether the other histogram has the same binning"""
+        return self.log==other.log and np.array_equal(self.edges,other.edges)
+
+    def merge(self,other):
+        """Adds the contents of another histogram with the same binning to
+        this one and returns this histogram"""
+        if not(self.compatible(other)):
+            raise ValueError("Can't merge histograms with different binning")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.entries += other.entries
+        return self
+
+    def __add__(self,other):
+        return self.copy().merge(other)
+
+    def copy(self):
+        return Histogram(self.edges.copy(),self.log,self.counts.copy(),
+                         self.underflow,self.overflow,self.entries)
+
+    def trimmed(self,low=None,high=None):
+        """Returns a copy of the histogram without the empty bins at either
+        end, or if low or high are given without the bins entirely below low
+        or above high (their counts go into underflow and overflow)"""
+        if low is None and high is None:
+            filled = np.nonzero(self.counts)[0]
+            if len(filled)==0:
+                return self.copy()
+            first, last = filled[0], filled[-1]+1
+        else:
+            first, last = 0, len(self.counts)
+            if low is not None:
+                first = max(np.searchsorted(self.edges,low,side="right")-1,0)
+            if high is not None:
+                last = max(np.searchsorted(self.edges,high,side="left"),first)
+        return Histogram(self.edges[first:last+1].copy(),self.log,
+                         self.counts[first:last].copy(),
+                         self.underflow+float(np.sum(self.counts[:first])),
+                         self.overflow+float(np.sum(self.counts[last:])),self.entries)
+
+    def withUnderflowBin(self,low=0):
+        """Returns a copy of the histogram with the underflow counted in an
+        extra first bin starting at low (e.g. 0 for distances)"""
+        return Histogram(np.concatenate(([low],self.edges)),self.log,
+                         np.concatenate(([self.underflow],self.counts)),0,
+                         self.overflow,self.entries)
+
+    @property
+    def centers(self):
+        """Returns the centers of the bins (on a log scale for log bins, for
+        which a bin starting at 0 is centered on half its upper edge)"""
+        if self.log:
+            return np.where(self.edges[:-1]>0,np.sqrt(self.edges[:-1]*self.edges[1:]),
+                            self.edges[1:]/2)
+        return (self.edges[:-1]+self.edges[1:])/2
+
+    @property
+    def widths(self):
+        return np.diff(self.edges)
+
+    def weighted(self,power=1):
+        """Returns the counts multiplied by the bin centers to the power"""
+        return self.counts*self.centers**power
+
+    def areal(self):
+        """Returns the counts divided by the area of the ring each bin covers
+        (for a histogram of distances from a center)"""
+        return self.counts/(np.pi*(self.edges[1:]**2-self.edges[:-1]**2))
+
+    def density(self):
+        """Returns the counts divided by the bin widths"""
+        return self.counts/self.widths
+
+    def state(self):
+        """Returns the state of the histogram as a JSON serializable dictionary"""
+        return {"edges": self.edges.tolist(), "log": self.log,
+                "counts": self.counts.tolist(), "underflow": self.underflow,
+                "overflow": self.overflow, "entries": self.entries}
+
+    @classmethod
+    def fromState(cls,state):
+        """Returns the histogram with the given state (see state)"""
+        return cls(state["edges"],state["log"],state["counts"],state["underflow"],
+                   state["overflow"],state["entries"])
+
+
+def saveHistograms(filename,histograms):
+    """Writes a dictionary of histograms to a JSON file"""
+    with open(filename,'w') as hFile:
+        json.dump({name: histogram.state() for name,histogram in histograms.items()},hFile)
+
+
+def loadHistograms(filename):
+    """Returns the dictionary of histograms written by saveHistograms"""
+    with open(filename) as hFile:
+        states = json.load(hFile)
+    return {name: Histogram.fromState(state) for name,state in states.items()}
+
+
+def mergeHistograms(histogramSets):
+    """Returns the merged histograms of a list of dictionaries of histograms
+    (e.g. one from each shard of a dataset)"""
+    merged = {}
+    for histograms in histogramSets:
+        for name,histogram in histograms.items():
+            if name in merged:
+                merged[name].merge(histogram)
+            else:
+                merged[name] = histogram.copy()
+    return merged
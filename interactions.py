@@ -1,122 +1,169 @@
 """Functions for handling particle collisions and decays"""
 import numpy as np
 from constants import pi, c
-from MCmethods import randomInRange, randomWithSum, isotropicAngles, randomMomentumTriangle, chooseMultiplicity
-from particle import Particle
+from MCmethods import randomInRange, randomWithSum, isotropicAngles, randomMomentumTriangles, chooseMultiplicity
+from particle import Particle, speciesCodes, speciesMasses
+
+# Products of two-body decays (the neutrinos of three-body decays are ignored)
+decayChannels = {"pi+": ("mu+","nuMu"),
+                 "pi-": ("mu-","nuMuBar"),
+                 "F-16": ("O-15","p+"),
+                 "C-14": ("N","e-"),
+                 "O-14": ("N","e-"),
+                 "N-16": ("O","e-"),
+                 "O-15": ("N","e+"),
+                 "Cl-40": ("Ar","e-"),
+                 "K-40": ("Ca","e-")}
+muonDecayProducts = {"mu+": ("e+","nuE","nuMuBar"),
+                     "mu-": ("e-","nuEBar","nuMu")}
+
+
+def twoBodyMomentum(m0,m1,m2):
+    """Returns the magnitude of the product momenta in the rest frame of a two
+    body decay of particle with mass m0 to particles with masses m1 and m2"""
+    return np.sqrt((m0**2+m1**2-m2**2)**2 - 4*m0**2*m1**2) / (2*m0)
+
+# Rest-frame product momentum of each decay channel
+decayMomenta = {parent: twoBodyMomentum(speciesMasses[speciesCodes[parent]],
+                                        speciesMasses[speciesCodes[products[0]]],
+                                        speciesMasses[speciesCodes[products[1]]])
+                for parent,products in decayChannels.items()}
+# Rest-frame product energies of each decay channel
+decayEnergies = {parent: tuple([np.sqrt(speciesMasses[speciesCodes[t]]**2+decayMomenta[parent]**2)
+                                for t in products])
+                 for parent,products in decayChannels.items()}
 
 
 def lorentzBoost(vector,beta=0,direction=[0,0,0]):
     """Calculate the lorentz boosted 4-vector for given beta and direction of boost"""
-    nx = direction[0]
-    ny = direction[1]
-    nz = direction[2]
-    gamma = 1/np.sqrt(1-beta**2)
-    boost = [[gamma, -gamma*beta*nx, -gamma*beta*ny, -gamma*beta*nz],
-             [-gamma*beta*nx, 1+(gamma-1)*nx**2, (gamma-1)*nx*ny, (gamma-1)*nx*nz],
-             [-gamma*beta*ny, (gamma-1)*ny*nx, 1+(gamma-1)*ny**2, (gamma-1)*ny*nz],
-             [-gamma*beta*nz, (gamma-1)*nz*nx, (gamma-1)*nz*ny, 1+(gamma-1)*nz**2]]
-    return np.dot(boost,vector)
+    return lorentzBoostArray([vector],beta,direction)[0]
+
 
+def boostMatrix(beta,nx,ny,nz):
+    """Returns the lorentz boost matrix for given beta and direction of boost"""
+    gamma = 1/np.sqrt(1-beta**2)
+    boost = np.array([[gamma, -gamma*beta*nx, -gamma*beta*ny, -gamma*beta*nz],
+                      [-gamma*beta*nx, 1+(gamma-1)*nx**2, (gamma-1)*nx*ny, (gamma-1)*nx*nz],
+                      [-gamma*beta*ny, (gamma-1)*ny*nx, 1+(gamma-1)*ny**2, (gamma-1)*ny*nz],
+                      [-gamma*beta*nz, (gamma-1)*nz*nx, (gamma-1)*nz*ny, 1+(gamma-1)*nz**2]])
+    return boost
+
+
+def lorentzBoostArray(vectors,beta=0,direction=[0,0,0]):
+    """Calculate the lorentz boosted 4-vectors for an (N,4) array of vectors.
+    Either one boost is shared by all vectors (scalar beta and one direction)
+    or each row has its own boost (beta of shape (N,) and/or directions of
+    shape (N,3))"""
+    vectors = np.asarray(vectors,dtype=float)
+    beta = np.asarray(beta,dtype=float)
+    direction = np.asarray(direction,dtype=float)
+    if beta.ndim==0 and direction.ndim==1:
+        boost = boostMatrix(float(beta),*[float(n) for n in direction])
+        return np.dot(vectors,boost.T)
+
+    # Apply per-row boosts without building the matrices:
+    #  E' = gamma*(E - beta*n.p),  p' = p + ((gamma-1)*n.p - gamma*beta*E)*n
+    beta = np.broadcast_to(beta,vectors.shape[:1])
+    direction = np.broadcast_to(direction,vectors.shape[:1]+(3,))
+    gamma = 1/np.sqrt(1-beta**2)
+    energies = vectors[:,0]
+    momenta = vectors[:,1:]
+    ndotp = np.sum(direction*momenta,axis=1)
+    boosted = np.empty_like(vectors)
+    boosted[:,0] = gamma*(energies - beta*ndotp)
+    boosted[:,1:] = momenta + ((gamma-1)*ndotp - gamma*beta*energies)[:,None]*direction
+    return boosted
+
+
+
+def buildProducts(productTypes,fourmomenta,position,ledger=None,firstId=None,weight=1.):
+    """Returns Particles of the given types with the given lab-frame
+    4-momenta, carrying the thinning weight of their parent. Products of any
+    types the ledger tallies are added to the ledger rather than being built"""
+    products = []
+    for i,productType in enumerate(productTypes):
+        code = speciesCodes[productType]
+        if ledger is not None and ledger.tallies(code):
+            ledger.add(code,fourmomenta[i][0],fourmomenta[i][1:],weight=weight)
+            continue
+        product = Particle(productType,pos=position)
+        if i==0 and firstId is not None:
+            product.id = firstId
+        product.momentum = fourmomenta[i][1:]
+        product.weight = weight
+        products.append(product)
+    return products
 
 
-def decay(particle):
+def decay(particle,ledger=None,rng=None):
     """Calculate kinematics of two body decay and return resulting particles.
     If the decay should have three particles, any neutrinos are ignored and
-    the resulting one- or two-body decay is performed"""
+    the resulting one- or two-body decay is performed. If a ledger is given,
+    products of the types it tallies are added to it instead of returned"""
     # Determine products
-    if particle.type=="pi+":
-        products = [Particle("mu+",pos=particle.position),
-                    Particle("nuMu",pos=particle.position)]
-    elif particle.type=="pi-":
-        products = [Particle("mu-",pos=particle.position),
-                    Particle("nuMuBar",pos=particle.position)]
-    elif particle.type=="F-16":
-        products = [Particle("oxygen-15",pos=particle.position),
-                    Particle("proton",pos=particle.position)]
+    if particle.type in decayChannels:
+        productTypes = decayChannels[particle.type]
     # The following product lists ignore neutrinos
-    elif particle.type=="mu+":
-        return [Particle("e+",pos=particle.position,energy=particle.energy,
-                         theta=particle.theta,phi=particle.phi),
-                Particle("nuE",pos=particle.position),
-                Particle("nuMuBar",pos=particle.position)]
-    elif particle.type=="mu-":
-        return [Particle("e-",pos=particle.position,energy=particle.energy,
-                         theta=particle.theta,phi=particle.phi),
-                Particle("nuEBar",pos=particle.position),
-                Particle("nuMu",pos=particle.position)]
-    elif particle.type=="C-14" or particle.type=="O-14":
-        products = [Particle("nitrogen-14",pos=particle.position),
-                    Particle("e-",pos=particle.position)]
-    elif particle.type=="N-16":
-        products = [Particle("oxygen-16",pos=particle.position),
-                    Particle("e-",pos=particle.position)]
-    elif particle.type=="O-15":
-        products = [Particle("nitrogen-15",pos=particle.position),
-                    Particle("e+",pos=particle.position)]
-    elif particle.type=="Cl-40":
-        products = [Particle("argon-40",pos=particle.position),
-                    Particle("e-",pos=particle.position)]
-    elif particle.type=="K-40":
-        products = [Particle("calcium-40",pos=particle.position),
-                    Particle("e-",pos=particle.position)]
+    elif particle.type in muonDecayProducts:
+        productTypes = muonDecayProducts[particle.type]
+        electronMass = speciesMasses[speciesCodes[productTypes[0]]]
+        electronPmag = np.sqrt(particle.energy**2-electronMass**2)
+        fourmomenta = [[particle.energy]+[electronPmag*x for x in particle.dir],
+                       [0,0,0,0],
+                       [0,0,0,0]]
+        return buildProducts(productTypes,fourmomenta,particle.position,ledger,
+                             weight=particle.weight)
     else:
         print("Warning:",particle.type,"decay not known")
         return [particle]
 
     # Kinematics in rest frame
-    theta,phi = isotropicAngles()
+    theta,phi = isotropicAngles(rng=rng)
     # phi: decay angle, theta: rotation about interaction axis
-    m0 = particle.mass
-    m1 = products[0].mass
-    m2 = products[1].mass
-    pmag1 = np.sqrt((m0**2+m1**2-m2**2)**2 - 4*m0**2*m1**2) / (2*m0)
+    pmag1 = decayMomenta[particle.type]
     p1 = [pmag1*np.sin(theta)*np.cos(phi),
           pmag1*np.sin(theta)*np.sin(phi),
           pmag1*np.cos(theta)]
     p2 = [-p1[0],-p1[1],-p1[2]]
+    e1, e2 = decayEnergies[particle.type]
 
     # Boost momenta to lab frame
-    products[0].momentum = p1
-    products[1].momentum = p2
     beta = particle.beta
     direction = [-1*x for x in particle.dir]
-    fourmom1 = lorentzBoost([products[0].energy]+list(p1), beta,direction)
-    fourmom2 = lorentzBoost([products[1].energy]+list(p2), beta,direction)
-    products[0].momentum = fourmom1[1:]
-    products[1].momentum = fourmom2[1:]
+    fourmomenta = lorentzBoostArray([[e1]+p1,[e2]+p2], beta,direction)
 
-    return products
+    return buildProducts(productTypes,fourmomenta,particle.position,ledger,
+                         weight=particle.weight)
 
 
 
-def collision(particle,target):
+def collision(particle,target,ledger=None,rng=None):
     """Calculate kinematics of collision between particle and target.
-    Returns products of the collision"""
+    Returns products of the collision. If a ledger is given, products of the
+    types it tallies are added to it instead of returned"""
     # Determine product types
-    pionSeed = randomInRange(3)
+    pionSeed = randomInRange(3,rng=rng)
     if pionSeed<1:   #1/3 pi+
         pionType = "pi+"
         if target.type=="N":
-            productType = "carbon-14"
+            productType = "C-14"
         elif target.type=="O":
-            productType = "nitrogen-16"
+            productType = "N-16"
         else:
-            productType = "chlorine-40"
+            productType = "Cl-40"
     elif pionSeed<2: #1/3 pi-
         pionType = "pi-"
         if target.type=="N":
-            productType = "oxygen-14"
+            productType = "O-14"
         elif target.type=="O":
-            productType = "fluorine-16"
+            productType = "F-16"
         else:
-            productType = "potassium-40"
+            productType = "K-40"
     else:            #1/3 pi0
         pionType = "pi0"
         productType = target.type
 
-    products = [Particle(particle.type,id=particle.id,pos=particle.position),
-                Particle(productType,pos=particle.position),
-                Particle(pionType,pos=particle.position)]
+    productTypes = [particle.type,productType,pionType]
 
     # Determine kinematics by dividing non-mass energy randomly (in COM frame)
     # then determine the momentum vectors by forming a triangle with fixed side
@@ -125,10 +172,11 @@ def collision(particle,target):
     # Boost to the COM frame before getting energies
     beta = particle.Pmag/(particle.energy+target.mass)
     direction = particle.dir
-    fourmom1 = lorentzBoost([particle.energy]+list(particle.momentum), beta,direction)
-    fourmom2 = lorentzBoost([target.energy]+list(target.momentum), beta,direction)
+    fourmom1, fourmom2 = lorentzBoostArray([[particle.energy]+list(particle.momentum),
+                                            [target.energy]+list(target.momentum)],
+                                           beta,direction)
 
-    productMassTotal = sum([particle.mass for particle in products])
+    productMassTotal = sum([speciesMasses[speciesCodes[t]] for t in productTypes])
     totalKE = fourmom1[0] + fourmom2[0] - productMassTotal
     if totalKE<=0:
         # Not enough energy for collision to do anything
@@ -136,43 +184,28 @@ def collision(particle,target):
 
     # Determine multiplicity and add that number of sets of pi+,pi-,pi0 to the
     # products
-    mult = chooseMultiplicity(particle.energy,totalKE)
-    setKEs = randomWithSum(mult+1,totalKE)
-
-    # Get momenta for first set of products
-    momenta = randomMomentumTriangle(setKEs[0],[prod.mass for prod in products])
-
-    # Get momenta for all additional pions from multiplicity
-    for i in range(mult):
-        additionalPions = [Particle("pi+",pos=particle.position),
-                           Particle("pi-",pos=particle.position),
-                           Particle("pi0",pos=particle.position)]
-        additionalMomenta = randomMomentumTriangle(setKEs[i+1],
-                            [prod.mass for prod in additionalPions])
-        products.extend(additionalPions)
-        momenta.extend(additionalMomenta)
-
-    # Assign the momenta to the particles
-    for i,prod in enumerate(products):
-        prod.momentum = momenta[i]
+    mult = chooseMultiplicity(particle.energy,totalKE,rng=rng)
+    setKEs = randomWithSum(mult+1,totalKE,rng=rng)
+    productTypes.extend(["pi+","pi-","pi0"]*mult)
+
+    # Get momenta for first set of products and all additional pions at once
+    masses = speciesMasses[[speciesCodes[t] for t in productTypes]]
+    momenta = randomMomentumTriangles(setKEs,masses.reshape(-1,3),rng=rng).reshape(-1,3)
+    energies = np.sqrt(masses**2+np.sum(momenta**2,axis=1))
 
     # for i,x in enumerate("xyzE"):
-    #     tot = 0
-    #     for prod in products:
-    #         if x=="E":
-    #             tot += prod.energy
-    #         else:
-    #             tot += prod.momentum[i]
-    #     print("  "+x+"-component total:",tot)
+    #     if x=="E":
+    #         print("  "+x+"-component total:",np.sum(energies))
+    #     else:
+    #         print("  "+x+"-component total:",np.sum(momenta[:,i]))
 
     # Boost momenta to the lab frame
     beta = particle.Pmag/(particle.energy+target.mass)
     direction = [-1*x for x in particle.dir]
-    for i,prod in enumerate(products):
-        fourmomentum = lorentzBoost([prod.energy]+list(prod.momentum), beta,direction)
-        prod.momentum = fourmomentum[1:]
+    fourmomenta = lorentzBoostArray(np.column_stack((energies,momenta)), beta,direction)
 
-    return products
+    return buildProducts(productTypes,fourmomenta,particle.position,ledger,
+                         firstId=particle.id,weight=particle.weight)
 
 
 
@@ -0,0 +1,57 @@
+"""Code for tallying particles which are accounted for but not simulated"""
+import numpy as np
+from particle import speciesTypes, speciesCodes, propagationTypes
+
+
+class EnergyLedger:
+    """Ledger of the number, energy, and momentum of particles of each species
+    which are tallied rather than built as Particles (for each of a number of
+    showers). By default species which are never propagated in a shower are
+    tallied, with neutral pions only tallied if requested. Particles count
+    with their thinning weights, so the counts may not be whole numbers"""
+    def __init__(self,tallyTypes=None,neutralPions=False,showers=1):
+        if tallyTypes is None:
+            tallyTypes = [t for t in speciesTypes if t not in propagationTypes
+                          and (neutralPions or t!="pi0")]
+        self.tallyCodes = np.zeros(len(speciesTypes),dtype=bool)
+        self.tallyCodes[[speciesCodes[t] for t in tallyTypes]] = True
+        self.counts = np.zeros((showers,len(speciesTypes)))
+        self.energy = np.zeros((showers,len(speciesTypes))) #MeV
+        self.momentum = np.zeros((showers,len(speciesTypes),3)) #MeV
+
+    def tallies(self,code):
+        """Returns whether particles of the type code are tallied"""
+        return self.tallyCodes[code]
+
+    def add(self,code,energy,momentum,shower=0,weight=1):
+        """Adds one particle to the tally"""
+        self.counts[shower,code] += weight
+        self.energy[shower,code] += weight*energy
+        self.momentum[shower,code] += weight*np.asarray(momentum)
+
+    def addArrays(self,codes,energies,momenta,showers=None,weights=None):
+        """Adds arrays of particles to the tally"""
+        if showers is None:
+            showers = np.zeros(len(codes),dtype=int)
+        if weights is None:
+            weights = np.ones(len(codes))
+        np.add.at(self.counts,(showers,codes),weights)
+        np.add.at(self.energy,(showers,codes),weights*energies)
+        np.add.at(self.momentum,(showers,codes),weights[:,None]*momenta)
+
+    def merge(self,other):
+        """Adds the tallies of another ledger for the same showers to this one"""
+        self.counts += other.counts
+        self.energy += other.energy
+        self.momentum += other.momentum
+
+    def totalEnergy(self,shower=None):
+        """Returns total tallied energy (of one shower, or of all showers)"""
+        if shower is None:
+            return np.sum(self.energy)
+        return np.sum(self.energy[shower])
+
+    def summary(self,shower=0):
+        """Returns dictionary of count and energy of each tallied type in the shower"""
+        return {speciesTypes[code]: (self.counts[shower,code],self.energy[shower,code])
+                for code in np.flatnonzero(self.counts[shower])}
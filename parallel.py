@@ -0,0 +1,347 @@
+"""Functions for simulating many showers across a pool of processes"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from MCmethods import RandomSource, CounterSource
+from particle import propagationTypes
+from particleStack import ParticleStack
+from dataset import eventValues, eventValueFields
+from shower import generatePrimary, generateShower, stepParticle, transportMuon, replayBranch
+from vectorShower import generateEnsemble
+
+
+# Record of one particle returned from a worker through shared memory
+groundRecordType = np.dtype([("code",np.int16),
+                             ("id",np.int64),
+                             ("position",np.float64,(3,)),
+                             ("momentum",np.float64,(3,)),
+                             ("shower",np.int64),
+                             ("weight",np.float64)])
+
+
+def shareRecords(showerResults,first=0):
+    """Writes the particles from each shower (numbered from first) as records
+    into a new shared memory block and returns the block name and record
+    count. The block is left for the receiving process to unlink"""
+    count = sum([len(particles) for particles in showerResults])
+    block = shared_memory.SharedMemory(create=True,
+                                       size=max(1,count*groundRecordType.itemsize))
+    records = np.ndarray(count,dtype=groundRecordType,buffer=block.buf)
+    particles = [p for shower in showerResults for p in shower]
+    if count>0:
+        records["code"] = [p.code for p in particles]
+        records["id"] = [p.id for p in particles]
+        records["position"] = [p.position for p in particles]
+        records["momentum"] = [p.momentum for p in particles]
+        records["weight"] = [p.weight for p in particles]
+        records["shower"] = np.repeat(np.arange(first,first+len(showerResults)),
+                                      [len(shower) for shower in showerResults])
+    del records
+    # Ownership passes to the receiving process, so stop this process's
+    # resource tracker from removing the block when the worker exits
+    resource_tracker.unregister(block._name,"shared_memory")
+    block.close()
+    return block.name, count
+
+
+def unlinkBlock(name):
+    """Removes the shared memory block with the given name, if it still
+    exists, without reading it (e.g. when its results won't be used)"""
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+class SharedGroundRecords:
+    """Ground-particle records written by worker processes to shared memory
+    blocks, held as NumPy views of the blocks without copying. The blocks are
+    released by close (or on leaving a with statement), after which any views
+    taken from the records must no longer be used"""
+    def __init__(self,blocks=()):
+        self.blocks = []
+        self.records = []
+        for name,count in blocks:
+            self.attach(name,count)
+
+    def attach(self,name,count):
+        """Adds the records of the shared memory block with the given name"""
+        block = shared_memory.SharedMemory(name=name)
+        self.blocks.append(block)
+        self.records.append(np.ndarray(count,dtype=groundRecordType,buffer=block.buf))
+
+    def __len__(self):
+        return sum([len(records) for records in self.records])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def stacks(self):
+        """Returns a ParticleStack viewing the records of each block"""
+        return [ParticleStack(codes=records["code"],positions=records["position"],
+                              momenta=records["momentum"],ids=records["id"],
+                              showers=records["shower"],weights=records["weight"])
+                for records in self.records]
+
+    def showerResults(self,num,first=0):
+        """Returns lists of Particle objects for showers first to first+num"""
+        showerResults = [[] for _ in range(num)]
+        for stack in self.stacks():
+            for particle,shower in zip(stack.toParticles(),stack.showers):
+                showerResults[shower-first].append(particle)
+        return showerResults
+
+    def close(self):
+        """Releases and removes the shared memory blocks"""
+        self.records = []
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def eventSource(seed,index):
+    """Returns the RandomSource for the event (or ensemble) with the given
+    index, seeded independently of all others from the master seed"""
+    return RandomSource(seed=np.random.SeedSequence(seed,spawn_key=(index,)))
+
+
+def simulateEvents(first,count,seed,primaryArgs,ensembleSize=None,shared=False,
+                   thinning=None,cuts=None,muonTransport=None):
+    """Simulates count showers from event index first, each event (or
+    ensemble) drawing from its own seeded source, and returns the muons from
+    each (as a shared memory block if shared, see shareRecords) and an array
+    of their event values (see dataset.eventValues)"""
+    showerResults = []
+    values = []
+    if ensembleSize is None:
+        for i in range(first,first+count):
+            rng = eventSource(seed,i)
+            primary = generatePrimary(rng=rng,**primaryArgs)
+            info = {}
+            showerResults.append(generateShower(primary.copy(),rng=rng,info=info,
+                                                thinning=thinning,cuts=cuts,
+                                                muonTransport=muonTransport))
+            values.append(eventValues(primary,info))
+    else:
+        for i in range(first,first+count,ensembleSize):
+            rng = eventSource(seed,i//ensembleSize)
+            primaries = [generatePrimary(rng=rng,**primaryArgs)
+                         for _ in range(min(ensembleSize,first+count-i))]
+            infos = [{} for _ in primaries]
+            showerResults.extend(generateEnsemble(primaries,rng=rng,infos=infos,
+                                                  thinning=thinning,cuts=cuts,
+                                                  muonTransport=muonTransport))
+            values.extend([eventValues(primary,info)
+                           for primary,info in zip(primaries,infos)])
+    values = np.array(values,dtype=float).reshape(count,-1)
+    if shared:
+        return shareRecords(showerResults,first), values
+    return showerResults, values
+
+
+def runShowers(num,seed,primaryArgs,ensembleSize=None,workers=None,chunkSize=None,
+               progress=None,shared=False,first=0,callback=None,thinning=None,cuts=None,
+               muonTransport=None):
+    """Simulates num showers (numbered from first) with primaries from
+    generatePrimary(**primaryArgs) across workers processes in chunks of
+    chunkSize events, and returns the muons from each in event order (as a
+    SharedGroundRecords the caller must close if shared) and an array of
+    their event values, the same for any number of workers. Progress is
+    called with the number of completed showers, and callback, if given,
+    with each chunk's results and values in order instead of returning them"""
+    if ensembleSize is not None and first%ensembleSize!=0:
+        # Ensembles are seeded by their index, so a run starting part way
+        # through one would repeat the primaries of its earlier events
+        raise ValueError("Ensemble runs must start at a multiple of ensembleSize")
+    if workers is None:
+        workers = 1
+    if workers<1:
+        workers = os.cpu_count()
+    if chunkSize is None:
+        if workers==1:
+            # Chunks only set how often progress and callback are called
+            chunkSize = max(1,min(100,num//10))
+        else:
+            # Several chunks per worker keeps all workers busy until the end
+            chunkSize = max(1,num//(8*workers))
+    if ensembleSize is not None:
+        # Chunks must hold whole ensembles so that each has the same source
+        chunkSize = ensembleSize*max(1,round(chunkSize/ensembleSize))
+    starts = list(range(first,first+num,chunkSize))
+
+    # With one worker nothing needs sharing, so only the returned records
+    # are put in shared memory, and a callback is given lists of Particles
+    sharedChunks = shared and workers>1
+    chunks = []
+    def deliver(start,results,values):
+        if callback is None:
+            chunks.append((results,values))
+        elif sharedChunks:
+            with SharedGroundRecords([results]) as records:
+                callback(records,values)
+        else:
+            callback(results,values)
+
+    completed = 0
+    if workers==1:
+        for start in starts:
+            results, values = simulateEvents(start,min(chunkSize,first+num-start),seed,
+                                             primaryArgs,ensembleSize,thinning=thinning,
+                                             cuts=cuts,muonTransport=muonTransport)
+            deliver(start,results,values)
+            completed += len(values)
+            if progress is not None:
+                progress(completed)
+    else:
+        pending = {}
+        received = set()
+        nextChunk = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(simulateEvents,start,min(chunkSize,first+num-start),
+                                   seed,primaryArgs,ensembleSize,shared,thinning,cuts,
+                                   muonTransport): start
+                       for start in starts}
+            try:
+                for future in as_completed(futures):
+                    pending[futures[future]] = future.result()
+                    received.add(futures[future])
+                    completed += len(pending[futures[future]][1])
+                    if progress is not None:
+                        progress(completed)
+                    # Pass on chunks in order once all earlier chunks are done
+                    while nextChunk<len(starts) and starts[nextChunk] in pending:
+                        deliver(starts[nextChunk],*pending.pop(starts[nextChunk]))
+                        nextChunk += 1
+            finally:
+                if nextChunk<len(starts) and shared:
+                    # A chunk (or the callback) failed, so remove the blocks
+                    # of the chunks which won't be passed on
+                    pool.shutdown(cancel_futures=True)
+                    unread = [results for results,values in pending.values()]
+                    if callback is None:
+                        unread += [results for results,values in chunks]
+                    unread += [future.result()[0] for future,start in futures.items()
+                               if start not in received and not(future.cancelled())
+                               and future.exception() is None]
+                    for name,count in unread:
+                        unlinkBlock(name)
+
+    if callback is not None:
+        return
+    values = np.concatenate([chunk[1] for chunk in chunks]) if len(chunks)>0 \
+             else np.zeros((0,len(eventValueFields)))
+    if sharedChunks:
+        return SharedGroundRecords([chunk[0] for chunk in chunks]), values
+    showerResults = []
+    for chunk in chunks:
+        showerResults.extend(chunk[0])
+    if shared:
+        return SharedGroundRecords([shareRecords(showerResults,first)]), values
+    return showerResults, values
+
+
+def splitShower(primary,splitEnergy,rng,floor=0,ceiling=None,maxIterations=1000,
+                thinning=None,cuts=None,muonTransport=None):
+    """Runs the top of a shower serially, stepping only particles with at
+    least splitEnergy total energy. Returns the particles below the threshold
+    as (generation, particle) roots of independent sub-showers, along with the
+    particles which have already left the atmosphere"""
+    if ceiling is None:
+        ceiling = 2*primary.position[2]
+    threshold = None if thinning is None else thinning.threshold(primary.energy)
+    primary.id = 0
+    particles = [primary]
+    roots = []
+    finished = []
+    loopCount = 0
+    while len(particles)>0 and loopCount<maxIterations:
+        loopCount += 1
+        products = []
+        for particle in particles:
+            if not(particle.type in propagationTypes):
+                continue
+            if not(particle.position[2]>floor and particle.position[2]<ceiling):
+                finished.append(particle)
+            elif cuts is not None and cuts.dropsParticle(particle):
+                continue
+            elif particle.energy<splitEnergy:
+                roots.append((loopCount,particle))
+            elif muonTransport is not None and particle.type in ["mu+","mu-"]:
+                products.extend(transportMuon(particle,floor,ceiling,loopCount,rng=rng,
+                                              survival=muonTransport=="survival"))
+            else:
+                products.extend(stepParticle(particle,floor,ceiling,loopCount,rng=rng,
+                                             thinning=thinning,threshold=threshold))
+        particles = products
+    finished.extend(particles)
+    return roots, finished
+
+
+def simulateBranches(roots,rng,ceiling,floor=0,maxIterations=1000,thinning=None,
+                     cuts=None,muonTransport=None):
+    """Returns the muons from a batch of sub-showers, given as (generation,
+    particle) roots (run in a worker process), as one shared memory block"""
+    muons = []
+    for generation,particle in roots:
+        muons.extend(replayBranch(particle,generation,rng,ceiling,floor,maxIterations,
+                                  thinning=thinning,cuts=cuts,
+                                  muonTransport=muonTransport))
+    return shareRecords([muons],rng.shower)
+
+
+def generateShowerParallel(primary,splitEnergy=1e5,workers=None,seed=0,shower=0,
+                           floor=0,maxIterations=1000,thinning=None,cuts=None,
+                           muonTransport=None):
+    """Generates one shower across a process pool and returns the muons that
+    reach the surface. The cascade is run serially until every particle has
+    less than splitEnergy (MeV) of energy, then the remaining sub-showers are
+    dealt out largest first into batches (several per worker), which are
+    handed to workers as they become free. Random numbers
+    come from CounterSource(seed,shower), so the muons are identical to those
+    of generateShower with that source for any number of workers (with the
+    same Thinning settings, CutPolicy and muonTransport mode if given)"""
+    rng = CounterSource(seed,shower)
+    ceiling = 2*primary.position[2]
+    if thinning is not None:
+        thinning = thinning.forPrimary(primary.energy)
+    roots, finished = splitShower(primary,splitEnergy,rng,floor,ceiling,maxIterations,
+                                  thinning,cuts,muonTransport)
+
+    particles = finished
+    if len(roots)>0:
+        roots.sort(key=lambda root: root[1].energy,reverse=True)
+        if workers is None or workers<1:
+            workers = os.cpu_count()
+        # Batching the sub-showers keeps the number of shared memory blocks
+        # (each open in the parent while it is read) down
+        batchCount = min(len(roots),8*workers)
+        batches = [roots[i::batchCount] for i in range(batchCount)]
+        batchMuons = [None]*batchCount
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(simulateBranches,batch,rng,ceiling,floor,maxIterations,
+                                   thinning,cuts,muonTransport): i
+                       for i,batch in enumerate(batches)}
+            try:
+                # Copy out and remove each block as soon as it is done
+                for future in as_completed(futures):
+                    with SharedGroundRecords([future.result()]) as records:
+                        batchMuons[futures[future]] = records.showerResults(1,shower)[0]
+            finally:
+                # If a batch failed, remove the blocks of those left unread
+                pool.shutdown(cancel_futures=True)
+                for future,i in futures.items():
+                    if batchMuons[i] is None and not(future.cancelled()) and \
+                       future.exception() is None:
+                        unlinkBlock(future.result()[0])
+        for muons in batchMuons:
+            particles.extend(muons)
+
+    return [particle for particle in particles
+            if (particle.type=="mu+" or particle.type=="mu-") and particle.position[2]<0]
@@ -1,22 +1,141 @@
 """Code for particle class"""
 from itertools import count
-from numpy import sqrt,sin,cos,arccos,arctan
+from math import sqrt
+from numpy import sin,cos,arccos,arctan,array,inf
 from constants import c, pi
 idCounter = count()
 
 class ParticleError(Exception):
     pass
 
+
+# Table of particle species, where the index of each entry is its integer type
+# code. Each entry contains the type name, mass (MeV), charge (e), lifetime
+# (s, None if stable), and any other names the type is known by
+speciesTable = [("nuE", 0, 0, None, []),
+                ("nuEBar", 0, 0, None, []),
+                ("nuMu", 0, 0, None, []),
+                ("nuMuBar", 0, 0, None, []),
+                ("nuTau", 0, 0, None, []),
+                ("nuTauBar", 0, 0, None, []),
+                ("pi+", 139.57018, 1, 2.6033e-8, []),
+                ("pi-", 139.57018, -1, 2.6033e-8, []),
+                ("pi0", 134.9766, 0, 8.4e-17, []),
+                ("mu+", 105.658369, 1, 2.1969811e-6, []),
+                ("mu-", 105.658369, -1, 2.1969811e-6, []),
+                ("e+", 0.5109989, 1, None, ["positron"]),
+                ("e-", 0.5109989, -1, None, ["electron","e"]),
+                ("p+", 938.27203, 1, None, ["proton","p"]),
+                ("n0", 939.56536, 0, 881.5, ["neutron","n"]),
+                ("C-14", 13043.94, 6, None, ["carbon-14"]),
+                ("C", 11177.93, 6, None, ["carbon"]),
+                ("N-16", 14909.59, 7, 10.29, ["nitrogen-16"]),
+                ("N", 13047.2, 7, None, ["nitrogen","nitrogen-14","nitrogen-15"]),
+                ("O-14", 13048.92, 8, 101.85, ["oxygen-14"]),
+                ("O-15", 13975.27, 8, 176.4, ["oxygen-15"]),
+                ("O", 14903.3, 8, None, ["oxygen","oxygen-16"]),
+                ("F-16", 14914.59, 9, 1.674e-19, ["fluorine-16"]),
+                ("F", 17696.9, 9, None, ["fluorine"]),
+                ("Cl-40", 37232.2, 17, 117, ["chlorine-40"]),
+                ("Cl-35", 32573.28, 17, None, ["Cl","chlorine","chlorine-35"]),
+                ("Ar", 37211, 18, None, ["argon","argon-40"]),
+                ("K-40", 37226.23, 19, None, ["potassium-40"]),
+                ("K-39", 36294.46, 19, None, ["K","potassium","potassium-39"]),
+                ("Ca", 37224.92, 20, None, ["calcium","calcium-40"])]
+
+# Arrays of species properties indexed by type code (stable lifetimes are inf)
+speciesTypes = [entry[0] for entry in speciesTable]
+speciesMasses = array([entry[1] for entry in speciesTable]) #MeV
+speciesCharges = array([entry[2] for entry in speciesTable]) #e
+speciesLifetimes = array([inf if entry[3] is None else entry[3]
+                          for entry in speciesTable]) #s
+speciesCodes = {particleType: code for code,particleType in enumerate(speciesTypes)}
+
+# Species which are propagated through the atmosphere in a shower
+propagationTypes = ["pi+","pi-","mu+","mu-","p+","n0","F-16"]
+
+# Type code of every known name, extended as new names are resolved
+typeAliases = dict(speciesCodes)
+for code,entry in enumerate(speciesTable):
+    for alias in entry[4]:
+        typeAliases[alias] = code
+
+
+def resolveType(particleType):
+    """Returns the integer type code of a particle type name"""
+    try:
+        return typeAliases[particleType]
+    except KeyError:
+        code = speciesCodes[parseTypeName(particleType)]
+        typeAliases[particleType] = code
+        return code
+
+
+def parseTypeName(particleType):
+    """Returns the species type name described by an unfamiliar name"""
+    if "neutrino" in particleType or "nu" in particleType:
+        if "E" in particleType or "el" in particleType:
+            name = "nuE"
+        elif "Mu" in particleType or "mu" in particleType:
+            name = "nuMu"
+        elif "Tau" in particleType or "tau" in particleType:
+            name = "nuTau"
+        else:
+            raise ParticleError("Unrecognized particle type "+particleType)
+        if "bar" in particleType.lower() or "anti" in particleType:
+            name += "Bar"
+        return name
+    elif "pi" in particleType:
+        if "+" in particleType or "positive" in particleType:
+            return "pi+"
+        elif "-" in particleType or "negative" in particleType:
+            return "pi-"
+        elif "0" in particleType or "neutral" in particleType:
+            return "pi0"
+    elif "mu" in particleType:
+        if "+" in particleType or "positive" in particleType:
+            return "mu+"
+        elif "-" in particleType or "negative" in particleType:
+            return "mu-"
+    elif "carbon" in particleType.lower():
+        return "C-14" if "14" in particleType else "C"
+    elif "nitrogen" in particleType.lower():
+        return "N-16" if "16" in particleType else "N"
+    elif "oxygen" in particleType.lower():
+        if "14" in particleType:
+            return "O-14"
+        elif "15" in particleType:
+            return "O-15"
+        return "O"
+    elif "fluorine" in particleType.lower():
+        return "F-16" if "16" in particleType else "F"
+    elif "chlorine" in particleType.lower():
+        return "Cl-40" if "40" in particleType else "Cl-35"
+    elif "argon" in particleType.lower():
+        return "Ar"
+    elif "potassium" in particleType.lower():
+        return "K-40" if "40" in particleType else "K-39"
+    elif "calcium" in particleType.lower():
+        return "Ca"
+    raise ParticleError("Unrecognized particle type "+str(particleType))
+
+
 class Particle:
     """Particle class detailing particle's type, position, motion, etc."""
+    __slots__ = ("type","code","mass","charge","lifetime","id","position","weight",
+                 "_momentum","_Pmag","_energy","_direction")
+
     def __init__(self,particleType,**kwargs):
         self.identifyType(particleType)
         self.id = next(idCounter)
         self.position = [0.,0.,0.] #m
         self.momentum = [0.,0.,0.] #MeV
+        self.weight = 1.
         for key,val in kwargs.items():
             if key=="id":
                 self.id = val
+            elif key=="weight":
+                self.weight = float(val)
             elif "pos" in key and len(val)==3:
                 self.position = [float(x) for x in val]
             elif "mom" in key:
@@ -40,160 +159,8 @@ class Particle:
 
     def identifyType(self,particleType):
         """Sets particle attributes based on type name"""
-        if "neutrino" in particleType or "nu" in particleType:
-            if "E" in particleType or "el" in particleType:
-                self.type = "nuE"
-                self.mass = 0 #MeV
-                self.charge = 0 #e
-                self.lifetime = None
-            elif "Mu" in particleType or "mu" in particleType:
-                self.type = "nuMu"
-                self.mass = 0 #MeV
-                self.charge = 0 #e
-                self.lifetime = None
-            elif "Tau" in particleType or "tau" in particleType:
-                self.type = "nuTau"
-                self.mass = 0 #MeV
-                self.charge = 0 #e
-                self.lifetime = None
-            else:
-                raise ParticleError("Unrecognized particle type "+particleType)
-            if "bar" in particleType.lower() or "anti" in particleType:
-                self.type += "Bar"
-        elif "pi" in particleType:
-            if "+" in particleType or "positive" in particleType:
-                self.type = "pi+"
-                self.mass = 139.57018 #MeV
-                self.charge = 1 #e
-                self.lifetime = 2.6033e-8 #s
-            elif "-" in particleType or "negative" in particleType:
-                self.type = "pi-"
-                self.mass = 139.57018 #MeV
-                self.charge = -1 #e
-                self.lifetime = 2.6033e-8 #s
-            elif "0" in particleType or "neutral" in particleType:
-                self.type = "pi0"
-                self.mass = 134.9766 #MeV
-                self.charge = 0 #e
-                self.lifetime = 8.4e-17 #s
-            else:
-                raise ParticleError("Unrecognized particle type "+particleType)
-        elif "mu" in particleType:
-            if "+" in particleType or "positive" in particleType:
-                self.type = "mu+"
-                self.mass = 105.658369 #MeV
-                self.charge = 1 #e
-                self.lifetime = 2.1969811e-6 #s
-            elif "-" in particleType or "negative" in particleType:
-                self.type = "mu-"
-                self.mass = 105.658369 #MeV
-                self.charge = -1 #e
-                self.lifetime = 2.1969811e-6 #s
-            else:
-                raise ParticleError("Unrecognized particle type "+particleType)
-        elif particleType=="positron" or particleType=="e+":
-            self.type = "e+"
-            self.mass = 0.5109989 #MeV
-            self.charge = 1 #e
-            self.lifetime = None
-        elif particleType=="electron" or particleType=="e-" or particleType=="e":
-            self.type = "e-"
-            self.mass = 0.5109989 #MeV
-            self.charge = -1 #e
-            self.lifetime = None
-        elif particleType=="proton" or particleType=="p+" or particleType=="p":
-            self.type = "p+"
-            self.mass = 938.27203 #MeV
-            self.charge = 1 #e
-            self.lifetime = None
-        elif particleType=="neutron" or particleType=="n0" or particleType=="n":
-            self.type = "n0"
-            self.mass = 939.56536 #MeV
-            self.charge = 0
-            self.lifetime = 881.5 #s
-        elif "carbon" in particleType.lower() or particleType=="C":
-            if "14" in particleType:
-                self.type = "C-14"
-                self.mass = 13043.94 #MeV
-                self.charge = 6
-                self.lifetime = None
-            else:
-                self.type = "C"
-                self.mass = 11177.93 #MeV
-                self.charge = 6
-                self.lifetime = None
-        elif "nitrogen" in particleType.lower() or particleType=="N":
-            if "16" in particleType:
-                self.type = "N-16"
-                self.mass = 14909.59 #MeV
-                self.charge = 7
-                self.lifetime = 10.29 #s
-            else:
-                self.type = "N"
-                self.mass = 13047.2 #MeV
-                self.charge = 7
-                self.lifetime = None
-        elif "oxygen" in particleType.lower() or particleType=="O":
-            if "14" in particleType:
-                self.type = "O-14"
-                self.mass = 13048.92 #MeV
-                self.charge = 8
-                self.lifetime = 101.85 #s
-            elif "15" in particleType:
-                self.type = "O-15"
-                self.mass = 13975.27 #MeV
-                self.charge = 8
-                self.lifetime = 176.4 #s
-            else:
-                self.type = "O"
-                self.mass = 14903.3 #MeV
-                self.charge = 8
-                self.lifetime = None
-        elif "fluorine" in particleType.lower() or particleType=="F":
-            if "16" in particleType:
-                self.type = "F-16"
-                self.mass = 14914.59 #MeV
-                self.charge = 9
-                self.lifetime = 1.674e-19 #s
-            else:
-                self.type = "F"
-                self.mass = 17696.9 #MeV
-                self.charge = 9
-                self.lifetime = None
-        elif "chlorine" in particleType.lower() or particleType=="Cl":
-            if "40" in particleType:
-                self.type = "Cl-40"
-                self.mass = 37232.2 #MeV
-                self.charge = 17
-                self.lifetime = 117 #s
-            else:
-                self.type = "Cl-35"
-                self.mass = 32573.28 #MeV
-                self.charge = 17
-                self.lifetime = None
-        elif "argon" in particleType.lower() or particleType=="Ar":
-            self.type = "Ar"
-            self.mass = 37211 #MeV
-            self.charge = 18
-            self.lifetime = None
-        elif "potassium" in particleType.lower() or particleType=="K":
-            if "40" in particleType:
-                self.type = "K-40"
-                self.mass = 37226.23 #MeV
-                self.charge = 19
-                self.lifetime = None
-            else:
-                self.type = "K-39"
-                self.mass = 36294.46 #MeV
-                self.charge = 19
-                self.lifetime = None
-        elif "calcium" in particleType.lower() or particleType=="Ca":
-            self.type = "Ca"
-            self.mass = 37224.92 #MeV
-            self.charge = 20
-            self.lifetime = None
-        else:
-            raise ParticleError("Unrecognized particle type "+str(particleType))
+        self.code = resolveType(particleType)
+        self.type, self.mass, self.charge, self.lifetime = speciesTable[self.code][:4]
 
 
     def buildMomentumFromScalar(self,scalar,kind,otherArgs):
@@ -219,44 +186,107 @@ class Particle:
             if not("energy" in kind):
                 kind = "magnitude of "+kind
             raise ParticleError("Must define angle if "+kind+" is given")
-        self.momentum[0] = momentum*sin(theta)*cos(phi)
-        self.momentum[1] = momentum*sin(theta)*sin(phi)
-        self.momentum[2] = momentum*cos(theta)
-
-
-    def __getattr__(self,name):
-        if name=="Pmag":
-            return sqrt(self.momentum[0]**2+self.momentum[1]**2+self.momentum[2]**2)
-        if name=="direction" or name=="dir":
-            if self.Pmag==0:
-                return [0,0,0]
-            return [p/self.Pmag for p in self.momentum]
-        if name=="theta":
-            if self.Pmag==0:
-                return 0
-            return arccos(self.momentum[2]/self.Pmag)
-        if name=="phi":
-            if self.momentum[0]==0:
-                return 0
-            return arctan(self.momentum[1]/self.momentum[0])
-        if name=="zenith":
-            return pi-self.theta
-        if name=="azimuth":
-            az = pi+self.phi
-            while az>2*pi:
-                az -= 2*pi
-            return az
-        if name=="energy":
-            return sqrt(self.mass**2+self.Pmag**2)
-        if name=="kinetic" or name=="ke":
-            return self.energy-self.mass
-        if name=="beta":
-            return self.Pmag/self.energy
-
-    # Since __getattr__ is defined, must define these functions to be pickle-able
+        self.momentum = [momentum*sin(theta)*cos(phi),
+                         momentum*sin(theta)*sin(phi),
+                         momentum*cos(theta)]
+
+
+    @property
+    def momentum(self):
+        return self._momentum
+
+    @momentum.setter
+    def momentum(self,value):
+        # Stored as a tuple so the cached kinematics can't go stale by
+        # modifying the momentum in place
+        self._momentum = tuple([float(p) for p in value]) #MeV
+        self._Pmag = None
+        self._energy = None
+        self._direction = None
+
+    @property
+    def Pmag(self):
+        if self._Pmag is None:
+            px, py, pz = self._momentum
+            self._Pmag = sqrt(px**2+py**2+pz**2)
+        return self._Pmag
+
+    @property
+    def direction(self):
+        if self._direction is None:
+            pmag = self.Pmag
+            if pmag==0:
+                self._direction = (0,0,0)
+            else:
+                self._direction = tuple([p/pmag for p in self._momentum])
+        return self._direction
+
+    @property
+    def dir(self):
+        return self.direction
+
+    @property
+    def theta(self):
+        if self.Pmag==0:
+            return 0
+        return arccos(self._momentum[2]/self.Pmag)
+
+    @property
+    def phi(self):
+        if self._momentum[0]==0:
+            return 0
+        return arctan(self._momentum[1]/self._momentum[0])
+
+    @property
+    def zenith(self):
+        return pi-self.theta
+
+    @property
+    def azimuth(self):
+        az = pi+self.phi
+        while az>2*pi:
+            az -= 2*pi
+        return az
+
+    @property
+    def energy(self):
+        if self._energy is None:
+            self._energy = sqrt(self.mass**2+self.Pmag**2)
+        return self._energy
+
+    @property
+    def kinetic(self):
+        return self.energy-self.mass
+
+    @property
+    def ke(self):
+        return self.energy-self.mass
+
+    @property
+    def beta(self):
+        return self.Pmag/self.energy
+
+    def copy(self):
+        """Returns an independent copy of the particle"""
+        other = Particle.__new__(Particle)
+        other.__setstate__(self.__getstate__())
+        other.position = list(self.position)
+        return other
+
+    # Since __slots__ is defined, must define these functions to be pickle-able
+    # (the state matches the __dict__ of earlier versions of the class)
     def __getstate__(self):
-        return self.__dict__
+        return {"type": self.type, "code": self.code, "mass": self.mass,
+                "charge": self.charge, "lifetime": self.lifetime, "id": self.id,
+                "position": self.position, "momentum": list(self._momentum),
+                "weight": self.weight}
 
     def __setstate__(self, d):
-        self.__dict__.update(d)
-
+        for key,val in d.items():
+            setattr(self,key,val)
+        # Particles pickled before type codes existed
+        if "code" not in d:
+            self.code = resolveType(self.type)
+        # Particles pickled before thinning weights existed
+        if "weight" not in d:
+            self.weight = 1.
@@ -0,0 +1,131 @@
+"""Code for structure-of-arrays particle stack"""
+import numpy as np
+from particle import Particle, speciesTypes, speciesMasses, speciesLifetimes, speciesCodes
+
+
+class ParticleStack:
+    """Particle stack holding particle types, positions, momenta, ids, shower
+    indices, and thinning weights as NumPy arrays with one row per particle"""
+    def __init__(self,codes=(),positions=None,momenta=None,ids=None,showers=None,
+                 weights=None):
+        self.codes = np.asarray(codes,dtype=np.int16)
+        size = len(self.codes)
+        if positions is None:
+            positions = np.zeros((size,3))
+        if momenta is None:
+            momenta = np.zeros((size,3))
+        if ids is None:
+            ids = np.full(size,-1)
+        if showers is None:
+            showers = np.zeros(size)
+        if weights is None:
+            weights = np.ones(size)
+        self.positions = np.asarray(positions,dtype=float).reshape(size,3) #m
+        self.momenta = np.asarray(momenta,dtype=float).reshape(size,3) #MeV
+        self.ids = np.asarray(ids,dtype=np.int64)
+        self.showers = np.asarray(showers,dtype=np.int64)
+        self.weights = np.asarray(weights,dtype=float)
+
+    @classmethod
+    def fromParticles(cls,particles,showers=None):
+        """Returns a stack built from a list of Particle objects, optionally
+        tagged with the index of the shower each belongs to"""
+        return cls(codes=[p.code for p in particles],
+                   positions=[p.position for p in particles],
+                   momenta=[list(p.momentum) for p in particles],
+                   ids=[p.id for p in particles],
+                   showers=showers,
+                   weights=[p.weight for p in particles])
+
+    @classmethod
+    def concatenate(cls,stacks):
+        """Returns a single stack containing the rows of all given stacks"""
+        stacks = list(stacks)
+        if len(stacks)==0:
+            return cls()
+        return cls(codes=np.concatenate([s.codes for s in stacks]),
+                   positions=np.concatenate([s.positions for s in stacks]),
+                   momenta=np.concatenate([s.momenta for s in stacks]),
+                   ids=np.concatenate([s.ids for s in stacks]),
+                   showers=np.concatenate([s.showers for s in stacks]),
+                   weights=np.concatenate([s.weights for s in stacks]))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def select(self,rows):
+        """Returns a new stack of the rows given by a boolean mask or indices"""
+        return ParticleStack(codes=self.codes[rows],
+                             positions=self.positions[rows],
+                             momenta=self.momenta[rows],
+                             ids=self.ids[rows],
+                             showers=self.showers[rows],
+                             weights=self.weights[rows])
+
+    def splitShowers(self,count):
+        """Returns list of stacks, one for each of count shower indices"""
+        order = np.argsort(self.showers,kind="stable")
+        bounds = np.searchsorted(self.showers[order],np.arange(count+1))
+        return [self.select(order[bounds[i]:bounds[i+1]]) for i in range(count)]
+
+    def isType(self,*particleTypes):
+        """Returns boolean mask of rows matching any of the particle types"""
+        return np.isin(self.codes,[speciesCodes[t] for t in particleTypes])
+
+    def toParticles(self,rows=None):
+        """Returns list of Particle objects for the given rows (default all)"""
+        if rows is None:
+            rows = np.arange(len(self))
+        elif np.asarray(rows).dtype==bool:
+            rows = np.flatnonzero(rows)
+        particles = []
+        for i in rows:
+            particles.append(Particle(speciesTypes[self.codes[i]],id=int(self.ids[i]),
+                                      pos=self.positions[i].tolist(),
+                                      momentum=self.momenta[i].tolist(),
+                                      weight=self.weights[i]))
+        return particles
+
+    @property
+    def types(self):
+        return [speciesTypes[code] for code in self.codes]
+
+    @property
+    def masses(self):
+        return speciesMasses[self.codes]
+
+    @property
+    def lifetimes(self):
+        return speciesLifetimes[self.codes]
+
+    @property
+    def Pmag(self):
+        return np.sqrt(np.sum(self.momenta**2,axis=1))
+
+    @property
+    def energy(self):
+        return np.sqrt(self.masses**2+np.sum(self.momenta**2,axis=1))
+
+    @property
+    def ke(self):
+        return self.energy-self.masses
+
+    @property
+    def direction(self):
+        pmag = self.Pmag
+        safe = np.where(pmag>0,pmag,1)
+        return self.momenta/safe[:,None]
+
+    @property
+    def beta(self):
+        return self.Pmag/self.energy
+
+    @property
+    def theta(self):
+        pmag = self.Pmag
+        safe = np.where(pmag>0,pmag,1)
+        return np.where(pmag>0,np.arccos(self.momenta[:,2]/safe),0)
+
+    @property
+    def zenith(self):
+        return np.pi-self.theta
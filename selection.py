@@ -0,0 +1,174 @@
+"""Code for cuts and derived quantities evaluated on whole columns of
+particles at once"""
+import numpy as np
+from particle import resolveType, speciesMasses
+
+deg = np.pi/180
+
+# Functions computing each named column from the Columns of a ParticleStack
+columnFunctions = {"code": lambda c: c.stack.codes,
+                   "id": lambda c: c.stack.ids,
+                   "shower": lambda c: c.stack.showers,
+                   "weight": lambda c: c.stack.weights,
+                   "x": lambda c: c.stack.positions[:,0],
+                   "y": lambda c: c.stack.positions[:,1],
+                   "z": lambda c: c.stack.positions[:,2],
+                   "px": lambda c: c.stack.momenta[:,0],
+                   "py": lambda c: c.stack.momenta[:,1],
+                   "pz": lambda c: c.stack.momenta[:,2],
+                   "mass": lambda c: speciesMasses[c["code"]],
+                   "momentum": lambda c: np.sqrt(c["px"]**2+c["py"]**2+c["pz"]**2),
+                   "energy": lambda c: np.sqrt(c["mass"]**2+(c["px"]**2+c["py"]**2+c["pz"]**2)),
+                   "ke": lambda c: c["energy"]-c["mass"],
+                   "theta": lambda c: np.arccos(np.clip(c["pz"]/np.where(c["momentum"]>0,
+                                                                          c["momentum"],1),
+                                                        -1,1))*(c["momentum"]>0),
+                   "zenith": lambda c: np.pi-c["theta"],
+                   "phi": lambda c: np.arctan2(c["py"],c["px"]),
+                   "radius": lambda c: np.sqrt(c["x"]**2+c["y"]**2)}
+
+
+class Columns:
+    """Columns of a ParticleStack (see columnFunctions), each computed at most
+    once however many expressions use it"""
+    def __init__(self,stack):
+        self.stack = stack
+        self.values = {}
+
+    def __len__(self):
+        return len(self.stack)
+
+    def __getitem__(self,name):
+        if name not in self.values:
+            if name not in columnFunctions:
+                raise KeyError("Unknown column "+name)
+            self.values[name] = columnFunctions[name](self)
+        return self.values[name]
+
+
+class Expression:
+    """Expression over the columns of particles, built from Column, numbers
+    and operators, e.g. (Column("ke")>50) & (Column("zenith")<6*deg).
+    Evaluating it on a ParticleStack (or its Columns) gives an array with a
+    value for each particle, comparisons giving boolean masks which combine
+    with &, | and ~"""
+    def __init__(self,function,text):
+        self.function = function
+        self.text = text
+
+    def evaluate(self,data):
+        """Returns the array of the expression for a ParticleStack or Columns"""
+        if not(isinstance(data,Columns)):
+            data = Columns(data)
+        return self.function(data)
+
+    def select(self,stack):
+        """Returns the rows of a ParticleStack for which the expression holds"""
+        return stack.select(self.evaluate(stack))
+
+    def __repr__(self):
+        return self.text
+
+    def combine(self,other,operation,symbol,reverse=False):
+        other = expression(other)
+        first, second = (other,self) if reverse else (self,other)
+        return Expression(lambda c: operation(first.function(c),second.function(c)),
+                          "("+first.text+symbol+second.text+")")
+
+    def __lt__(self,other):
+        return self.combine(other,np.less,"<")
+
+    def __le__(self,other):
+        return self.combine(other,np.less_equal,"<=")
+
+    def __gt__(self,other):
+        return self.combine(other,np.greater,">")
+
+    def __ge__(self,other):
+        return self.combine(other,np.greater_equal,">=")
+
+    def __eq__(self,other):
+        return self.combine(other,np.equal,"==")
+
+    def __ne__(self,other):
+        return self.combine(other,np.not_equal,"!=")
+
+    __hash__ = None
+
+    def __and__(self,other):
+        return self.combine(other,np.logical_and,"&")
+
+    def __or__(self,other):
+        return self.combine(other,np.logical_or,"|")
+
+    def __invert__(self):
+        return Expression(lambda c: np.logical_not(self.function(c)),"~"+self.text)
+
+    def __add__(self,other):
+        return self.combine(other,np.add,"+")
+
+    def __radd__(self,other):
+        return self.combine(other,np.add,"+",True)
+
+    def __sub__(self,other):
+        return self.combine(other,np.subtract,"-")
+
+    def __rsub__(self,other):
+        return self.combine(other,np.subtract,"-",True)
+
+    def __mul__(self,other):
+        return self.combine(other,np.multiply,"*")
+
+    def __rmul__(self,other):
+        return self.combine(other,np.multiply,"*",True)
+
+    def __truediv__(self,other):
+        return self.combine(other,np.divide,"/")
+
+    def __rtruediv__(self,other):
+        return self.combine(other,np.divide,"/",True)
+
+    def __pow__(self,other):
+        return self.combine(other,np.power,"**")
+
+    def __neg__(self):
+        return Expression(lambda c: -self.function(c),"-"+self.text)
+
+    def __abs__(self):
+        return Expression(lambda c: np.abs(self.function(c)),"abs("+self.text+")")
+
+
+def Column(name):
+    """Returns the expression for a named column (see columnFunctions)"""
+    if name not in columnFunctions:
+        raise KeyError("Unknown column "+name)
+    return Expression(lambda c: c[name],name)
+
+
+def expression(value):
+    """Returns value as an Expression, treating strings as column names and
+    numbers as constants"""
+    if isinstance(value,Expression):
+        return value
+    if isinstance(value,str):
+        return Column(value)
+    return Expression(lambda c: value,repr(value))
+
+
+def isSpecies(*particleTypes):
+    """Returns the expression which holds for particles of any of the types"""
+    codes = [resolveType(particleType) for particleType in particleTypes]
+    return Expression(lambda c: np.isin(c["code"],codes),
+                      "species("+",".join(particleTypes)+")")
+
+
+def log10(value):
+    """Returns the expression for the log10 of an expression"""
+    value = expression(value)
+    return Expression(lambda c: np.log10(value.function(c)),"log10("+value.text+")")
+
+
+def evaluate(value,data):
+    """Returns the array of an expression (or column name) for a ParticleStack
+    or Columns"""
+    return expression(value).evaluate(data)
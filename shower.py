@@ -1,13 +1,22 @@
 """Code to generate hadron shower from primary"""
+import os
+import json
+import time
+import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-from constants import pi
-from MCmethods import isotropicAngles, pointInCircle, randomDistance, chooseEnergy
-from particle import Particle
+from constants import pi, c
+from MCmethods import CounterSource, getSource, isotropicAngles, pointInCircle, randomDistance, \
+    chooseEnergy
+from particle import Particle, propagationTypes
+from particleStack import ParticleStack
 from atmosphere import density, getAtmosphericNucleus, getAirCrossSection, getCollisionInverseCDF
 from interactions import decay, collision, getDecayInverseCDF
 
 
+# Largest primary kinetic energy (MeV) drawn by generatePrimary
+maxPrimaryEnergy = 1e14
+
 
 def generatePrimary(**kwargs):
     """Returns a randomized primary particle with optional set attributes"""
@@ -19,6 +28,7 @@ def generatePrimary(**kwargs):
     theta = None
     phi = None
     isotropic = False
+    rng = None
 
     # Set values
     for key,val in kwargs.items():
@@ -28,9 +38,9 @@ def generatePrimary(**kwargs):
             height = val
         elif key=="minE":
             if not("energy" in kwargs.keys()):
-                ke = 2e14
-                while ke>1e14:
-                    ke = chooseEnergy(minimum=val)
+                ke = 2*maxPrimaryEnergy
+                while ke>maxPrimaryEnergy:
+                    ke = chooseEnergy(minimum=val,rng=kwargs.get("rng"))
         elif key=="energy":
             ke = val
         elif key=="theta":
@@ -39,6 +49,8 @@ def generatePrimary(**kwargs):
             phi = val
         elif key=="isotropic":
             isotropic = bool(val)
+        elif key=="rng":
+            rng = val
         else:
             print("Warning: argument",key,"in generatePrimary not recognized")
 
@@ -48,17 +60,17 @@ def generatePrimary(**kwargs):
         height = 500000
     if position is None:
         if isotropic:
-            x, y = pointInCircle(radius=1000)
+            x, y = pointInCircle(radius=1000,rng=rng)
             position = [x,y,height]
         else:
             position = [0,0,height]
     if ke is None:
-        ke = 2e14
-        while ke>1e14:
-            ke = chooseEnergy(minimum=1000)
+        ke = 2*maxPrimaryEnergy
+        while ke>maxPrimaryEnergy:
+            ke = chooseEnergy(minimum=1000,rng=rng)
     if theta is None or phi is None:
         if isotropic:
-            theta, phi = isotropicAngles(downgoing=True)
+            theta, phi = isotropicAngles(downgoing=True,rng=rng)
         else:
             theta = pi
             phi = 0
@@ -66,13 +78,13 @@ def generatePrimary(**kwargs):
     return Particle(particleType,pos=position,KE=ke,theta=theta,phi=phi)
 
 
-def getNextInteraction(particle):
+def getNextInteraction(particle,rng=None):
     """Return a propagation length for the particle and the particle it
     interacts with after the propagation (decay returns "decay" as target,
     continued propagation returns None as target)"""
     if particle.lifetime is not None:
         decayInvCDF = getDecayInverseCDF(particle.lifetime,particle.beta)
-        decayLength = randomDistance(decayInvCDF)
+        decayLength = randomDistance(decayInvCDF,rng)
     else:
         decayLength = None
     if particle.type in ["pi+","pi-","p+","n0"]:
@@ -80,25 +92,25 @@ def getNextInteraction(particle):
         z = particle.position[2]
         theta = particle.theta
         collisionInvCDF = getCollisionInverseCDF(sigma,z,theta)
-        collisionLength = randomDistance(collisionInvCDF)
+        collisionLength = randomDistance(collisionInvCDF,rng)
     else:
         collisionLength = None
 
     if decayLength is None:
-        return collisionLength, getAtmosphericNucleus(particle.position)
+        return collisionLength, getAtmosphericNucleus(particle.position,rng)
     elif collisionLength is None:
         return decayLength, "decay"
     else:
         if decayLength<collisionLength:
             return decayLength, "decay"
         else:
-            return collisionLength, getAtmosphericNucleus(particle.position)
+            return collisionLength, getAtmosphericNucleus(particle.position,rng)
 
 
-def propagate(particle,floor=None,ceiling=None):
+def propagate(particle,floor=None,ceiling=None,rng=None):
     """Propagate the particle and return particle that caused it to stop
     (decay returns "decay")"""
-    distance, target = getNextInteraction(particle)
+    distance, target = getNextInteraction(particle,rng)
     # Stop particles at the floor level
     if floor is not None and \
        particle.position[2]+distance*particle.direction[2]<floor:
@@ -115,37 +127,230 @@ def propagate(particle,floor=None,ceiling=None):
     return target
 
 
-def interact(particle,target=None):
+def interact(particle,target=None,ledger=None,rng=None):
     """Interact the particle with the target (or "decay") and return the
-    products. If target is None, do nothing and return the particle"""
+    products. If target is None, do nothing and return the particle. If a
+    ledger is given, products of the types it tallies are added to it instead"""
     if target is None:
         return [particle]
-    elif target is "decay":
-        return decay(particle)
+    elif target=="decay":
+        return decay(particle,ledger,rng)
     elif target.type=="N" or target.type=="O" or target.type=="Ar":
-        return collision(particle,target)
+        return collision(particle,target,ledger,rng)
     else:
         print("Warning: no supported interaction between",particle.type,
               "and",target.type)
         return [particle,target]
 
 
-def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=None):
-    """Generates a full hadron shower and returns any muons that reach the surface"""
+def stepParticle(particle,floor=None,ceiling=None,generation=0,ledger=None,rng=None,
+                 thinning=None,threshold=None):
+    """Propagate and interact the particle, returning the products. If rng is
+    a CounterSource, the particle's draws come from its own stream for the
+    generation and new products are given ids drawn from that stream. If
+    Thinning settings are given, only the products which survive thinning at
+    the threshold energy are returned, with their weights adjusted"""
+    if isinstance(rng,CounterSource):
+        particleRng = rng.forParticle(particle.id,generation)
+    else:
+        particleRng = rng
+    parentEnergy = particle.energy
+    target = propagate(particle,floor,ceiling,particleRng)
+    products = interact(particle,target,ledger,particleRng)
+    if isinstance(rng,CounterSource) and target is not None:
+        newIds = particleRng.generator.integers(1,2**62,size=len(products))
+        for product,newId in zip(products,newIds):
+            if product.id!=particle.id:
+                product.id = int(newId)
+    if thinning is not None and target is not None and len(products)>0:
+        keep, weights = thinning.sample([p.code for p in products],
+                                        [p.energy for p in products],
+                                        [p.weight for p in products],
+                                        parentEnergy,threshold,particleRng)
+        for product,weight in zip(products,weights):
+            product.weight = float(weight)
+        products = [product for product,kept in zip(products,keep) if kept]
+    return products
+
+
+def transportMuon(muon,floor=None,ceiling=None,generation=0,ledger=None,rng=None,
+                  survival=False):
+    """Moves a muon (which can only decay) in one step to the floor, or to the
+    ceiling if it is going up, and returns the particles left: the muon if it
+    gets there, otherwise its decay products. The decay point is sampled as
+    in propagate (with the same draws as stepParticle for the generation),
+    unless survival is True, in which case the muon always gets there with
+    its weight multiplied by its probability of surviving the distance, and
+    the rest of its weight decays (into the ledger if given)"""
+    if isinstance(rng,CounterSource):
+        rng = rng.forParticle(muon.id,generation)
+    direction = muon.direction
+    z = muon.position[2]
+    beta = muon.beta
+    if beta**2==1:
+        meanLength = 1e300
+    else:
+        meanLength = beta*c*muon.lifetime/np.sqrt(1-beta**2)
+    if survival:
+        plane = floor if direction[2]<0 else ceiling
+        if plane is None or direction[2]==0:
+            reach = np.inf
+        else:
+            reach = (plane-z)/direction[2]
+        survivalProbability = np.exp(-reach/meanLength)
+        if ledger is not None and survivalProbability<1:
+            decayed = muon.copy()
+            decayed.weight *= 1-survivalProbability
+            decay(decayed,ledger,rng)
+        if survivalProbability==0:
+            return []
+        muon.weight *= survivalProbability
+        distance = reach+.1
+        target = None
+    else:
+        distance = -meanLength*np.log(1-getSource(rng).random())
+        target = "decay"
+        # Stop muons at the floor or ceiling level
+        if floor is not None and z+distance*direction[2]<floor:
+            distance = (floor-z)/direction[2]+.1
+            target = None
+        if ceiling is not None and z+distance*direction[2]>ceiling:
+            distance = (ceiling-z)/direction[2]+.1
+            target = None
+    for i in range(len(muon.position)):
+        muon.position[i] += distance * direction[i]
+    return interact(muon,target,ledger,rng)
+
+
+def cutParticle(particle,cuts=None,ledger=None):
+    """Returns whether the CutPolicy (if given) drops the particle, adding it
+    to the ledger (if given) when it does"""
+    if cuts is None or not(cuts.dropsParticle(particle)):
+        return False
+    if ledger is not None:
+        ledger.add(particle.code,particle.energy,particle.momentum,weight=particle.weight)
+    return True
+
+
+def snapshotSettings(primary,rng=None,thinning=None,cuts=None,muonTransport=None):
+    """Returns the settings a shower snapshot can only be restarted with: the
+    primary, the CounterSource keys (a RandomSource continues from the saved
+    state), and the thinning, cuts and muon transport"""
+    return {"primary": {"type": primary.type, "energy": float(primary.energy),
+                        "position": [float(x) for x in primary.position],
+                        "direction": [float(x) for x in primary.direction]},
+            "rng": [rng.seed,rng.shower] if isinstance(rng,CounterSource) else None,
+            "thinning": None if thinning is None else thinning.state(),
+            "cuts": None if cuts is None else cuts.state(),
+            "muonTransport": muonTransport}
+
+
+def saveShowerSnapshot(filename,particles,loopCount,ceiling,rng=None,ledger=None,
+                       info=None,settings=None):
+    """Writes the state of a shower between generations (its particles, loop
+    count, ceiling, random number state, ledger tallies, info, and settings)
+    to the snapshot file, replacing any earlier snapshot in one step"""
+    stack = ParticleStack.fromParticles(particles)
+    if isinstance(rng,CounterSource):
+        rngState = {"seed": rng.seed, "shower": rng.shower}
+    else:
+        rngState = getSource(rng).getState()
+    arrays = {"codes": stack.codes, "positions": stack.positions,
+              "momenta": stack.momenta, "ids": stack.ids, "weights": stack.weights,
+              "state": np.array(json.dumps({"loopCount": loopCount, "ceiling": ceiling,
+                                            "rng": rngState, "info": info,
+                                            "settings": settings}))}
+    if ledger is not None:
+        arrays.update({"ledgerCounts": ledger.counts, "ledgerEnergy": ledger.energy,
+                       "ledgerMomentum": ledger.momentum})
+    temporaryName = filename+".tmp"
+    with open(temporaryName,'wb') as sFile:
+        np.savez(sFile,**arrays)
+        sFile.flush()
+        os.fsync(sFile.fileno())
+    os.replace(temporaryName,filename)
+
+
+def loadShowerSnapshot(filename,rng=None,ledger=None,info=None,settings=None):
+    """Returns the particles, loop count, and ceiling of a shower snapshot,
+    restoring the random number state to rng (or the default source), and
+    the tallies to the ledger and the saved info to info if given. If
+    settings are given, a ValueError is raised unless the snapshot was saved
+    with the same settings"""
+    with np.load(filename) as snapshot:
+        state = json.loads(str(snapshot["state"]))
+        if settings is not None:
+            # Compare the settings as they are stored
+            settings = json.loads(json.dumps(settings))
+            stored = state.get("settings") or {}
+            changed = [name for name in settings if stored.get(name)!=settings[name]]
+            if len(changed)>0:
+                raise ValueError(filename+" is a snapshot of a shower with different "+
+                                 ", ".join(changed)+", so remove it to start this shower")
+        stack = ParticleStack(snapshot["codes"],snapshot["positions"],
+                              snapshot["momenta"],snapshot["ids"],
+                              weights=snapshot["weights"] if "weights" in snapshot else None)
+        if ledger is not None and "ledgerCounts" in snapshot:
+            ledger.counts[:] = snapshot["ledgerCounts"]
+            ledger.energy[:] = snapshot["ledgerEnergy"]
+            ledger.momentum[:] = snapshot["ledgerMomentum"]
+    if not(isinstance(rng,CounterSource)):
+        getSource(rng).setState(state["rng"])
+    if info is not None and state.get("info") is not None:
+        info.update(state["info"])
+    return stack.toParticles(), state["loopCount"], state["ceiling"]
+
+
+# Options of the shower functions (generateShower, and generateEnsemble and
+# the parallel runners, which pass them on):
+#   ledger - EnergyLedger in which products which are never propagated (or
+#       which the cuts drop) are tallied instead of being built
+#   rng - RandomSource to draw from (default the global one). With a
+#       CounterSource the primary gets id 0 and the shower can be replayed
+#       branch by branch (see replayBranch), with the state of each particle
+#       before each of its steps appended to history if it is a list
+#   info - dictionary to which the number of iterations and the height of
+#       the primary's first interaction (nan if it never interacts) are added
+#   thinning - Thinning settings, with which interaction products below the
+#       threshold (relative to the primary's energy) are sampled and the
+#       returned muons carry weights
+#   cuts - CutPolicy, whose dropped particles are removed before being
+#       propagated
+#   muonTransport - "sample" or "survival" to move muons straight to the
+#       floor as soon as they are produced (see transportMuon), sampling
+#       where they decay or weighting them by their survival probability
+def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=None,
+                   ledger=None,rng=None,ceiling=None,startGeneration=0,history=None,
+                   snapshotFile=None,snapshotInterval=600,info=None,thinning=None,cuts=None,
+                   muonTransport=None):
+    """Generates a full hadron shower and returns any muons that reach the
+    surface (see the options above). If snapshotFile is given the shower is
+    saved to it once snapshotInterval seconds pass between generations, and
+    restarted from it (then removed once finished) if it already exists"""
     #Setup
     particles = [primary]
+    threshold = None if thinning is None else thinning.threshold(primary.energy)
     finished = False
-    propagationParticles = ["pi+","pi-","mu+","mu-","p+","n0","F-16"]
+    propagationParticles = propagationTypes
+    if isinstance(rng,CounterSource) and startGeneration==0:
+        primary.id = 0
+    settings = None if snapshotFile is None else \
+               snapshotSettings(primary,rng,thinning,cuts,muonTransport)
+    if snapshotFile is not None and os.path.exists(snapshotFile):
+        particles, startGeneration, ceiling = loadShowerSnapshot(snapshotFile,rng,ledger,
+                                                                 info,settings)
+    lastSnapshot = time.time()
     if drawShower:
-        vertices = {primary.id: [[x for x in primary.position]]}
-        colors = {primary.id: drawColor(primary.type)}
-        markers = {primary.id: drawMarker(primary.type)}
+        vertices = {particle.id: [[x for x in particle.position]] for particle in particles}
+        colors = {particle.id: drawColor(particle.type) for particle in particles}
+        markers = {particle.id: drawMarker(particle.type) for particle in particles}
 
     # Set a ceiling above which particles can be assumed to escape
-    ceiling = 2*primary.position[2]
+    if ceiling is None:
+        ceiling = 2*primary.position[2]
 
     # Loop until all propagating particles reach the ground
-    loopCount = 0
+    loopCount = startGeneration
     while not(finished):
         loopCount += 1
         products = []
@@ -154,10 +359,24 @@ def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=
         for particle in particles:
             if particle.type in propagationParticles:
                 if particle.position[2]>floor and particle.position[2]<ceiling:
-                    target = propagate(particle,floor,ceiling)
+                    if cutParticle(particle,cuts,ledger):
+                        continue
+                    if history is not None:
+                        history.append((loopCount,particle.copy()))
+                    if muonTransport is not None and particle.type in ["mu+","mu-"]:
+                        newProducts = transportMuon(particle,floor,ceiling,loopCount,ledger,
+                                                    rng,muonTransport=="survival")
+                    else:
+                        newProducts = stepParticle(particle,floor,ceiling,loopCount,
+                                                   ledger,rng,thinning,threshold)
+                    if info is not None and particle is primary and \
+                       "firstInteractionHeight" not in info:
+                        z = particle.position[2]
+                        info["firstInteractionHeight"] = float(z) if z>floor and z<ceiling \
+                                                         else float("nan")
                     if drawShower:
                         vertices[particle.id].append([x for x in particle.position])
-                    products.extend(interact(particle,target))
+                    products.extend(newProducts)
                     propagated += 1
                 else:
                     products.append(particle)
@@ -168,6 +387,27 @@ def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=
         particles = products
         finished = True
 
+        # Move the new muons straight to the ground, each with the random
+        # numbers it would have been stepped with in the next generation
+        if muonTransport is not None:
+            products = []
+            for particle in particles:
+                if not(particle.type in ["mu+","mu-"] and
+                       particle.position[2]>floor and particle.position[2]<ceiling):
+                    products.append(particle)
+                    continue
+                if cutParticle(particle,cuts,ledger):
+                    continue
+                if history is not None:
+                    history.append((loopCount+1,particle.copy()))
+                if drawShower and particle.id not in vertices:
+                    vertices[particle.id] = [[x for x in particle.position]]
+                    colors[particle.id] = drawColor(particle.type)
+                    markers[particle.id] = drawMarker(particle.type)
+                products.extend(transportMuon(particle,floor,ceiling,loopCount+1,ledger,rng,
+                                              muonTransport=="survival"))
+            particles = products
+
         # # Print particles at each step
         # print("---")
         # for particle in particles:
@@ -196,6 +436,18 @@ def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=
             # print("Stopped after",loopCount,"iterations")
             break
 
+        if snapshotFile is not None and not(finished) and \
+           time.time()-lastSnapshot>=snapshotInterval:
+            saveShowerSnapshot(snapshotFile,particles,loopCount,ceiling,rng,ledger,info,
+                               settings)
+            lastSnapshot = time.time()
+
+    if snapshotFile is not None and os.path.exists(snapshotFile):
+        os.remove(snapshotFile)
+    if info is not None:
+        info["iterations"] = loopCount
+        info.setdefault("firstInteractionHeight",float("nan"))
+
     # Get the muons
     muons = []
     for particle in particles:
@@ -213,8 +465,12 @@ def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=
             zvals = [pos[2] for pos in points]
             ax.plot(xs=xvals,ys=yvals,zs=zvals,
                     color=colors[particleId],marker=markers[particleId])
-        # Only show plot below first interaction point
-        plotHeight = vertices[0][1][2]*1.2
+        # Only show plot below first interaction point (or below the highest
+        # particle of a restarted shower)
+        if len(vertices.get(primary.id,[]))>1:
+            plotHeight = vertices[primary.id][1][2]*1.2
+        else:
+            plotHeight = max([points[0][2] for points in vertices.values()])*1.2
         ax.set_zbound(floor,plotHeight)
         if plotName is not None:
             plt.savefig(plotName)
@@ -223,6 +479,21 @@ def generateShower(primary,floor=0,maxIterations=1000,drawShower=False,plotName=
     return muons
 
 
+def replayBranch(particle,generation,rng,ceiling,floor=0,maxIterations=1000,
+                 ledger=None,thinning=None,cuts=None,muonTransport=None):
+    """Re-simulates the branch of a shower below one particle, given the
+    particle's state at the start of the generation (as recorded in the
+    history of generateShower), the CounterSource the shower was generated
+    with, and the shower's ceiling. Returns the muons from the branch that
+    reach the surface, identical to those of the original shower. A thinned
+    shower must be replayed with its Thinning settings fixed to the shower's
+    primary energy (see Thinning.forPrimary), and any CutPolicy and muon
+    transport it had"""
+    return generateShower(particle.copy(),floor,maxIterations,ledger=ledger,rng=rng,
+                          ceiling=ceiling,startGeneration=generation-1,thinning=thinning,
+                          cuts=cuts,muonTransport=muonTransport)
+
+
 def drawColor(particleType):
     """Return the color the particle should be drawn in"""
     if particleType[:2]=="mu":
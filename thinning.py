@@ -0,0 +1,65 @@
+"""Code for statistical (Hillas) thinning of showers"""
+import numpy as np
+from MCmethods import getSource
+from particle import speciesCodes, propagationTypes
+
+propagationCodes = np.array([speciesCodes[t] for t in propagationTypes])
+
+
+class Thinning:
+    """Settings for Hillas thinning of showers. The thinning threshold is
+    level times the energy of the shower's primary (or of primaryEnergy if
+    given, e.g. when replaying a branch of a shower). Each propagating
+    product of an interaction with energy E below the reference energy (the
+    threshold, or the parent's energy if that is lower) is only followed with
+    probability E/reference, and its weight is divided by that probability,
+    so a parent below the threshold leaves about one weighted product. If
+    maxWeight is given, products are kept with at least probability
+    weight/maxWeight, so thinning stops once weights reach maxWeight"""
+    def __init__(self,level=1e-4,maxWeight=None,primaryEnergy=None):
+        self.level = level
+        self.maxWeight = maxWeight
+        self.primaryEnergy = primaryEnergy
+
+    def threshold(self,primaryEnergy):
+        """Returns the thinning threshold for showers of the primary energy"""
+        if self.primaryEnergy is not None:
+            primaryEnergy = self.primaryEnergy
+        return self.level*np.asarray(primaryEnergy,dtype=float)
+
+    def forPrimary(self,primaryEnergy):
+        """Returns the settings with the threshold fixed by the primary energy"""
+        return Thinning(self.level,self.maxWeight,primaryEnergy)
+
+    def sample(self,codes,energies,weights,parentEnergies,thresholds,rng=None):
+        """Returns a boolean array of which products of interactions are kept,
+        and the new weights of the products, given the products' type codes,
+        energies and weights and their parents' energies and thresholds.
+        Random numbers are only drawn for products which may be dropped"""
+        energies = np.asarray(energies,dtype=float)
+        weights = np.asarray(weights,dtype=float)
+        reference = np.minimum(parentEnergies,thresholds)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            probabilities = np.where(reference>0,energies/reference,1)
+        if self.maxWeight is not None:
+            probabilities = np.maximum(probabilities,weights/self.maxWeight)
+        probabilities = np.where(np.isin(codes,propagationCodes),
+                                 np.minimum(probabilities,1),1)
+        keep = np.ones(len(energies),dtype=bool)
+        thinned = probabilities<1
+        if np.any(thinned):
+            keep[thinned] = getSource(rng).random(np.count_nonzero(thinned))<probabilities[thinned]
+        with np.errstate(divide='ignore'):
+            return keep, weights/probabilities
+
+    def state(self):
+        """Returns the settings as a JSON serializable dictionary"""
+        return {"level": self.level, "maxWeight": self.maxWeight,
+                "primaryEnergy": self.primaryEnergy}
+
+    @classmethod
+    def fromState(cls,state):
+        """Returns the settings from state (None for no thinning)"""
+        if state is None:
+            return None
+        return cls(state["level"],state["maxWeight"],state.get("primaryEnergy"))
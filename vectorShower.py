@@ -0,0 +1,433 @@
+"""Code to generate hadron showers by advancing whole generations of a
+structure-of-arrays particle stack at once"""
+from itertools import islice
+import numpy as np
+from constants import c
+from particle import idCounter, speciesTypes, speciesCodes, speciesMasses, propagationTypes
+from particleStack import ParticleStack
+from atmosphere import density
+from MCmethods import getSource, isotropicAngles, randomWithSums, randomMomentumTriangles, chooseMultiplicities
+from interactions import decayChannels, decayMomenta, muonDecayProducts, lorentzBoostArray
+
+pionCodes = np.array([speciesCodes["pi+"],speciesCodes["pi-"],speciesCodes["pi0"]])
+# Nuclear fragment left by a collision, indexed by target and produced pion
+fragmentCodes = {speciesCodes["N"]: np.array([speciesCodes["C-14"],speciesCodes["O-14"],speciesCodes["N"]]),
+                 speciesCodes["O"]: np.array([speciesCodes["N-16"],speciesCodes["F-16"],speciesCodes["O"]]),
+                 speciesCodes["Ar"]: np.array([speciesCodes["Cl-40"],speciesCodes["K-40"],speciesCodes["Ar"]])}
+
+
+def meanDecayLengths(stack):
+    """Returns the mean decay length of each particle in the stack"""
+    # Mean decay length is beta*gamma*c*tau = c*tau*p/m
+    masses = stack.masses
+    safeMasses = np.where(masses>0,masses,1)
+    with np.errstate(invalid='ignore'):
+        meanLengths = c*stack.lifetimes*stack.Pmag/safeMasses
+    meanLengths[masses==0] = 1e300
+    return meanLengths
+
+
+def decayLengths(stack,rng=None):
+    """Returns random decay lengths for each particle in the stack
+    (infinite for stable particles)"""
+    return -meanDecayLengths(stack)*np.log(1-getSource(rng).random(len(stack)))
+
+
+def airCrossSections(stack):
+    """Returns the cross section (in m^2) with the air of each particle in the
+    stack (nan for particles which don't collide)"""
+    s = 2*stack.energy/1000*13 #GeV^2
+    base = np.full(len(stack),np.nan)
+    base[stack.isType("p+","n0")] = 32.4
+    base[stack.isType("pi+","pi-")] = 16
+    sigma_p = base - 1.2*np.log(s) + 0.21*np.log(s)**2
+    sigma_air = sigma_p*4+100
+    #Convert from mb to m^2
+    return sigma_air*1e-31
+
+
+def collisionLengths(stack,scaleHeight=8000,rng=None):
+    """Returns random collision lengths for each particle in the stack based on
+    the atmospheric model (infinite for particles which don't collide)"""
+    pmag = stack.Pmag
+    cosTheta = np.where(pmag>0,stack.momenta[:,2]/np.where(pmag>0,pmag,1),1)
+    a = density(0)*airCrossSections(stack)
+    with np.errstate(divide='ignore'):
+        b = scaleHeight/cosTheta
+    cc = np.exp(-stack.positions[:,2]/scaleHeight)
+    with np.errstate(over='ignore',invalid='ignore',divide='ignore'):
+        n = np.where(b>0,1-np.exp(-a*b*cc),1)
+        arg = 1+np.log(1-n*getSource(rng).random(len(stack)))/(a*b*cc)
+        # Catch negative logarithms and assume they should be nearly log(0)
+        lengths = np.where(arg<0,1e99,-b*np.log(arg))
+    lengths[np.isnan(a)] = np.inf
+    return lengths
+
+
+def atmosphericNucleusCodes(size,rng=None):
+    """Returns array of atomic nucleus type codes based on the atmospheric
+    composition"""
+    atomSeeds = getSource(rng).random(size)
+    nuclei = np.full(size,speciesCodes["Ar"],dtype=np.int16)
+    nuclei[atomSeeds>=.01] = speciesCodes["O"]
+    nuclei[atomSeeds>=1-.78] = speciesCodes["N"]
+    return nuclei
+
+
+def newIds(size):
+    """Returns array of the next size unique particle ids"""
+    return np.fromiter(islice(idCounter,size),dtype=np.int64,count=size)
+
+
+def tallyStack(stack,ledger=None):
+    """Adds particles of the types tallied by the ledger to the ledger and
+    returns the stack of remaining particles"""
+    if ledger is None:
+        return stack
+    tallied = ledger.tallies(stack.codes)
+    if np.any(tallied):
+        ledger.addArrays(stack.codes[tallied],stack.energy[tallied],
+                         stack.momenta[tallied],stack.showers[tallied],
+                         stack.weights[tallied])
+    return stack.select(~tallied)
+
+
+def thinStack(stack,parentEnergies,thinning=None,thresholds=None,rng=None):
+    """Returns the products in the stack which survive thinning (see
+    Thinning.sample) given their parents' energies and thinning thresholds,
+    with their weights adjusted"""
+    if thinning is None or len(stack)==0:
+        return stack
+    keep, weights = thinning.sample(stack.codes,stack.energy,stack.weights,
+                                    parentEnergies,thresholds,rng)
+    stack.weights = weights
+    return stack.select(keep)
+
+
+def propagateStack(stack,floor=None,ceiling=None,rng=None):
+    """Propagate every particle in the stack in place and return arrays
+    indicating which particles decay and which collide (particles stopped at
+    the floor or ceiling do neither)"""
+    decayLength = decayLengths(stack,rng)
+    collisionLength = collisionLengths(stack,rng=rng)
+    decays = decayLength<collisionLength
+    distance = np.where(decays,decayLength,collisionLength)
+    stopped = np.zeros(len(stack),dtype=bool)
+
+    dz = stack.direction[:,2]
+    z = stack.positions[:,2]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # Stop particles at the floor level
+        if floor is not None:
+            below = z+distance*dz<floor
+            distance = np.where(below,(floor-z)/dz+.1,distance)
+            stopped |= below
+        # Stop particles at the ceiling level
+        if ceiling is not None:
+            above = z+distance*dz>ceiling
+            distance = np.where(above,(ceiling-z)/dz+.1,distance)
+            stopped |= above
+    # Otherwise, propagate completely
+    stack.positions += distance[:,None]*stack.direction
+
+    return decays & ~stopped, ~decays & ~stopped
+
+
+def collideStack(stack,targetCodes,ledger=None,rng=None,thinning=None,thresholds=None):
+    """Calculate kinematics of collisions between every particle in the stack
+    and its target nucleus at rest, following interactions.collision for all
+    collisions at once. Returns stack of the collision products, except those
+    tallied by the ledger (if given) or dropped by thinning (if given, with
+    the threshold of each particle)"""
+    rng = getSource(rng)
+    size = len(stack)
+    # Determine product types
+    pionIndex = (rng.random(size)*3).astype(int)
+    productPions = pionCodes[pionIndex]
+    fragments = np.zeros(size,dtype=np.int16)
+    for target,options in fragmentCodes.items():
+        isTarget = targetCodes==target
+        fragments[isTarget] = options[pionIndex[isTarget]]
+    firstSetCodes = np.stack([stack.codes,fragments,productPions],axis=1)
+    firstSetMasses = speciesMasses[firstSetCodes]
+
+    # Boost to the COM frame before getting energies
+    energy = stack.energy
+    pmag = stack.Pmag
+    targetMass = speciesMasses[targetCodes]
+    beta = pmag/(energy+targetMass)
+    direction = stack.direction
+    gamma = 1/np.sqrt(1-beta**2)
+    comEnergy = lorentzBoostArray(np.column_stack((energy,stack.momenta)),
+                                  beta,direction)[:,0] + gamma*targetMass
+    totalKE = comEnergy - np.sum(firstSetMasses,axis=1)
+
+    # Not enough energy for collision to do anything, so particle continues
+    elastic = totalKE<=0
+    unchanged = stack.select(elastic)
+    rows = np.flatnonzero(~elastic)
+    if len(rows)==0:
+        return unchanged
+
+    # Divide non-mass energy randomly among the first set of products plus
+    # the number of additional pion sets given by the multiplicity
+    mults = chooseMultiplicities(energy[rows],totalKE[rows],rng=rng)
+    setCounts = mults+1
+    setKEs = randomWithSums(setCounts,totalKE[rows],rng)
+    setRows = np.repeat(rows,setCounts)
+    firstSets = np.concatenate(([0],np.cumsum(setCounts)[:-1]))
+    setCodes = np.tile(pionCodes,(len(setRows),1))
+    setCodes[firstSets] = firstSetCodes[rows]
+    momenta = randomMomentumTriangles(setKEs,speciesMasses[setCodes],rng=rng).reshape(-1,3)
+
+    # Boost momenta to the lab frame
+    productRows = np.repeat(setRows,3)
+    productCodes = setCodes.reshape(-1)
+    productEnergies = np.sqrt(speciesMasses[productCodes]**2+np.sum(momenta**2,axis=1))
+    fourmomenta = lorentzBoostArray(np.column_stack((productEnergies,momenta)),
+                                    beta[productRows],-direction[productRows])
+
+    # Colliding particle keeps its id, all other products get new ids
+    ids = newIds(len(productRows))
+    ids[3*firstSets] = stack.ids[rows]
+
+    products = ParticleStack(codes=productCodes,
+                             positions=stack.positions[productRows],
+                             momenta=fourmomenta[:,1:],
+                             ids=ids,
+                             showers=stack.showers[productRows],
+                             weights=stack.weights[productRows])
+    if thinning is not None:
+        products = thinStack(products,energy[productRows],thinning,
+                             thresholds[productRows],rng)
+    return ParticleStack.concatenate([unchanged,tallyStack(products,ledger)])
+
+
+def decayStack(stack,ledger=None,rng=None,thinning=None,thresholds=None):
+    """Decay every particle in the stack, following interactions.decay for all
+    particles of each decay channel at once. Returns stack of decay products,
+    except those tallied by the ledger (if given) or dropped by thinning (if
+    given, with the threshold of each particle)"""
+    products = []
+    for code in np.unique(stack.codes):
+        parentType = speciesTypes[code]
+        isParent = stack.codes==code
+        parents = stack.select(isParent)
+        size = len(parents)
+        if parentType in decayChannels:
+            # Kinematics in rest frame, using the tabulated product momentum
+            productCodes = [speciesCodes[t] for t in decayChannels[parentType]]
+            pmag1 = decayMomenta[parentType]
+            theta,phi = isotropicAngles(size=size,rng=rng)
+            p1 = pmag1*np.column_stack((np.sin(theta)*np.cos(phi),
+                                        np.sin(theta)*np.sin(phi),
+                                        np.cos(theta)))
+            restMomenta = np.concatenate((p1,-p1))
+            productMasses = np.repeat(speciesMasses[productCodes],size)
+            restEnergies = np.sqrt(productMasses**2+pmag1**2)
+
+            # Boost momenta to lab frame
+            fourmomenta = lorentzBoostArray(np.column_stack((restEnergies,restMomenta)),
+                                            np.tile(parents.beta,2),
+                                            -np.tile(parents.direction,(2,1)))
+            channelProducts = ParticleStack(codes=np.repeat(productCodes,size),
+                                            positions=np.tile(parents.positions,(2,1)),
+                                            momenta=fourmomenta[:,1:],
+                                            ids=newIds(2*size),
+                                            showers=np.tile(parents.showers,2),
+                                            weights=np.tile(parents.weights,2))
+            if thinning is not None:
+                channelProducts = thinStack(channelProducts,np.tile(parents.energy,2),
+                                            thinning,np.tile(thresholds[isParent],2),rng)
+            products.append(channelProducts)
+        elif parentType in muonDecayProducts:
+            # Electron takes all the energy, neutrinos are ignored
+            productCodes = [speciesCodes[t] for t in muonDecayProducts[parentType]]
+            electronMass = speciesMasses[productCodes[0]]
+            electronPmag = np.sqrt(parents.energy**2-electronMass**2)
+            momenta = np.zeros((3*size,3))
+            momenta[:size] = electronPmag[:,None]*parents.direction
+            products.append(ParticleStack(codes=np.repeat(productCodes,size),
+                                          positions=np.tile(parents.positions,(3,1)),
+                                          momenta=momenta,
+                                          ids=newIds(3*size),
+                                          showers=np.tile(parents.showers,3),
+                                          weights=np.tile(parents.weights,3)))
+        else:
+            print("Warning:",parentType,"decay not known")
+            products.append(parents)
+    return tallyStack(ParticleStack.concatenate(products),ledger)
+
+
+def interactStack(stack,decays,collides,ledger=None,rng=None,thinning=None,
+                  thresholds=None):
+    """Interact the decaying and colliding particles of the stack and return a
+    stack of products which propagate (thinned with the threshold of each
+    particle if Thinning settings are given)"""
+    targets = atmosphericNucleusCodes(np.count_nonzero(collides),rng)
+    if thinning is None:
+        decayThresholds = collideThresholds = None
+    else:
+        decayThresholds, collideThresholds = thresholds[decays], thresholds[collides]
+    products = ParticleStack.concatenate([decayStack(stack.select(decays),ledger,rng,
+                                                     thinning,decayThresholds),
+                                          collideStack(stack.select(collides),targets,
+                                                       ledger,rng,thinning,
+                                                       collideThresholds)])
+    return products.select(products.isType(*propagationTypes))
+
+
+def transportMuons(stack,floor=0,ceilings=None,ledger=None,rng=None,survival=False):
+    """Moves every muon in the stack in one step to the floor, or to its
+    ceiling if it is going up, as shower.transportMuon does, and returns the
+    stack of muons which get there along with the decay products of those
+    which don't (except those tallied by the ledger, if given). If survival
+    is True every muon gets there, its weight multiplied by its probability
+    of surviving the distance, and the rest of its weight decays"""
+    dz = stack.direction[:,2]
+    z = stack.positions[:,2]
+    planes = np.where(dz<0,floor,ceilings)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        reach = np.where(dz!=0,(planes-z)/np.where(dz!=0,dz,1),np.inf)
+    if survival:
+        with np.errstate(invalid='ignore'):
+            survivalProbability = np.exp(-reach/meanDecayLengths(stack))
+        products = ParticleStack()
+        decaying = survivalProbability<1
+        if ledger is not None and np.any(decaying):
+            decayed = stack.select(decaying)
+            decayed.weights = decayed.weights*(1-survivalProbability[decaying])
+            products = decayStack(decayed,ledger,rng)
+        arrives = survivalProbability>0
+        stack.weights = stack.weights*survivalProbability
+    else:
+        lengths = decayLengths(stack,rng)
+        decays = lengths<reach
+        stack.positions[decays] += lengths[decays,None]*stack.direction[decays]
+        products = decayStack(stack.select(decays),ledger,rng)
+        arrives = ~decays
+    arrived = stack.select(arrives)
+    arrived.positions += (reach[arrives]+.1)[:,None]*arrived.direction
+    return ParticleStack.concatenate([arrived,products])
+
+
+def cutStack(stack,cuts=None,ledger=None):
+    """Returns boolean array of which particles in the stack the CutPolicy
+    (if given) drops, adding them to the ledger (if given)"""
+    if cuts is None:
+        return np.zeros(len(stack),dtype=bool)
+    dropped = cuts.drops(stack.codes,stack.ke,stack.momenta[:,2])
+    if ledger is not None and np.any(dropped):
+        ledger.addArrays(stack.codes[dropped],stack.energy[dropped],
+                         stack.momenta[dropped],stack.showers[dropped],
+                         stack.weights[dropped])
+    return dropped
+
+
+def advanceGeneration(stack,floor=None,ceiling=None,ledger=None,rng=None,thinning=None,
+                      thresholds=None):
+    """Propagate and interact every particle in the stack, returning the stack
+    of particles in the next generation"""
+    decays, collides = propagateStack(stack,floor,ceiling,rng)
+    interacting = decays|collides
+    products = interactStack(stack,decays,collides,ledger,rng,thinning,thresholds)
+    return ParticleStack.concatenate([stack.select(~interacting),products])
+
+
+def generateShowerVectorized(primary,floor=0,maxIterations=1000,asStack=False,
+                             ledger=None,rng=None,info=None,thinning=None,cuts=None,
+                             muonTransport=None):
+    """Generates a full hadron shower using the particle stack and returns any
+    muons that reach the surface (as a list of Particles, or as a ParticleStack
+    if asStack is True). If an EnergyLedger is given, products which are never
+    propagated are tallied in it instead of being kept. If info is a
+    dictionary, the number of iterations and the height of the primary's
+    first interaction are added to it. If Thinning settings are given, the
+    shower is thinned and the muons carry weights. If a CutPolicy is given,
+    particles it drops are removed before being propagated. If muonTransport
+    is "sample" or "survival", muons are moved straight to the ground as
+    soon as they are produced (see transportMuons)"""
+    infos = None if info is None else [info]
+    return generateEnsemble([primary],floor,maxIterations,asStack,ledger,rng,infos,
+                            thinning,cuts,muonTransport)[0]
+
+
+def generateEnsemble(primaries,floor=0,maxIterations=1000,asStack=False,
+                     ledger=None,rng=None,infos=None,thinning=None,cuts=None,
+                     muonTransport=None):
+    """Generates the showers of all primaries together in one particle stack
+    and returns a list of the muons that reach the surface from each shower
+    (as ParticleStacks if asStack is True). The options are those of
+    shower.generateShower, with a ledger row and a dictionary in infos for
+    each shower"""
+    stack = ParticleStack.fromParticles(primaries,showers=np.arange(len(primaries)))
+    if thinning is not None:
+        showerThresholds = np.broadcast_to(thinning.threshold(stack.energy),len(stack))
+
+    # Set a ceiling for each shower above which particles can be assumed to escape
+    showerCeilings = 2*stack.positions[:,2]
+    iterations = np.zeros(len(primaries),dtype=int)
+    firstHeights = np.full(len(primaries),np.nan)
+    transported = []
+
+    # Loop until all propagating particles reach the ground
+    loopCount = 0
+    while True:
+        loopCount += 1
+        # Only particles between the floor and ceiling need propagating
+        z = stack.positions[:,2]
+        ceiling = showerCeilings[stack.showers]
+        active = (z>floor) & (z<ceiling)
+        current = stack.select(active)
+        currentCeiling = ceiling[active]
+        if cuts is not None:
+            dropped = cutStack(current,cuts,ledger)
+            current = current.select(~dropped)
+            currentCeiling = currentCeiling[~dropped]
+        iterations[current.showers] = loopCount
+        thresholds = None if thinning is None else showerThresholds[current.showers]
+        nextGeneration = advanceGeneration(current,floor,currentCeiling,ledger,rng,
+                                           thinning,thresholds)
+        if loopCount==1:
+            # The primaries have been moved to their first interactions
+            z = current.positions[:,2]
+            interacted = (z>floor) & (z<currentCeiling)
+            firstHeights[current.showers[interacted]] = z[interacted]
+        stack = ParticleStack.concatenate([stack.select(~active),nextGeneration])
+        stack = stack.select(stack.isType(*propagationTypes))
+
+        # Move the new muons straight to the ground, keeping them aside as
+        # they are done with
+        if muonTransport is not None:
+            z = stack.positions[:,2]
+            ceiling = showerCeilings[stack.showers]
+            moving = stack.isType("mu+","mu-") & (z>floor) & (z<ceiling)
+            if np.any(moving):
+                muons = stack.select(moving)
+                kept = ~cutStack(muons,cuts,ledger)
+                muons = muons.select(kept)
+                muons = transportMuons(muons,floor,ceiling[moving][kept],ledger,rng,
+                                       muonTransport=="survival")
+                transported.append(muons.select(muons.isType(*propagationTypes)))
+                stack = stack.select(~moving)
+
+        # Check to see if all propagating particles have reached the ground
+        z = stack.positions[:,2]
+        ceiling = showerCeilings[stack.showers]
+        if not(np.any((z>floor) & (z<ceiling))):
+            break
+        if loopCount==maxIterations:
+            break
+
+    if infos is not None:
+        for i,info in enumerate(infos):
+            info["iterations"] = int(iterations[i])
+            info["firstInteractionHeight"] = float(firstHeights[i])
+
+    # Get the muons of each shower
+    stack = ParticleStack.concatenate([stack]+transported)
+    muons = stack.select(stack.isType("mu+","mu-") & (stack.positions[:,2]<0))
+    showerMuons = muons.splitShowers(len(primaries))
+    if asStack:
+        return showerMuons
+    return [muons.toParticles() for muons in showerMuons]